@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# batch.py - Scores many dropsuit loadouts at once.
+# Copyright (C) 2013 Mark Wingerd <markwingerd@yahoo.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+from fitting import Dropsuit
+from rules import (DROPSUIT_PLAN, WEAPON_PLAN, ADD, MULTIPLY, STACKING_PENALTY)
+from skillmatrix import get_skill_matrix
+from util import XmlRetrieval
+
+# Columns of the array returned by BatchEvaluator.evaluate.
+BATCH_STATS = ('shield_hp', 'shield_recharge', 'armor_hp', 'armor_repair_rate',
+	'cpu_used', 'cpu_max', 'pg_used', 'pg_max', 'movement_speed',
+	'sprint_speed', 'scan_profile', 'primary_dps')
+
+# Slot types in the order Fitting lists them. An items slot code is its index.
+SLOT_TYPES = ('heavy_weapon', 'light_weapon', 'sidearm', 'grenade', 'equipment',
+	'hi_slot', 'low_slot')
+
+# The columns which hi and low slot modules change, by how rules.RULES
+# combines them with the dropsuit.
+ADDITIVE_STATS = tuple([s for s in DROPSUIT_PLAN.additive if s in BATCH_STATS])
+MULTIPLICATIVE_STATS = tuple([s for s in DROPSUIT_PLAN.multiplicative if s in BATCH_STATS])
+STACKING_STATS = tuple([s for s in DROPSUIT_PLAN.stacking if s in BATCH_STATS])
+
+# Item stats kept as columns. Weapons use damage as their base damage, damage
+# modifiers use it as the bonus they give the weapons they enhance. The same
+# goes for any other stat WEAPON_PLAN has a rule for, and stats stacking
+# together with a column need columns too.
+ITEM_STATS = ('cpu', 'pg', 'cpu_bonus', 'pg_bonus', 'damage', 'rate_of_fire') + \
+	ADDITIVE_STATS + MULTIPLICATIVE_STATS + STACKING_STATS
+ITEM_STATS += tuple(sorted(set(WEAPON_PLAN.stats +
+	sum([DROPSUIT_PLAN.get_group(s) for s in STACKING_STATS], ())) - set(ITEM_STATS)))
+
+# Id of an empty slot.
+EMPTY = -1
+
+# Loadouts are evaluated this many rows at a time to bound memory use.
+CHUNK_SIZE = 4096
+
+
+class BatchEvaluator:
+	""" Evaluates loadouts for one dropsuit and character. A loadout is a row of
+	item ids, see get_id, in the order they would be fitted. Items beyond the
+	dropsuits slots are ignored just as Fitting.add_module ignores them. """
+	def __init__(self, ds_name, character):
+		self.ds_name = ds_name
+		self.dropsuit = Dropsuit(character, ds_name)
+		self.max_slots = np.array([self.dropsuit.stats[s] for s in SLOT_TYPES])
+
+		# Every module and weapon with the characters skills applied, all at
+		# once through the skill matrix. Row 0 is the empty slot so an id is its
+		# row minus one.
+		matrix = get_skill_matrix()
+		values = matrix.apply(matrix.get_effects(character))
+		self.names = []
+		self.ids = {}
+		slot_codes = [EMPTY]
+		enhances = [EMPTY]
+		columns = dict((stat, [0.0]) for stat in ITEM_STATS)
+		for xml_file in ('module.xml', 'weapon.xml'):
+			data = XmlRetrieval(xml_file)
+			for name in data.get_list():
+				if name in self.ids:
+					continue
+				properties, effecting_skills = data.get_target(name)
+				stats = matrix.get_stats(values, xml_file, name)
+				self.ids[name] = len(self.names)
+				self.names.append(name)
+				slot_codes.append(SLOT_TYPES.index(properties['slot_type']))
+				if properties.get('enhances') in SLOT_TYPES:
+					enhances.append(SLOT_TYPES.index(properties['enhances']))
+				else:
+					enhances.append(EMPTY)
+				for stat in ITEM_STATS:
+					columns[stat].append(stats.get(stat) or 0.0)
+
+		self.slot_codes = np.array(slot_codes)
+		self.enhances = np.array(enhances)
+		self.columns = dict((s, np.array(columns[s], dtype=float)) for s in columns)
+
+	def get_id(self, name):
+		""" Returns the id of a module or weapon. """
+		return self.ids[name]
+
+	def get_ids(self, loadouts, width=None):
+		""" Turns lists of item names into an id array, padding short rows with
+		empty slots. """
+		if width is None:
+			width = max([len(l) for l in loadouts] or [0])
+		ids = np.empty((len(loadouts), width), dtype=int)
+		ids.fill(EMPTY)
+		for row, loadout in enumerate(loadouts):
+			ids[row, :len(loadout)] = [self.ids[name] for name in loadout]
+		return ids
+
+	def evaluate(self, ids):
+		""" Returns an N x len(BATCH_STATS) array of final stats for an N x slots
+		array of item ids. primary_dps is 0 when no heavy or light weapon is
+		fitted. """
+		ids = np.asarray(ids, dtype=int)
+		if ids.ndim == 1:
+			ids = ids.reshape(1, -1)
+		output = np.empty((len(ids), len(BATCH_STATS)))
+		for start in range(0, len(ids), CHUNK_SIZE):
+			rows = ids[start:start + CHUNK_SIZE] + 1
+			columns = dict((s, self.columns[s][rows]) for s in self.columns)
+			output[start:start + CHUNK_SIZE] = evaluate_columns(columns,
+				self.slot_codes[rows], self.enhances[rows], self.dropsuit.stats,
+				self.max_slots)
+		return output
+
+	def evaluate_one(self, loadout):
+		""" Returns {stat: value} for a single list of item names. """
+		return dict(zip(BATCH_STATS, self.evaluate(self.get_ids([loadout]))[0]))
+
+
+def evaluate_columns(columns, slots, enhances, base, max_slots):
+	""" Applies the Fitting rules to N loadouts at once.
+
+	columns maps each of ITEM_STATS to an N x slots array of item values, slots
+	and enhances are N x slots arrays of slot codes and base holds the dropsuit
+	stats, either as numbers or as length N arrays. """
+	# Drop the items which do not fit, in fitting order.
+	fitted = np.zeros(slots.shape, dtype=bool)
+	for code in range(len(SLOT_TYPES)):
+		of_type = slots == code
+		fitted |= of_type & (np.cumsum(of_type, axis=1) <= max_slots[code])
+	stat_slots = fitted & ((slots == SLOT_TYPES.index('hi_slot')) |
+		(slots == SLOT_TYPES.index('low_slot')))
+
+	output = {}
+	output['cpu_used'] = (columns['cpu'] * fitted).sum(axis=1)
+	output['pg_used'] = (columns['pg'] * fitted).sum(axis=1)
+	output['cpu_max'] = base['cpu'] * (1 + columns['cpu_bonus'] * fitted).prod(axis=1)
+	output['pg_max'] = base['pg'] + (columns['pg_bonus'] * fitted).sum(axis=1)
+
+	for stat in ADDITIVE_STATS + MULTIPLICATIVE_STATS + STACKING_STATS:
+		output[stat] = apply_columns(DROPSUIT_PLAN, stat, base[stat], columns, stat_slots)
+
+	output['primary_dps'] = _primary_dps(columns, slots, enhances, fitted)
+
+	return np.column_stack([output[stat] for stat in BATCH_STATS])
+
+
+def apply_columns(plan, stat, base, columns, mask):
+	""" Returns base with the modifiers of stat in the masked slots applied
+	the way the rule plan combines them. """
+	if plan.combine[stat] == ADD:
+		return base + (columns[stat] * mask).sum(axis=1)
+	if plan.combine[stat] == MULTIPLY:
+		return base * (1 + columns[stat] * mask).prod(axis=1)
+	group = plan.get_group(stat)
+	if len(group) == 1:
+		return base * stacking_factor(columns[stat] * mask)
+	# The whole group takes its penalties together, stat only gets its own.
+	modifiers = np.concatenate([columns[s] * mask for s in group], axis=1)
+	owned = np.concatenate([np.ones(mask.shape, dtype=bool) * (s == stat)
+		for s in group], axis=1)
+	return base * stacking_factor(modifiers, owned)
+
+
+def stacking_factor(modifiers, owned=None):
+	""" Returns the penalized product of each rows modifiers, applying them
+	strongest first like Fitting does. Zero modifiers sort last and count as
+	nothing. If owned is given only those modifiers are multiplied in, the
+	others still take up their place in the penalties. """
+	width = modifiers.shape[1]
+	order = np.argsort(-np.abs(modifiers), axis=1, kind='mergesort')
+	strongest = np.take_along_axis(modifiers, order, axis=1)
+	if owned is not None:
+		strongest = strongest * np.take_along_axis(owned, order, axis=1)
+	penalty = np.zeros(width)
+	count = min(width, len(STACKING_PENALTY))
+	penalty[:count] = STACKING_PENALTY[:count]
+	return (1 + strongest * penalty).prod(axis=1)
+
+
+def _primary_dps(columns, slots, enhances, fitted):
+	""" DPS of the first heavy weapon, or the first light weapon if there is no
+	heavy, including the damage modifiers fitted for it. """
+	rows = np.arange(len(slots))
+	heavy = fitted & (slots == SLOT_TYPES.index('heavy_weapon'))
+	light = fitted & (slots == SLOT_TYPES.index('light_weapon'))
+	has_heavy = heavy.any(axis=1)
+	has_primary = has_heavy | light.any(axis=1)
+	if not has_primary.any():
+		return np.zeros(len(slots))
+	column = np.where(has_heavy, heavy.argmax(axis=1), light.argmax(axis=1))
+
+	weapon_slot = slots[rows, column]
+	modifiers = fitted & (slots == SLOT_TYPES.index('hi_slot')) & \
+		(enhances == weapon_slot[:, np.newaxis])
+	weapon = {}
+	for stat in ('damage', 'rate_of_fire'):
+		weapon[stat] = columns[stat][rows, column]
+		if stat in WEAPON_PLAN.combine:
+			weapon[stat] = apply_columns(WEAPON_PLAN, stat, weapon[stat], columns, modifiers)
+
+	return np.where(has_primary, weapon['damage'] * weapon['rate_of_fire'] / 60, 0.0)
+
+
+if __name__ == '__main__':
+	from char import Character
+
+	evaluator = BatchEvaluator('Assault Type-I', Character('No Skills'))
+	ids = evaluator.get_ids([
+		['Complex Shield Extender', 'Basic CPU Upgrade', 'Assault Rifle'],
+		['Complex Light Damage Modifier', 'Assault Rifle', 'Complex Armor Plates']])
+	for row in evaluator.evaluate(ids):
+		print dict(zip(BATCH_STATS, row))
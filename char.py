@@ -17,8 +17,7 @@
 
 import sys, os
 import pickle
-import xml.etree.ElementTree as ET
-from util import DataRetrieval
+from util import DataRetrieval, XmlRetrieval, get_file_loc
 
 class Character:
     def __init__(self, name):
@@ -63,21 +62,34 @@ class Character:
     def get_children_skills(self, parent):
         return self.skills.get_children(parent)
 
+    def to_record(self):
+        """ Returns what is saved of a character. Skill effects are rebuilt
+        from skills.xml when it is loaded. """
+        return {'name': self.name, 'skill_level': dict(self.skill_level)}
+
+
+def character_from_record(record):
+    """ Rebuilds a Character from Character.to_record. """
+    character = Character(record['name'])
+    for skill, level in record['skill_level'].items():
+        if skill in character.skills.skill_effect:
+            character.set_skill(skill, level)
+    return character
 
-class CharacterLibrary:
-    def __init__(self):
-        self.character_data = DataRetrieval('characters.dat')
 
-        self.character_list = self.character_data.data
+class CharacterLibrary:
+    def __init__(self, writer=None):
+        self.character_data = DataRetrieval('characters.dat',
+            self._encode, self._decode, writer=writer)
         #self._load_characters('characters.dat')
 
     def get_character(self, char_name):
         """ Returns a the specified character instance. """
-        return self.character_list[char_name]
+        return self.character_data.get_data(char_name)
 
     def get_character_list(self):
         """ Returns a list of the names of all characters as a tuple. """
-        return tuple(self.character_list.keys())
+        return self.character_data.get_names()
 
     def save_character(self, character):
         """ """
@@ -86,16 +98,20 @@ class CharacterLibrary:
     def delete_character(self, character):
         self.character_data.delete_data(character)
 
+    def _encode(self, character):
+        return pickle.dumps(character.to_record(), pickle.HIGHEST_PROTOCOL)
+
+    def _decode(self, payload):
+        return character_from_record(pickle.loads(payload))
+
 
 class Skills:
     def __init__(self):
         # Dict of skills and their effects on stats {Skill_Name: Effect}
         self.skill_effect = {}
-        self.file_name = self._get_file_loc('skills.xml')
-        
-        # THIS STILL USES THE OLDER VERSION TO RETRIEVE XML.... ITS TOO
-        # DIFFERENT TO USE THE OTHER SHIT. FUCK. IL FIX IT LATER
-        self._get_xml(self.file_name)
+        self.file_name = get_file_loc('skills.xml')
+
+        self._get_effects()
 
     def show_skills(self):
         print self.skill_effect
@@ -106,44 +122,19 @@ class Skills:
 
     def get_parents(self):
         """ Returns a list of all parents in the xml file. """
-        parent_list = []
-
-        xml_tree = ET.parse(self.file_name)
-        parents = xml_tree.findall('.//*[@name]/..')
-        for parent in parents:
-            parent_list.append(parent.tag)
-
-        return parent_list
+        return XmlRetrieval('skills.xml').get_parents()
 
     def get_children(self, target):
         """ Returns all the children of a given parent. """
-        children_list = []
-
-        xml_tree = ET.parse(self.file_name)
-        parent = xml_tree.findall('.//%s/' % target)
-        for child in parent:
-            children_list.append(child.attrib['name'])
-
-        return children_list
-
-    def _get_file_loc(self, file_name):
-        """ Will return the path to the desired file depending on whether this
-        is an executable or in development. """
-        if getattr(sys, 'frozen', None):
-            basedir = sys._MEIPASS + '/data/'
-        else:
-            basedir = os.path.dirname('data/')
-        return os.path.join(basedir, file_name)
-
-    def _get_xml(self, src):
-        """ Extracts skill information from an xml file. """
-        xml_tree = ET.parse(src)
-        xml_root = xml_tree.getroot()
-
-        for skill in xml_root.findall('.//skill'):
-            name = skill.get('name')
-            effect = round(float(skill.find('effect').text), 3)
-            self.skill_effect[name] = effect
+        skill_data = XmlRetrieval('skills.xml')
+        return [child[0] for child in skill_data.get_children(target)]
+
+    def _get_effects(self):
+        """ Collects every skills effect from the shared skills catalog. """
+        skill_data = XmlRetrieval('skills.xml')
+        for name in skill_data.get_list():
+            properties, effecting_skills = skill_data.get_target(name)
+            self.skill_effect[name] = properties['effect']
 
 
 if __name__ == '__main__':
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# combat.py - Simulates fittings shooting at each other.
+# Copyright (C) 2013 Mark Wingerd <markwingerd@yahoo.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+# Weapon stats an attacker fires with. rate_of_fire is in rounds per minute,
+# reload_time in seconds. max_ammo is carried on top of the loaded clip. A
+# weapon without a clip_size never reloads, one without max_ammo never runs
+# out and one without reload_time reloads at once.
+ATTACKER_STATS = ('damage', 'rate_of_fire', 'clip_size', 'reload_time', 'max_ammo')
+
+# Dropsuit stats a defender takes the fire with. Recharge and repair are in HP
+# per second, the delays in seconds.
+DEFENDER_STATS = ('shield_hp', 'armor_hp', 'shield_recharge',
+	'shield_recharge_delay', 'shield_depleted_recharge_delay', 'armor_repair_rate')
+
+# Columns of the array returned by simulate. ttk is the time from the first
+# shot to the killing one and shots the number fired, both inf when the
+# attacker runs out of ammo or MAX_SHOTS first. sustained_dps is the attackers
+# damage per second over whole clips and reloads, effective_dps the defenders
+# shield and armor over ttk, or over one shot interval if the first shot kills.
+COMBAT_STATS = ('ttk', 'shots', 'sustained_dps', 'effective_dps')
+
+# No engagement is stepped past this many shots.
+MAX_SHOTS = 10000
+
+
+def get_attacker(fit):
+	""" Returns {stat: value} of ATTACKER_STATS for the primary weapon of a
+	fitting, with its damage modifiers applied. A fitting without one has a
+	rate_of_fire of 0, and never kills. """
+	weapon = fit.get_primary_weapon()
+	if weapon is None:
+		return {'damage': 0.0, 'rate_of_fire': 0.0}
+	return dict((stat, weapon.stats[stat]) for stat in ATTACKER_STATS
+		if stat in weapon.stats)
+
+
+def get_defender(fit):
+	""" Returns {stat: value} of DEFENDER_STATS for a fitting, with its
+	modules applied. """
+	return dict((stat, fit.get_stat(stat)) for stat in DEFENDER_STATS)
+
+
+def get_columns(rows, stats):
+	""" Turns a list of get_attacker or get_defender results into
+	{stat: array}. Missing stats are nan. """
+	return dict((stat, np.array([row.get(stat, np.nan) for row in rows], dtype=float))
+		for stat in stats)
+
+
+def simulate(attackers, defenders):
+	""" Fights N attackers against N defenders, one pair to a row, and returns
+	an N x len(COMBAT_STATS) array. Both are {stat: array} as from get_columns,
+	a single value or a length 1 array is used for every pair.
+
+	Every pair fires shot k at the same step, at k shot intervals plus a
+	reload for every clip emptied before it. Between shots the defenders armor
+	is repaired and its shield recharges once the delay since the last hit,
+	the depleted delay if the shield was down, has passed. A shot takes the
+	shield first and the rest from the armor. Pairs leave the step loop once
+	the armor is gone or the ammo is. """
+	attackers = dict((s, np.asarray(attackers[s], dtype=float)) for s in ATTACKER_STATS)
+	defenders = dict((s, np.asarray(defenders[s], dtype=float)) for s in DEFENDER_STATS)
+	count = np.broadcast(*(attackers.values() + defenders.values())).size
+
+	def column(columns, stat, missing):
+		return np.where(np.isnan(columns[stat]), missing,
+			columns[stat]) * np.ones(count)
+
+	damage = column(attackers, 'damage', 0.0)
+	rate_of_fire = column(attackers, 'rate_of_fire', 0.0)
+	clip_size = column(attackers, 'clip_size', np.inf)
+	reload_time = column(attackers, 'reload_time', 0.0)
+	ammo = clip_size + column(attackers, 'max_ammo', np.inf)
+	shield_hp = column(defenders, 'shield_hp', 0.0)
+	armor_hp = column(defenders, 'armor_hp', 0.0)
+	recharge = column(defenders, 'shield_recharge', 0.0)
+	delay = column(defenders, 'shield_recharge_delay', 0.0)
+	depleted_delay = column(defenders, 'shield_depleted_recharge_delay', 0.0)
+	repair = column(defenders, 'armor_repair_rate', 0.0)
+
+	firing = (rate_of_fire > 0) & (damage > 0)
+	interval = 60 / np.where(firing, rate_of_fire, 1)
+	# A weapon without a clip fires as one with a one round clip and no reload.
+	reloading = np.isfinite(clip_size)
+	clip = np.where(reloading, clip_size, 1)
+	cycle = clip * interval + np.where(reloading, reload_time, 0)
+	output = np.empty((count, len(COMBAT_STATS)))
+	output[:, COMBAT_STATS.index('sustained_dps')] = np.where(firing,
+		damage * clip / cycle, 0.0)
+	ttk = np.empty(count)
+	ttk.fill(np.inf)
+	shots = np.empty(count)
+	shots.fill(np.inf)
+
+	# Only the pairs still fighting are stepped, rows maps them back.
+	rows = np.flatnonzero(firing & (ammo >= 1))
+	shield = shield_hp[rows]
+	armor = armor_hp[rows]
+	last_time = np.zeros(len(rows))
+	for k in range(MAX_SHOTS):
+		if not len(rows):
+			break
+		reloads = np.floor(k / clip[rows]) * reloading[rows]
+		time = k * interval[rows] + reloads * reload_time[rows]
+		gap = time - last_time
+
+		# Recharge and repair since the last shot.
+		wait = np.where(shield > 0, delay[rows], depleted_delay[rows])
+		shield = np.minimum(shield_hp[rows],
+			shield + recharge[rows] * np.maximum(gap - wait, 0))
+		armor = np.minimum(armor_hp[rows], armor + repair[rows] * gap)
+
+		# The shot.
+		hit = damage[rows]
+		armor = armor - np.maximum(hit - shield, 0)
+		shield = np.maximum(shield - hit, 0)
+
+		dead = armor <= 0
+		ttk[rows[dead]] = time[dead]
+		shots[rows[dead]] = k + 1
+		keep = ~dead & (ammo[rows] > k + 1)
+		rows = rows[keep]
+		shield = shield[keep]
+		armor = armor[keep]
+		last_time = time[keep]
+
+	output[:, COMBAT_STATS.index('ttk')] = ttk
+	output[:, COMBAT_STATS.index('shots')] = shots
+	with np.errstate(divide='ignore'):
+		output[:, COMBAT_STATS.index('effective_dps')] = np.where(np.isfinite(ttk),
+			(shield_hp + armor_hp) / np.maximum(ttk, interval), 0.0)
+	return output
+
+
+def simulate_all(attack_fits, defend_fits):
+	""" Fights every attacking fitting against every defending one and returns
+	a len(attack_fits) x len(defend_fits) x len(COMBAT_STATS) array. """
+	return simulate_grid(
+		get_columns([get_attacker(f) for f in attack_fits], ATTACKER_STATS),
+		get_columns([get_defender(f) for f in defend_fits], DEFENDER_STATS))
+
+
+def simulate_grid(attackers, defenders):
+	""" Fights A attackers against every one of D defenders and returns an
+	A x D x len(COMBAT_STATS) array. Both are {stat: array} as from
+	get_columns. """
+	rows = len(attackers[ATTACKER_STATS[0]])
+	columns = len(defenders[DEFENDER_STATS[0]])
+	attackers = dict((s, np.repeat(attackers[s], columns)) for s in ATTACKER_STATS)
+	defenders = dict((s, np.tile(defenders[s], rows)) for s in DEFENDER_STATS)
+	return simulate(attackers, defenders).reshape(rows, columns, len(COMBAT_STATS))
+
+
+if __name__ == '__main__':
+	import time
+	from char import Character
+	from fitting import Fitting
+
+	character = Character('No Skills')
+	attackers = []
+	for weapon in ('Assault Rifle', 'Sniper Rifle', 'Shotgun', 'Heavy Machine Gun', 'Forge Gun'):
+		for ds_name in ('Assault Type-I', 'Heavy Type-I'):
+			fit = Fitting(weapon, character, ds_name)
+			fit.add_weapon(weapon)
+			if fit.get_primary_weapon() is not None:
+				attackers.append(fit)
+				break
+	defenders = []
+	for modules in ([], ['Complex Shield Extender'] * 2, ['Complex Armor Plates'] * 2):
+		fit = Fitting(', '.join(modules) or 'Bare', character, 'Assault Type-I')
+		for m in modules:
+			fit.add_module(m)
+		defenders.append(fit)
+
+	results = simulate_all(attackers, defenders)
+	for i, attacker in enumerate(attackers):
+		for j, defender in enumerate(defenders):
+			print '{:<20} {:<56} {}'.format(attacker.name, defender.name,
+				', '.join(['%s %.2f' % pair for pair in zip(COMBAT_STATS, results[i, j])]))
+
+	count = 100000
+	a = get_columns([get_attacker(f) for f in attackers], ATTACKER_STATS)
+	d = get_columns([get_defender(f) for f in defenders], DEFENDER_STATS)
+	pick = np.random.RandomState(0)
+	i, j = pick.randint(len(attackers), size=count), pick.randint(len(defenders), size=count)
+	start = time.time()
+	simulate(dict((s, v[i]) for s, v in a.items()), dict((s, v[j]) for s, v in d.items()))
+	print '%s pairs in %.3f seconds' % (count, time.time() - start)
@@ -16,11 +16,49 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import sys, os
+import copy
+import pickle
 import xml.etree.ElementTree as ET
+from collections import namedtuple
 
 from char import Character, CharacterLibrary
 from module import Module, Weapon
-from util import XmlRetrieval, DataRetrieval
+from rules import DROPSUIT_PLAN
+from util import XmlRetrieval, DataRetrieval, StatRecord, make_stat_record
+
+# Only modules in these slots change the dropsuits stats.
+STAT_SLOTS = ('hi_slot', 'low_slot')
+
+# Slots in the order they are refitted. Weapons must follow the modules.
+MODULE_SLOTS = ('hi_slot', 'low_slot', 'equipment')
+WEAPON_SLOTS = ('heavy_weapon', 'light_weapon', 'sidearm', 'grenade')
+
+# Slots in the order get_all_modules lists them, and the icon of their rows.
+DISPLAY_SLOTS = WEAPON_SLOTS + ('equipment', 'hi_slot', 'low_slot')
+SLOT_ICONS = {'heavy_weapon': 'H', 'light_weapon': 'L', 'sidearm': 'S',
+	'grenade': 'G', 'equipment': 'E', 'hi_slot': '--', 'low_slot': '-'}
+
+# Everything Fitting.snapshot works out. Dropsuit stats are rounded to two
+# places, the primary weapons to one and its damage per magazine to two. The
+# weapon stats are None without a heavy or light weapon.
+FittingStats = namedtuple('FittingStats', ('cpu_used', 'cpu_max', 'cpu_over',
+	'pg_used', 'pg_max', 'pg_over', 'primary_weapon', 'damage', 'rate_of_fire',
+	'dps', 'dpm') + DROPSUIT_PLAN.stats)
+
+# Dropsuit stats a Fitting also keeps as attributes of its own.
+DROPSUIT_ATTRIBUTES = ('shield_hp', 'armor_hp', 'armor_repair_rate',
+	'movement_speed', 'sprint_speed', 'shield_recharge', 'shield_recharge_delay',
+	'shield_depleted_recharge_delay', 'scan_profile')
+
+# The attributes of a Fitting which make up one version of it. An edit never
+# changes the objects these hold, it replaces the ones it changes, so a
+# version is only these references and shares everything else with the next.
+# The character is the exception, it is edited in place, so a version also
+# keeps the skill effects its items were worked out with.
+STATE_ATTRIBUTES = ('char', '_skills', 'dropsuit') + MODULE_SLOTS + WEAPON_SLOTS + (
+	'item_positions', 'enhancers', 'current_cpu', 'current_pg', 'max_cpu',
+	'max_pg', 'stat_modifiers', 'stat_totals', '_snapshot') + DROPSUIT_ATTRIBUTES
+FittingState = namedtuple('FittingState', [a.lstrip('_') for a in STATE_ATTRIBUTES])
 
 class Fitting:
 	def __init__(self, name, character, ds_name):
@@ -29,50 +67,82 @@ class Fitting:
 		self.ds_name = ds_name
 		#self.dropsuit = Dropsuit(self.char.skill_effect, ds_type, ds_name)
 		self.dropsuit = Dropsuit(self.char, ds_name)
-
-		self.heavy_weapon = []
-		self.light_weapon = []
-		self.sidearm = []
-		self.grenade = []
-		self.equipment = []
-		self.hi_slot = []
-		self.low_slot = []
-		self.current_cpu = 0
-		self.current_pg = 0
-		self.max_cpu = self.dropsuit.stats['cpu']
-		self.max_pg = self.dropsuit.stats['pg']
-		self.shield_hp = self.dropsuit.stats['shield_hp']
-		self.armor_hp = self.dropsuit.stats['armor_hp']
-		self.armor_repair_rate = self.dropsuit.stats['armor_repair_rate']
-		self.movement_speed = self.dropsuit.stats['movement_speed']
-		self.sprint_speed = self.dropsuit.stats['sprint_speed']
-		self.shield_recharge = self.dropsuit.stats['shield_recharge']
-		self.shield_recharge_delay = self.dropsuit.stats['shield_recharge_delay']
-		self.shield_depleted_recharge_delay = self.dropsuit.stats['shield_depleted_recharge_delay']
-		self.scan_profile = self.dropsuit.stats['scan_profile']
+		self._skills = _get_skills(self.char) # Skill effects the items have.
+
+		self.heavy_weapon = ()
+		self.light_weapon = ()
+		self.sidearm = ()
+		self.grenade = ()
+		self.equipment = ()
+		self.hi_slot = ()
+		self.low_slot = ()
+		# Where each item is fitted, so removing one by name needs no search.
+		self.item_positions = {} # {name: ((slot type, position), ...)}
+		# Which weapons a module change can effect. Only the weapons in a slot
+		# type that a hi slot module enhances ever need their bonus redone.
+		self.enhancers = {} # {weapon slot type: (hi slot module, ...)}
+		# FittingStates to go back to, latest last, see undo and redo.
+		self.undo_states = []
+		self.redo_states = []
+		# Called with (fitting, slot types, snapshot fields) after every change,
+		# see subscribe.
+		self.listeners = []
+		self._published = None # The snapshot listeners were last told of.
+		# Names of saved items fitting_from_record found no longer exist.
+		self.dropped_items = ()
+		self._reset_totals()
+
+	def __getstate__(self):
+		""" Listeners belong to whoever is showing the fitting, a copy has
+		none. """
+		state = self.__dict__.copy()
+		for key in ('listeners', '_published', '_snapshot', 'undo_states', 'redo_states'):
+			state.pop(key, None)
+		return state
+
+	def __setstate__(self, state):
+		""" The running totals are rebuilt from the fitted modules, since the
+		rules they were totaled by may have changed since it was pickled. """
+		self.__dict__.update(state)
+		if '_skills' not in state:
+			self._skills = _get_skills(self.char)
+		if 'dropped_items' not in state:
+			self.dropped_items = ()
+		self._snapshot = None
+		self.listeners = []
+		self._published = None
+		self.undo_states = []
+		self.redo_states = []
+		for slot_type in DISPLAY_SLOTS:
+			setattr(self, slot_type, tuple(getattr(self, slot_type)))
+		self.stat_modifiers = {}
+		self.stat_totals = {}
+		for m in self.hi_slot + self.low_slot:
+			self._add_modifiers(m)
+		self.item_positions = {}
+		for slot_type in DISPLAY_SLOTS:
+			self._index_slot(slot_type)
+		self._index_enhancers()
 
 	def change_character(self, char):
-		""" This method will reroll the whole fitting instance with the new 
-		character. It will need to collect all of the fitted modules before the
-		reroll.  After the roll it will readd all the modules. This is currently
-		the easiest way to change characters. """
-		# Get a list of all modules and all weapons
-		mod_list = []
-		wea_list = []
-		for m in self.hi_slot + self.low_slot + self.equipment:
-			mod_list.append(m.name)
-		for w in self.heavy_weapon + self.light_weapon + self.sidearm + self.grenade:
-			wea_list.append(w.name)
-
-		# Change base fitting stats by recalling the init function.
-		self.char = char
-		self.__init__(self.name, char, self.ds_name)
-
-		# Readd the modules and weapons.
-		for m in mod_list:
-			self.add_module(m)
-		for w in wea_list:
-			self.add_weapon(w)
+		""" Rebases the fitting onto a new character. Every item keeps its xml
+		base stats so only the skills are applied again, nothing is looked up
+		or refitted. The items are rebased as copies, the old ones stay as
+		they were for undo. """
+		state = self._get_state()
+		self._rebase_items(char)
+		self._record(state)
+		self._notify(DISPLAY_SLOTS)
+
+	def to_record(self):
+		""" Returns what is saved of a fitting: the dropsuit, the name of its
+		character and the names of the fitted items. Stats are rebuilt from the
+		xml when it is loaded. """
+		slots = {}
+		for slot_type in MODULE_SLOTS + WEAPON_SLOTS:
+			slots[slot_type] = [m.name for m in getattr(self, slot_type)]
+		return {'name': self.name, 'ds_name': self.ds_name,
+			'character': self.char.name, 'slots': slots}
 
 	def show_stats(self):
 		""" Displays fitting status with all calculations, modules, and skills
@@ -93,9 +163,10 @@ class Fitting:
 			return output
 
 		# Display dropsuit stats.
+		stats = self.snapshot()
 		print 'Character Name:                    %s' % self.char.name
-		print 'CPU:                            %s/%s' % (self.current_cpu, self.max_cpu)
-		print 'PG:                             %s/%s' % (self.current_pg, self.max_pg)
+		print 'CPU:                            %s/%s' % (stats.cpu_used, stats.cpu_max)
+		print 'PG:                             %s/%s' % (stats.pg_used, stats.pg_max)
 		print 'Heavy Weapon:                      %s' % get_mod_names(self.heavy_weapon)
 		print 'Light Weapon:                      %s' % get_mod_names(self.light_weapon)
 		print 'Sidearm:                           %s' % get_mod_names(self.sidearm)
@@ -103,16 +174,16 @@ class Fitting:
 		print 'Equipment:                         %s' % get_mod_names(self.equipment)
 		print 'Hi Slot:                           %s' % get_mod_names(self.hi_slot)
 		print 'Low Slot:                          %s' % get_mod_names(self.low_slot)
-		print 'Shield HP:                         %s' % self.get_shield_hp()
-		print 'Shield Recharge:                   %s' % self.get_shield_recharge()
-		print 'Shield Recharge Delay:             %s' % self.get_shield_recharge_delay()
-		print 'Shield Depleted Recharge Delay:    %s' % self.get_shield_depleted_recharge_delay()
-		print 'Armor HP:                          %s' % self.get_armor_hp()
-		print 'Armor Repair Rate:                 %s' % self.get_armor_repair_rate()
-		print 'Movement Speed:                    %s' % self._get_multiplicative_stat('movement_speed')
-		print 'Sprint Speed:                      %s' % self._get_multiplicative_stacking_stat('sprint_speed')
-		print 'Scan Profile:                      %s' % self._get_multiplicative_stacking_stat('scan_profile')
-		print 'Stamina:                           %s' % self._get_multiplicative_stacking_stat('stamina')
+		print 'Shield HP:                         %s' % stats.shield_hp
+		print 'Shield Recharge:                   %s' % stats.shield_recharge
+		print 'Shield Recharge Delay:             %s' % stats.shield_recharge_delay
+		print 'Shield Depleted Recharge Delay:    %s' % stats.shield_depleted_recharge_delay
+		print 'Armor HP:                          %s' % stats.armor_hp
+		print 'Armor Repair Rate:                 %s' % stats.armor_repair_rate
+		print 'Movement Speed:                    %s' % stats.movement_speed
+		print 'Sprint Speed:                      %s' % stats.sprint_speed
+		print 'Scan Profile:                      %s' % stats.scan_profile
+		print 'Stamina:                           %s' % stats.stamina
 
 	def show_module_stats(self):
 		""" Displays module stats with and without calculations. """
@@ -169,186 +240,336 @@ class Fitting:
 		max_slots = self.dropsuit.stats[slot_type]
 		if used_slots < max_slots:
 			if True: #cpu/pg reqs go here.
+				state = self._get_state()
 				self._update_cpu(module)
 				self._update_pg(module)
-				getattr(self, module.stats['slot_type']).append(module)
-				self._update_module_bonus() # Must be called after the module has been added to the list
+				self._fit_item(module)
+				self._add_modifiers(module)
+				self._changed()
+				enhanced = self._get_enhanced(module)
+				if enhanced:
+					self.enhancers = dict(self.enhancers)
+					self.enhancers[enhanced] = self.enhancers.get(enhanced, ()) + (module,)
+					self._update_module_bonus(enhanced)
+				self._record(state)
+				self._notify((slot_type, enhanced) if enhanced else (slot_type,))
 
 	def remove_module(self, mod_name):
-		""" Finds a module that needs to be deleted and removes it if it has 
-		been fitted. """
-		for m in self.heavy_weapon:
-			if m.name in mod_name:
-				self.heavy_weapon.remove(m)
-				self._free_cpu(m)
-				self._free_pg(m)
-				self._update_module_bonus()
-				break
-		for m in self.light_weapon:
-			if m.name in mod_name:
-				self.light_weapon.remove(m)
-				self._free_cpu(m)
-				self._free_pg(m)
-				self._update_module_bonus()
-				break
-		for m in self.sidearm:
-			if m.name in mod_name:
-				self.sidearm.remove(m)
-				self._free_cpu(m)
-				self._free_pg(m)
-				self._update_module_bonus()
-				break
-		for m in self.grenade:
-			if m.name in mod_name:
-				self.grenade.remove(m)
-				self._free_cpu(m)
-				self._free_pg(m)
-				self._update_module_bonus()
-				break
-		for m in self.equipment:
-			if m.name in mod_name:
-				self.equipment.remove(m)
-				self._free_cpu(m)
-				self._free_pg(m)
-				self._update_module_bonus()
-				break
-		for m in self.hi_slot:
-			if m.name in mod_name:
-				self.hi_slot.remove(m)
-				self._free_cpu(m)
-				self._free_pg(m)
-				self._update_module_bonus()
-				break
-		for m in self.low_slot:
-			if m.name in mod_name:
-				self.low_slot.remove(m)
-				self._free_cpu(m)
-				self._free_pg(m)
-				self._update_module_bonus()
-				break
+		""" Removes the first fitted module or weapon named exactly mod_name.
+		Returns the removed item, or None if none is fitted. """
+		positions = self.item_positions.get(mod_name)
+		if not positions:
+			return None
+		return self.remove_slot(*min(positions))
+
+	def remove_slot(self, slot_type, position):
+		""" Removes the item fitted at position of slot_type, see
+		get_slot_positions. Returns the removed item, or None if the slot is
+		empty. """
+		items = getattr(self, slot_type)
+		if not 0 <= position < len(items):
+			return None
+		state = self._get_state()
+		item = items[position]
+		setattr(self, slot_type, items[:position] + items[position + 1:])
+		self._unfit_position(slot_type, position, items)
+		self._changed()
+		self._free_cpu(item)
+		self._free_pg(item)
+		if slot_type in STAT_SLOTS:
+			self._remove_modifiers(item)
+		enhanced = self._get_enhanced(item)
+		if enhanced:
+			self.enhancers = dict(self.enhancers)
+			self.enhancers[enhanced] = tuple([m for m in self.enhancers[enhanced]
+				if m is not item])
+			self._update_module_bonus(enhanced)
+			if not self.enhancers[enhanced]:
+				del self.enhancers[enhanced]
+		self._record(state)
+		self._notify((slot_type, enhanced) if enhanced else (slot_type,))
+		return item
 
 	def add_weapon(self, weapon_name):
-		""" Adds a weapon. THIS MUST bE CALLED AFTER MODULES HAVE BEEN ADDED. """
-		weapon = Weapon(self.char.skill_effect, weapon_name, self.hi_slot)
+		""" Adds a weapon with the bonuses of any modules already fitted for
+		it. Modules fitted later add theirs, so the order does not matter. """
+		weapon = Weapon(self.char.skill_effect, weapon_name)
 		slot_type = weapon.stats['slot_type']
+		if self.enhancers.get(slot_type):
+			weapon.rebase(self.char.skill_effect, list(self.enhancers[slot_type]))
 		used_slots = len(getattr(self, slot_type))
 		max_slots = self.dropsuit.stats[slot_type]
 		if used_slots < max_slots:
 			if True: #cpu/pg reqs go here.
+				state = self._get_state()
 				self._update_cpu(weapon)
 				self._update_pg(weapon)
-				getattr(self, weapon.stats['slot_type']).append(weapon)
+				self._fit_item(weapon)
+				self._changed()
+				self._record(state)
+				self._notify((slot_type,))
+
+	def undo(self):
+		""" Puts the fitting back the way it was before the last change.
+		Nothing is worked out again, the earlier version is put back as it
+		was. Returns False if there is nothing to undo. """
+		if not self.undo_states:
+			return False
+		self.redo_states.append(self._get_state())
+		self._set_state(self.undo_states.pop())
+		return True
+
+	def redo(self):
+		""" Makes the last undone change again. Returns False if there is
+		nothing to redo. """
+		if not self.redo_states:
+			return False
+		self.undo_states.append(self._get_state())
+		self._set_state(self.redo_states.pop())
+		return True
+
+	def clear_history(self):
+		""" Forgets every change, so there is nothing to undo or redo. """
+		self.undo_states = []
+		self.redo_states = []
+
+	def subscribe(self, listener):
+		""" Calls listener(fitting, slot types, fields) after every change to
+		the fitting, with the slot types whose items changed and the fields of
+		snapshot whose values changed since the listeners were last called. """
+		self.listeners.append(listener)
+		self._published = self.snapshot()
+
+	def unsubscribe(self, listener):
+		if listener in self.listeners:
+			self.listeners.remove(listener)
+
+	def snapshot(self):
+		""" Returns every stat the fitting shows as a FittingStats. It is worked
+		out in one pass and kept until the fitting next changes. """
+		if self._snapshot is None:
+			self._snapshot = self._get_snapshot()
+		return self._snapshot
 
 	def get_cpu_over(self):
 		""" If the dropsuit is using more CPU then it has available, return the
 		percentage that it's over as a string. Otherwise return ''. """
-		if self.current_cpu > self.max_cpu:
-			perc =( (self.current_cpu-self.max_cpu) / self.max_cpu) * 100
-			return '%s%% over' % round(perc, 1)
-		else:
-			return None
+		return self.snapshot().cpu_over
 
 	def get_pg_over(self):
 		""" If the dropsuit is using more PG then it has available, return the
 		percentage that it's over as a string. Otherwise return ''. """
-		if self.current_pg > self.max_pg:
-			perc =( (self.current_pg-self.max_pg) / self.max_pg) * 100
-			return '%s%% over' % round(perc, 1)
-		else:
-			return None
+		return self.snapshot().pg_over
 
-	def get_primary_weapon_name(self):
-		""" Returns the module name of the Heavy or Light weapon. """
+	def get_primary_weapon(self):
+		""" Returns the first heavy weapon, or the first light weapon if there
+		is no heavy. None if there is neither. """
 		if self.heavy_weapon:
-			return self.heavy_weapon[0].name
+			return self.heavy_weapon[0]
 		elif self.light_weapon:
-			return self.light_weapon[0].name
+			return self.light_weapon[0]
 		return None
 
+	def get_primary_weapon_name(self):
+		""" Returns the module name of the Heavy or Light weapon. """
+		return self.snapshot().primary_weapon
+
 	def get_primary_stats(self, stat):
-		if self.heavy_weapon:
-			return round(self.heavy_weapon[0].stats[stat], 1)
-		elif self.light_weapon:
-			return round(self.light_weapon[0].stats[stat], 1)
-		return None
+		weapon = self.get_primary_weapon()
+		if weapon is None:
+			return None
+		return round(weapon.stats[stat], 1)
 
 	def get_primary_dps(self):
-		if self.heavy_weapon:
-			return round(self.heavy_weapon[0].stats['damage'] * (self.heavy_weapon[0].stats['rate_of_fire']/60), 1)
-		elif self.light_weapon:
-			return round(self.light_weapon[0].stats['damage'] * (self.light_weapon[0].stats['rate_of_fire']/60), 1)
-		return None
+		return self.snapshot().dps
 
 	def get_primary_dpm(self):
-		if self.heavy_weapon:
-			return round(self.heavy_weapon[0].stats['damage'] * self.heavy_weapon[0].stats['clip_size'], 2)
-		elif self.light_weapon:
-			return round(self.light_weapon[0].stats['damage'] * self.light_weapon[0].stats['clip_size'], 2)
-		return None
+		return self.snapshot().dpm
 
 	def get_shield_hp(self):
-		return round(self._get_additive_stat('shield_hp'), 2)
+		return self.snapshot().shield_hp
 
 	def get_shield_recharge(self):
-		return round(self._get_multiplicative_stacking_stat('shield_recharge'), 2)
+		return self.snapshot().shield_recharge
 
 	def get_shield_recharge_delay(self):
-		return round(self._get_multiplicative_stacking_stat('shield_recharge_delay'), 2)
+		return self.snapshot().shield_recharge_delay
 
 	def get_shield_depleted_recharge_delay(self):
-		return round(self._get_multiplicative_stacking_stat('shield_depleted_recharge_delay'), 2)
+		return self.snapshot().shield_depleted_recharge_delay
 
 	def get_armor_hp(self):
-		return round(self._get_additive_stat('armor_hp'), 2)
+		return self.snapshot().armor_hp
 
 	def get_armor_repair_rate(self):
-		return round(self._get_additive_stat('armor_repair_rate'), 2)
+		return self.snapshot().armor_repair_rate
 
 	def get_scan_profile(self):
-		return round(self._get_multiplicative_stacking_stat('scan_profile'), 2)
+		return self.snapshot().scan_profile
 
 	def get_scan_precision(self):
-		return round(self._get_multiplicative_stacking_stat('scan_precision'), 2)
+		return self.snapshot().scan_precision
 
 	def get_scan_radius(self):
-		return round(self._get_multiplicative_stacking_stat('scan_radius'), 2)
+		return self.snapshot().scan_radius
+
+	def get_slot_positions(self):
+		""" Returns (slot type, position) of every row of get_all_modules, empty
+		slots included. """
+		output = []
+		for slot_type in DISPLAY_SLOTS:
+			slots = max(len(getattr(self, slot_type)), int(self.dropsuit.stats[slot_type]))
+			output.extend([(slot_type, i) for i in range(slots)])
+		return output
 
 	def get_all_modules(self):
 		""" Returns a tuple of modules and weapons for the GUI. """
+		module_list = []
+		for slot_type in DISPLAY_SLOTS:
+			module_list.extend(self.get_slot_rows(slot_type))
+		return tuple(module_list)
+
+	def get_slot_rows(self, slot_type):
+		""" Returns the rows of get_all_modules for one slot type. """
 		def get_output(icon, name, cpu, pg):
 			return '{:3.3} {:<30.30} {:>5.5} {:>5.5}'.format(icon, name, cpu, pg)
 
-		module_list = []
-		for mod in self.heavy_weapon:
-			module_list.append(get_output('H',mod.name, mod.stats['cpu'], mod.stats['pg']))
-		for i in range( len(self.heavy_weapon), int(self.dropsuit.stats['heavy_weapon']) ):
-			module_list.append(get_output('H','None','0','0'))
-		for mod in self.light_weapon:
-			module_list.append(get_output('L',mod.name, mod.stats['cpu'], mod.stats['pg']))
-		for i in range( len(self.light_weapon), int(self.dropsuit.stats['light_weapon']) ):
-			module_list.append(get_output('L','None','0','0'))
-		for mod in self.sidearm:
-			module_list.append(get_output('S',mod.name, mod.stats['cpu'], mod.stats['pg']))
-		for i in range( len(self.sidearm), int(self.dropsuit.stats['sidearm']) ):
-			module_list.append(get_output('S','None','0','0'))
-		for mod in self.grenade:
-			module_list.append(get_output('G',mod.name, mod.stats['cpu'], mod.stats['pg']))
-		for i in range( len(self.grenade), int(self.dropsuit.stats['grenade']) ):
-			module_list.append(get_output('G','None','0','0'))
-		for mod in self.equipment:
-			module_list.append(get_output('E',mod.name, mod.stats['cpu'], mod.stats['pg']))
-		for i in range( len(self.equipment), int(self.dropsuit.stats['equipment']) ):
-			module_list.append(get_output('E','None','0','0'))
-		for mod in self.hi_slot:
-			module_list.append(get_output('--',mod.name, mod.stats['cpu'], mod.stats['pg']))
-		for i in range( len(self.hi_slot), int(self.dropsuit.stats['hi_slot']) ):
-			module_list.append(get_output('--','None','0','0'))
-		for mod in self.low_slot:
-			module_list.append(get_output('-',mod.name, mod.stats['cpu'], mod.stats['pg']))
-		for i in range( len(self.low_slot), int(self.dropsuit.stats['low_slot']) ):
-			module_list.append(get_output('-','None','0','0'))
-
-		return tuple(module_list)
+		icon = SLOT_ICONS[slot_type]
+		items = getattr(self, slot_type)
+		rows = [get_output(icon, mod.name, mod.stats['cpu'], mod.stats['pg'])
+			for mod in items]
+		for i in range(len(items), int(self.dropsuit.stats[slot_type])):
+			rows.append(get_output(icon, 'None', '0', '0'))
+		return rows
+
+	def _changed(self):
+		""" Called whenever an item is fitted or removed or the stats are
+		recalculated, so the snapshot is worked out again. """
+		self._snapshot = None
+
+	def _notify(self, slot_types):
+		""" Calls the listeners once a change is complete, with only the
+		snapshot fields whose values differ from the last call. """
+		if not self.listeners:
+			return
+		stats = self.snapshot()
+		published = self._published
+		fields = tuple([f for f in FittingStats._fields if published is None or
+			getattr(published, f) != getattr(stats, f)])
+		self._published = stats
+		for listener in list(self.listeners):
+			listener(self, tuple(slot_types), fields)
+
+	def _get_state(self):
+		""" Returns the current version of the fitting as a FittingState. """
+		return FittingState(*[getattr(self, a) for a in STATE_ATTRIBUTES])
+
+	def _set_state(self, state):
+		""" Makes state the current version and tells the listeners. Slots
+		are only shared between versions while unchanged, so a slot holding a
+		different tuple is one that changed. If the character has been edited
+		since the version was made its items are rebased onto the skills the
+		character has now. """
+		if state.dropsuit is self.dropsuit:
+			slot_types = [s for s in DISPLAY_SLOTS
+				if getattr(state, s) is not getattr(self, s)]
+		else:
+			slot_types = DISPLAY_SLOTS
+		for attribute, value in zip(STATE_ATTRIBUTES, state):
+			setattr(self, attribute, value)
+		if self._skills != _get_skills(self.char):
+			self._rebase_items(self.char)
+			slot_types = DISPLAY_SLOTS
+		self._notify(slot_types)
+
+	def _record(self, state):
+		""" Keeps the version from before a change for undo. """
+		self.undo_states.append(state)
+		self.redo_states = []
+
+	def _rebase_items(self, char):
+		""" Applies the skills of char to copies of every item, without
+		recording a version. """
+		self.char = char
+		self._skills = _get_skills(char)
+		self.dropsuit = _rebased(self.dropsuit, char)
+		for slot_type in MODULE_SLOTS:
+			setattr(self, slot_type, tuple([_rebased(m, char.skill_effect)
+				for m in getattr(self, slot_type)]))
+		self._index_enhancers()
+		for slot_type in WEAPON_SLOTS:
+			modules = list(self.enhancers.get(slot_type, ()))
+			setattr(self, slot_type, tuple([_rebased(w, char.skill_effect, modules)
+				for w in getattr(self, slot_type)]))
+		self._reset_totals()
+
+	def _get_snapshot(self):
+		stats = {'cpu_used': self.current_cpu, 'cpu_max': self.max_cpu,
+			'pg_used': self.current_pg, 'pg_max': self.max_pg,
+			'cpu_over': _get_over(self.current_cpu, self.max_cpu),
+			'pg_over': _get_over(self.current_pg, self.max_pg)}
+		for stat in DROPSUIT_PLAN.stats:
+			stats[stat] = round(self.get_stat(stat), 2)
+
+		weapon = self.get_primary_weapon()
+		if weapon is None:
+			stats.update(primary_weapon=None, damage=None, rate_of_fire=None,
+				dps=None, dpm=None)
+		else:
+			damage = weapon.stats['damage']
+			stats['primary_weapon'] = weapon.name
+			stats['damage'] = round(damage, 1)
+			stats['rate_of_fire'] = round(weapon.stats['rate_of_fire'], 1)
+			stats['dps'] = round(damage * (weapon.stats['rate_of_fire']/60), 1)
+			stats['dpm'] = round(damage * weapon.stats['clip_size'], 2)
+		return FittingStats(**stats)
+
+	def _fit_item(self, item):
+		""" Appends an item to its slot and indexes its position. """
+		slot_type = item.stats['slot_type']
+		items = getattr(self, slot_type)
+		self.item_positions = dict(self.item_positions)
+		self.item_positions[item.name] = \
+			self.item_positions.get(item.name, ()) + ((slot_type, len(items)),)
+		setattr(self, slot_type, items + (item,))
+
+	def _unfit_position(self, slot_type, position, items):
+		""" Drops a removed position from item_positions and moves up the
+		items of the slot which were after it. items is the slot as it was
+		before the removal. Only the names of those items are touched. """
+		item_positions = dict(self.item_positions)
+		name = items[position].name
+		positions = tuple([p for p in item_positions[name] if p != (slot_type, position)])
+		if positions:
+			item_positions[name] = positions
+		else:
+			del item_positions[name]
+		for moved in range(position + 1, len(items)):
+			name = items[moved].name
+			item_positions[name] = tuple([(s, p - 1) if (s, p) == (slot_type, moved)
+				else (s, p) for s, p in item_positions[name]])
+		self.item_positions = item_positions
+
+	def _index_slot(self, slot_type):
+		""" Rebuilds the item_positions entries of one slot type after its
+		items have moved. """
+		item_positions = {}
+		for name, positions in self.item_positions.items():
+			positions = tuple([p for p in positions if p[0] != slot_type])
+			if positions:
+				item_positions[name] = positions
+		for position, item in enumerate(getattr(self, slot_type)):
+			item_positions[item.name] = \
+				item_positions.get(item.name, ()) + ((slot_type, position),)
+		self.item_positions = item_positions
+
+	def _index_enhancers(self):
+		""" Rebuilds enhancers from the hi slot modules. """
+		self.enhancers = {}
+		for m in self.hi_slot:
+			enhanced = self._get_enhanced(m)
+			if enhanced:
+				self.enhancers[enhanced] = self.enhancers.get(enhanced, ()) + (m,)
 
 	def _update_cpu(self, module):
 		""" Called by add_module or add_weapon methods.  This will update the
@@ -384,81 +605,162 @@ class Fitting:
 		if 'pg_bonus' in module.stats:
 			self.max_pg -= module.stats['pg_bonus']
 
-	def _update_module_bonus(self):
-		""" This will update weapons with any modules that give a bonus to them.
-		This is intended to be a hotfix. """
-		for w in self.heavy_weapon + self.light_weapon + self.sidearm:
-			w.__init__(self.char.skill_effect, w.name, self.hi_slot)
-
+	def _get_enhanced(self, module):
+		""" Returns the weapon slot type a module gives a bonus to, or None.
+		Only hi slot modules give weapon bonuses. """
+		if module.stats['slot_type'] != 'hi_slot':
+			return None
+		enhances = module.stats.get('enhances')
+		if enhances in WEAPON_SLOTS:
+			return enhances
+		return None
 
-	def _get_additive_stat(self, stat):
+	def _update_module_bonus(self, slot_type):
+		""" Reapplies the bonuses of the modules enhancing slot_type to the
+		weapons fitted there. No other weapon depends on them. The weapons are
+		replaced by rebased copies, earlier versions keep the old ones. """
+		modules = list(self.enhancers.get(slot_type, ()))
+		setattr(self, slot_type, tuple([_rebased(w, self.char.skill_effect, modules)
+			for w in getattr(self, slot_type)]))
+
+	def _reset_totals(self):
+		""" Recalculates the resources and dropsuit stats from the fitted items,
+		adding them in the order a saved fitting is refitted. """
+		self._changed()
+		self.current_cpu = 0
+		self.current_pg = 0
+		self.max_cpu = self.dropsuit.stats['cpu']
+		self.max_pg = self.dropsuit.stats['pg']
+		for stat in DROPSUIT_ATTRIBUTES:
+			setattr(self, stat, self.dropsuit.stats[stat])
+
+		# Running totals of the hi and low slot module stats which rules.RULES
+		# applies to the dropsuit. These are updated as modules are added and
+		# removed so the stat getters never need to walk the slots.
+		self.stat_modifiers = {} # {stat: (modifier, ...)} strongest first.
+		self.stat_totals = {} # {stat: total from DROPSUIT_PLAN.get_total}
+		for slot_type in MODULE_SLOTS + WEAPON_SLOTS:
+			for item in getattr(self, slot_type):
+				self._update_cpu(item)
+				self._update_pg(item)
+
+		# Same as calling _add_modifiers for each module, but every stat is
+		# sorted and totaled once.
+		for m in self.hi_slot + self.low_slot:
+			for stat, value in m.stats.numeric_items():
+				if stat in DROPSUIT_PLAN.combine:
+					self.stat_modifiers.setdefault(stat, []).append(value)
+		for stat, modifiers in self.stat_modifiers.items():
+			modifiers.sort(key=abs, reverse=True)
+			self.stat_modifiers[stat] = tuple(modifiers)
+		for stat in self.stat_modifiers:
+			self.stat_totals[stat] = DROPSUIT_PLAN.get_total(stat, self.stat_modifiers)
+
+	def _add_modifiers(self, module):
+		""" Adds a modules stats to the running totals if it is fitted in a slot
+		which effects the dropsuit. Only the stats it has are recalculated. """
+		if module.stats['slot_type'] not in STAT_SLOTS:
+			return
+		self._copy_totals()
+		for stat, value in module.stats.numeric_items():
+			if stat not in DROPSUIT_PLAN.combine:
+				continue
+			modifiers = self.stat_modifiers.get(stat, ()) + (value,)
+			self.stat_modifiers[stat] = tuple(sorted(modifiers, key=abs, reverse=True))
+			self._update_stat_total(stat)
+
+	def _remove_modifiers(self, module):
+		""" Takes a removed modules stats back out of the running totals. """
+		if module.stats['slot_type'] not in STAT_SLOTS:
+			return
+		self._copy_totals()
+		for stat, value in module.stats.numeric_items():
+			if stat in DROPSUIT_PLAN.combine:
+				modifiers = list(self.stat_modifiers[stat])
+				modifiers.remove(value)
+				self.stat_modifiers[stat] = tuple(modifiers)
+				self._update_stat_total(stat)
+
+	def _copy_totals(self):
+		""" Replaces the running totals with copies to change, earlier
+		versions keep the old ones. """
+		self.stat_modifiers = dict(self.stat_modifiers)
+		self.stat_totals = dict(self.stat_totals)
+
+	def _update_stat_total(self, stat):
+		""" Recalculates the total of one stats modifiers, along with the stats
+		sharing its stacking penalties. """
+		if not self.stat_modifiers[stat]:
+			del self.stat_modifiers[stat]
+		for s in DROPSUIT_PLAN.get_group(stat):
+			if s in self.stat_modifiers:
+				self.stat_totals[s] = DROPSUIT_PLAN.get_total(s, self.stat_modifiers)
+			elif s in self.stat_totals:
+				del self.stat_totals[s]
+
+	def get_stat(self, stat):
+		""" Returns a dropsuit stat with the hi and low slot modules applied as
+		rules.RULES says. """
 		output = self.dropsuit.stats[stat]
-		for m in self.hi_slot:
-			try:
-				output = output + m.get(stat)
-			except TypeError:
-				# If mod doesn't have the proper stat, None is returned.
-				pass
-		for m in self.low_slot:
-			try:
-				output = output + m.get(stat)
-			except:
-				# If mod doesn't have the proper stat, None is returned.
-				pass
+		if stat in self.stat_totals:
+			output = DROPSUIT_PLAN.apply(stat, output, self.stat_totals[stat])
 		return output
 
-	def _get_multiplicative_stat(self, stat):
-		output = self.dropsuit.stats[stat]
-		for m in self.hi_slot:
-			try:
-				output = output + (output * m.get(stat))
-			except TypeError:
-				# If mod doesn't have the proper stat, None is returned.
-				pass
-		for m in self.low_slot:
-			try:
-				output = output + (output * m.get(stat))
-			except:
-				# If mod doesn't have the proper stat, None is returned.
-				pass
-		return output
 
-	def _get_multiplicative_stacking_stat(self, stat):
-		ds_stat = self.dropsuit.stats[stat]
-		modifier_list = []
-		for m in self.hi_slot:
-			if m.get(stat):
-				modifier_list.append(m.get(stat))
-		for m in self.low_slot:
-			if m.get(stat):
-				modifier_list.append(m.get(stat))
-		return self._stacking_penalty(ds_stat, modifier_list)
-
-	def _stacking_penalty(self, ds_stat, modifier_list):
-		penalty = (1, 0.87, 0.57, 0.28, 0.105, 0.03)
-		output = ds_stat
-		for m, p in zip(modifier_list, penalty):
-			output = output + output*m*p
-		return output
+def _get_skills(char):
+	""" The skill effects of a character as they are now, to compare with
+	them once it has been edited. """
+	return frozenset(char.skill_effect.items())
+
+
+def _rebased(item, *args):
+	""" Returns a copy of a module, weapon or dropsuit rebased with args. The
+	copy shares the base stats, only the skilled stats are new. """
+	item = copy.copy(item)
+	item.rebase(*args)
+	return item
+
+
+def _get_over(used, available):
+	""" Returns how far used goes over available as a percentage string, or
+	None if it does not. """
+	if used > available:
+		perc =( (used-available) / available) * 100
+		return '%s%% over' % round(perc, 1)
+	return None
 
 
 class Dropsuit:
 	def __init__(self, char, ds_name):
-		self.stats = {}
 		self.skill_effects = char.skill_effect
 		self.ds_name = ds_name
 
-		dropsuit_data = XmlRetrieval('dropsuit.xml')
-		properties, effecting_skills = dropsuit_data.get_target(ds_name)
+		dropsuit_data = XmlRetrieval('dropsuit.xml').get_catalog()
+		self.base = dropsuit_data.get_target(ds_name)
+		properties, effecting_skills = self.base
+		self._add_stats(properties, effecting_skills, dropsuit_data.get_layout(ds_name))
+
+	def __setstate__(self, state):
+		""" Dropsuits pickled with a stats dict get a StatRecord instead. """
+		self.__dict__.update(state)
+		if isinstance(self.stats, dict):
+			self.stats = make_stat_record(self.stats)
+
+	def rebase(self, char):
+		""" Reapplies a new characters skills to the base stats. """
+		if 'base' not in self.__dict__:
+			self.base = XmlRetrieval('dropsuit.xml').get_target(self.ds_name)
+		self.skill_effects = char.skill_effect
+		properties, effecting_skills = self.base
 		self._add_stats(properties, effecting_skills)
 
 	def show_stats(self):
 		for key in self.stats:
 			print key, self.stats[key]
 
-	def _add_stats(self, properties, effecting_skills):
+	def _add_stats(self, properties, effecting_skills, layout=None):
 		""" Adds the properties and effecting skills to the Dropsuit.stats
-		dictionary. """
+		record. """
 		def skill_modifiers(attrib):
 			""" Finds all skills in attrib.values and applies the appropriate
 			modifier.  If no modifier found, 1 is returned for no change.  Each
@@ -471,27 +773,59 @@ class Dropsuit:
 			return output
 
 		# Apply stats. Add skill modifiers when applicable.
-		for key in properties:
+		if layout is None and isinstance(self.__dict__.get('stats'), StatRecord):
+			# A rebase keeps the layout of the stats it replaces.
+			layout = self.stats.layout
+		elif layout is None:
+			layout = XmlRetrieval('dropsuit.xml').get_layout(self.ds_name)
+		values = []
+		for key in layout.numeric:
 			if key in effecting_skills:
 				stat = properties[key] * skill_modifiers(effecting_skills[key])
 			else:
 				stat = properties[key]
-			self.stats[key] = round(stat, 3)
+			values.append(round(stat, 3))
+		self.stats = StatRecord(layout, values)
+
+
+def fitting_from_record(record, character):
+	""" Rebuilds a Fitting from Fitting.to_record for the given character.
+	Items no longer in the xml are left out and named in its dropped_items. """
+	fit = Fitting(record['name'], character, record['ds_name'])
+	module_names = XmlRetrieval('module.xml').get_list()
+	weapon_names = XmlRetrieval('weapon.xml').get_list()
+	dropped = []
+	for slot_type in MODULE_SLOTS + WEAPON_SLOTS:
+		for item_name in record['slots'].get(slot_type, ()):
+			if slot_type in MODULE_SLOTS and item_name in module_names:
+				fit.add_module(item_name)
+			elif slot_type in WEAPON_SLOTS and item_name in weapon_names:
+				fit.add_weapon(item_name)
+			else:
+				dropped.append(item_name)
+	fit.dropped_items = tuple(dropped)
+	# Loading it is not a change to undo.
+	fit.clear_history()
+	return fit
 
 
 class FittingLibrary:
-	def __init__(self):
-		self.fitting_data = DataRetrieval('fittings.dat')
-
-		self.fitting_list = self.fitting_data.data
+	""" Fittings are saved with only the name of their character, which is
+	looked up in the CharacterLibrary when the fitting is loaded. """
+	def __init__(self, character_library=None, writer=None):
+		if character_library is None:
+			character_library = CharacterLibrary(writer)
+		self.character_library = character_library
+		self.fitting_data = DataRetrieval('fittings.dat',
+			self._encode, self._decode, writer=writer)
 
 	def get_fitting(self, fitting_name):
 		""" Returns a the specified fitting instance. """
-		return self.fitting_list[fitting_name]
+		return self.fitting_data.get_data(fitting_name)
 
 	def get_fitting_list(self):
 		""" Returns a list of the names of all fitting names as a tuple. """
-		return tuple(self.fitting_list.keys())
+		return self.fitting_data.get_names()
 
 	def save_fitting(self, fitting):
 		""" """
@@ -500,6 +834,22 @@ class FittingLibrary:
 	def delete_fitting(self, fitting):
 		self.fitting_data.delete_data(fitting)
 
+	def _encode(self, fitting):
+		# A character which was never saved, such as one from an old fitting,
+		# is saved so the fitting keeps its skills.
+		if fitting.char.name not in self.character_library.get_character_list():
+			self.character_library.save_character(fitting.char)
+		return pickle.dumps(fitting.to_record(), pickle.HIGHEST_PROTOCOL)
+
+	def _decode(self, payload):
+		record = pickle.loads(payload)
+		try:
+			character = self.character_library.get_character(record['character'])
+		except KeyError:
+			# The character was deleted, fall back to one without skills.
+			character = Character(record['character'])
+		return fitting_from_record(record, character)
+
 
 class DropsuitLibrary:
 	def __init__(self):
@@ -513,6 +863,21 @@ class DropsuitLibrary:
 
 
 if __name__ == '__main__':
+	if sys.argv[1:] == ['check']:
+		# Stacking modifiers are applied strongest first, so the scan profile
+		# of a fitting does not depend on the order its dampeners were added.
+		import itertools
+		dampeners = ('Basic Profile Dampener', 'Enhanced Profile Dampener',
+			'Complex Profile Dampener')
+		for order in itertools.permutations(dampeners):
+			fit = Fitting('Check', Character('No Skills'), 'God Type-I')
+			for name in order:
+				fit.add_module(name)
+			assert fit.get_scan_profile() == 56.65, (order, fit.get_scan_profile())
+			fit.remove_module('Complex Profile Dampener')
+			assert fit.get_scan_profile() == 69.56, (order, fit.get_scan_profile())
+		print 'Checks passed'
+		sys.exit()
 
 	"""
 	charlib = CharacterLibrary()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# matchup.py - Time to kill of every saved fitting against every other one.
+# Copyright (C) 2013 Mark Wingerd <markwingerd@yahoo.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+from char import Character
+from combat import (ATTACKER_STATS, DEFENDER_STATS, COMBAT_STATS, get_attacker,
+	get_defender, get_columns, simulate_grid)
+from fitting import Fitting, FittingLibrary, DropsuitLibrary
+from parallel import TILE_SIZE, parallel_simulate
+from util import get_file_loc, replace_file
+
+# Where the matrix is kept between runs and the version of what it holds. A
+# change to how combat.simulate fights needs a new version too, so results
+# from the old one are dropped.
+MATCHUP_FILE = 'matchups.npz'
+MATCHUP_VERSION = 1
+
+# What np.load and reading its arrays raise for a damaged file.
+LOAD_ERRORS = (IOError, ValueError, KeyError, EOFError, zipfile.BadZipfile)
+
+# Fewer new pairs than this are fought in this process, a pool would take
+# longer to start than they take.
+POOL_PAIRS = TILE_SIZE * TILE_SIZE
+
+
+class MatchupMatrix:
+	""" Combat results of every saved fitting attacking every saved fitting
+	and every dropsuit with nothing fitted.
+
+	Results are kept by fingerprint, a hash of the stats combat.simulate
+	reads, rather than by fitting. Each attacker fingerprint is a row and each
+	defender fingerprint a column, so fittings with the same stats share them
+	and an update only fights the rows and columns whose fingerprints are new.
+	Adding a fitting costs one row and one column, renaming one costs
+	nothing. """
+	def __init__(self, file_name=MATCHUP_FILE):
+		self.file_name = get_file_loc(file_name)
+		self.attackers = [] # Name of each attacking fitting.
+		self.defenders = [] # Name of each defending fitting or dropsuit.
+		self.rows = np.empty(0, dtype=int) # Row of each attacker.
+		self.columns = np.empty(0, dtype=int) # Column of each defender.
+		self.row_keys = [] # Fingerprint of each row.
+		self.column_keys = [] # Fingerprint of each column.
+		self.results = np.empty((0, 0, len(COMBAT_STATS)))
+		self.load()
+
+	def load(self):
+		""" Reads the matrix saved by save. Nothing is read if the file is
+		missing, damaged or was saved by another version. """
+		# numpy complains on stderr about a file that is not a zip at all.
+		if not zipfile.is_zipfile(self.file_name):
+			return
+		try:
+			data = np.load(self.file_name)
+		except LOAD_ERRORS:
+			return
+		try:
+			if int(data['version']) != MATCHUP_VERSION:
+				return
+			# Everything is read before anything is kept, so a damaged file
+			# leaves the matrix empty rather than half loaded.
+			attackers = [n.decode('utf-8') for n in data['attackers']]
+			defenders = [n.decode('utf-8') for n in data['defenders']]
+			rows = data['rows']
+			columns = data['columns']
+			row_keys = list(data['row_keys'])
+			column_keys = list(data['column_keys'])
+			results = data['results']
+		except LOAD_ERRORS:
+			return
+		finally:
+			data.close()
+		self.attackers, self.defenders = attackers, defenders
+		self.rows, self.columns = rows, columns
+		self.row_keys, self.column_keys = row_keys, column_keys
+		self.results = results
+
+	def save(self):
+		""" Writes the matrix to a temporary file and renames it into place so
+		a reader never sees half of it. """
+		temp_name = self.file_name + '.tmp'
+		data_file = open(temp_name, 'wb')
+		try:
+			np.savez(data_file, version=MATCHUP_VERSION,
+				attackers=_encode_names(self.attackers),
+				defenders=_encode_names(self.defenders),
+				rows=self.rows, columns=self.columns,
+				row_keys=np.array(self.row_keys, dtype='S40'),
+				column_keys=np.array(self.column_keys, dtype='S40'),
+				results=self.results)
+			data_file.flush()
+			os.fsync(data_file.fileno())
+		finally:
+			data_file.close()
+		replace_file(temp_name, self.file_name)
+
+	def update(self, fitting_library=None, processes=None, progress=None):
+		""" Brings the matrix up to date with the saved fittings and the
+		dropsuits and saves it. Returns the number of pairs fought. """
+		if fitting_library is None:
+			fitting_library = FittingLibrary()
+		fits = [fitting_library.get_fitting(name)
+			for name in fitting_library.get_fitting_list()]
+		fought = self.set_fittings(fits, fits + get_bare_dropsuits(),
+			processes, progress)
+		self.save()
+		return fought
+
+	def set_fittings(self, attack_fits, defend_fits, processes=None, progress=None):
+		""" Makes the matrix every one of attack_fits against every one of
+		defend_fits, keeping the results whose fingerprints it already has.
+		Returns the number of pairs fought. progress is passed on to
+		parallel_simulate. """
+		attackers = [get_attacker(f) for f in attack_fits]
+		defenders = [get_defender(f) for f in defend_fits]
+		row_keys, rows, row_stats = _get_unique(attackers, ATTACKER_STATS)
+		column_keys, columns, column_stats = _get_unique(defenders, DEFENDER_STATS)
+
+		old_rows = dict((key, row) for row, key in enumerate(self.row_keys))
+		old_columns = dict((key, column) for column, key in enumerate(self.column_keys))
+		kept_rows = [r for r, key in enumerate(row_keys) if key in old_rows]
+		kept_columns = [c for c, key in enumerate(column_keys) if key in old_columns]
+		new_rows = [r for r, key in enumerate(row_keys) if key not in old_rows]
+		new_columns = [c for c, key in enumerate(column_keys) if key not in old_columns]
+
+		results = np.empty((len(row_keys), len(column_keys), len(COMBAT_STATS)))
+		results[np.ix_(kept_rows, kept_columns)] = self.results[np.ix_(
+			[old_rows[row_keys[r]] for r in kept_rows],
+			[old_columns[column_keys[c]] for c in kept_columns])]
+
+		# The new rows against every column, then the old rows against the new
+		# columns.
+		attack_columns = get_columns(row_stats, ATTACKER_STATS)
+		defend_columns = get_columns(column_stats, DEFENDER_STATS)
+		fought = 0
+		for grid_rows, grid_columns in ((new_rows, range(len(column_keys))),
+				(kept_rows, new_columns)):
+			if not grid_rows or not grid_columns:
+				continue
+			grid_attackers = dict((s, v[grid_rows]) for s, v in attack_columns.items())
+			grid_defenders = dict((s, v[grid_columns]) for s, v in defend_columns.items())
+			if len(grid_rows) * len(grid_columns) < POOL_PAIRS:
+				grid = simulate_grid(grid_attackers, grid_defenders)
+			else:
+				grid = parallel_simulate(grid_attackers, grid_defenders, processes,
+					progress=progress)
+			results[np.ix_(grid_rows, grid_columns)] = grid
+			fought += grid.shape[0] * grid.shape[1]
+
+		self.attackers = [f.name for f in attack_fits]
+		self.defenders = [f.name for f in defend_fits]
+		self.rows = np.array(rows, dtype=int)
+		self.columns = np.array(columns, dtype=int)
+		self.row_keys = row_keys
+		self.column_keys = column_keys
+		self.results = results
+		return fought
+
+	def get_results(self, stat=None):
+		""" Returns a len(attackers) x len(defenders) x len(COMBAT_STATS)
+		array, or the attackers x defenders array of one stat. """
+		results = self.results[self.rows][:, self.columns]
+		if stat is None:
+			return results
+		return results[..., COMBAT_STATS.index(stat)]
+
+	def get(self, attacker, defender, stat='ttk'):
+		""" Returns one stat of an attacker fighting a defender, by name. """
+		row = self.rows[self.attackers.index(attacker)]
+		column = self.columns[self.defenders.index(defender)]
+		return self.results[row, column, COMBAT_STATS.index(stat)]
+
+
+def get_bare_dropsuits(character=None):
+	""" Returns a Fitting with nothing fitted for every dropsuit, named after
+	it. Without a character they have no skills. """
+	if character is None:
+		character = Character('No Skills')
+	return [Fitting(ds_name, character, ds_name)
+		for ds_name in DropsuitLibrary().get_names()]
+
+
+def get_fingerprint(stats, names):
+	""" Returns a hash of the values of names in a get_attacker or
+	get_defender result. Missing stats hash as nan. """
+	values = [stats.get(name, np.nan) for name in names]
+	return hashlib.sha1(struct.pack('<%sd' % len(values), *values)).hexdigest()
+
+
+def _get_unique(rows, names):
+	""" Fingerprints rows of stats and returns (fingerprints, position of each
+	row in them, stats of each fingerprint), fingerprints in order of first
+	use. """
+	keys = []
+	positions = {}
+	stats = []
+	output = []
+	for row in rows:
+		key = get_fingerprint(row, names)
+		if key not in positions:
+			positions[key] = len(keys)
+			keys.append(key)
+			stats.append(row)
+		output.append(positions[key])
+	return keys, output, stats
+
+
+def _encode_names(names):
+	""" Names as a byte string array, np.load will not read object arrays. """
+	return np.array([n.encode('utf-8') for n in names], dtype=str)
+
+
+if __name__ == '__main__':
+	import sys, time
+
+	def show_progress(done, total):
+		sys.stdout.write('\r%s/%s' % (done, total))
+		sys.stdout.flush()
+
+	matchups = MatchupMatrix()
+	start = time.time()
+	fought = matchups.update(progress=show_progress)
+	print 'Fought %s pairs in %.3f seconds' % (fought, time.time() - start)
+
+	start = time.time()
+	matchups = MatchupMatrix()
+	print 'Loaded in %.4f seconds' % (time.time() - start)
+	ttk = matchups.get_results('ttk')
+	for i, attacker in enumerate(matchups.attackers):
+		for j, defender in enumerate(matchups.defenders):
+			print '{:<24} {:<24} ttk {:.2f}'.format(attacker, defender, ttk[i, j])
@@ -20,18 +20,35 @@ import xml.etree.ElementTree as ET
 import math
 
 from char import Character
-from util import XmlRetrieval
+from rules import WEAPON_PLAN
+from util import XmlRetrieval, StatRecord, make_stat_record
 
 
 class Module:
+	xml_file = 'module.xml'
+
 	def __init__(self, skills, mod_name):
-		self.stats = {}
 		self.name = mod_name
 		self.skills = skills
 
-		module_data = XmlRetrieval('module.xml')
-		properties, effecting_skills = module_data.get_target(mod_name)
-		self._add_stats(properties,effecting_skills)
+		module_data = XmlRetrieval(self.xml_file).get_catalog()
+		# (properties, effecting_skills) shared with the catalog, kept so the
+		# skills can be reapplied without another lookup.
+		self.base = module_data.get_target(mod_name)
+		properties, effecting_skills = self.base
+		self._add_stats(properties, effecting_skills, module_data.get_layout(mod_name))
+
+	def __setstate__(self, state):
+		""" Items pickled with a stats dict get a StatRecord instead. """
+		self.__dict__.update(state)
+		if isinstance(self.stats, dict):
+			self.stats = make_stat_record(self.stats)
+
+	def rebase(self, skills):
+		""" Reapplies a new set of skills to the base stats. """
+		self.skills = skills
+		properties, effecting_skills = self._get_base()
+		self._add_stats(properties, effecting_skills)
 
 	def show_stats(self):
 		print self.name
@@ -44,9 +61,21 @@ class Module:
 		else:
 			return None
 
-	def _add_stats(self, properties, effecting_skills):
+	def _get_base(self):
+		# Modules pickled before base was kept look it up again.
+		if 'base' not in self.__dict__:
+			self.base = XmlRetrieval(self.xml_file).get_target(self.name)
+		return self.base
+
+	def _get_layout(self):
+		# A rebase keeps the layout of the stats it replaces.
+		if isinstance(self.__dict__.get('stats'), StatRecord):
+			return self.stats.layout
+		return XmlRetrieval(self.xml_file).get_layout(self.name)
+
+	def _add_stats(self, properties, effecting_skills, layout=None):
 		""" Uses the properties list and effecting_skills list to populate
-		the stats dictionary with all appropriate values. 
+		the stats record with all appropriate values. 
 		THIS ALSO HANDLES SKILL BONUSES! """
 
 		def _get_skill_modifier(skill_list):
@@ -59,42 +88,59 @@ class Module:
 					pass
 			return output
 
-		for key in properties:
-			if key in effecting_skills.keys():
+		if layout is None:
+			layout = self._get_layout()
+		values = []
+		for key in layout.numeric:
+			if key in effecting_skills:
 				# Skills effect this property. Get and apply the skill modifier.
 				skill_list = effecting_skills[key]
 				mod = _get_skill_modifier(skill_list)
-				self.stats[key] = math.floor(properties[key] * (1 + mod))
+				values.append(math.floor(properties[key] * (1 + mod)))
 			else:
-				self.stats[key] = properties[key]
+				values.append(properties[key])
+		self.stats = StatRecord(layout, values)
 
 
 class Weapon(Module):
 	""" Req dropsuit and fitting to test properly. """
+	xml_file = 'weapon.xml'
+
 	def __init__(self, skills, weapon_name, module_list=[]):
-		self.stats = {}
 		self.name = weapon_name
 		self.skills = skills
 		self.module_list = module_list
 
-		weapon_data = XmlRetrieval('weapon.xml')
-		properties, effecting_skills = weapon_data.get_target(weapon_name)
-		self._add_stats(properties,effecting_skills)
+		weapon_data = XmlRetrieval(self.xml_file).get_catalog()
+		self.base = weapon_data.get_target(weapon_name)
+		properties, effecting_skills = self.base
+		self._add_stats(properties, effecting_skills, weapon_data.get_layout(weapon_name))
+		self._add_module_bonus()
+
+	def rebase(self, skills, module_list=None):
+		""" Reapplies a new set of skills, and the bonuses of module_list if
+		given, to the base stats. """
+		if module_list is not None:
+			self.module_list = module_list
+		Module.rebase(self, skills)
 		self._add_module_bonus()
 
 	def _add_module_bonus(self):
 		""" Searching self.module_list for any modules which effect this 
-		weapons slot type (found in the modules 'enhances' cell. If so, it will 
-		add the bonuses for that module. 
-		CURRENTLY ONLY WORKS FOR DAMAGE!!! """
+		weapons slot type (found in the modules 'enhances' cell. If so, their
+		stats are applied to this weapon as rules.RULES says. """
 		slot_type = self.stats['slot_type']
+		modifiers = {}
 		for m in self.module_list:
-			try:
-				if slot_type == m.stats['enhances']:
-					self.stats['damage'] = self.stats['damage'] * (1 + m.stats['damage'])
-			except KeyError:
-				# Module does not have a key 'enhances' in its stats dictionary.
-				pass
+			if m.stats.get('enhances') != slot_type:
+				continue
+			for stat in WEAPON_PLAN.stats:
+				if stat in m.stats and stat in self.stats:
+					modifiers.setdefault(stat, []).append(m.stats[stat])
+		for stat in modifiers:
+			modifiers[stat].sort(key=abs, reverse=True)
+			total = WEAPON_PLAN.get_total(stat, modifiers)
+			self.stats[stat] = WEAPON_PLAN.apply(stat, self.stats[stat], total)
 
 
 class ModuleLibrary:
@@ -0,0 +1,508 @@
+#!/usr/bin/env python
+# optimizer.py - Finds the best legal loadout for a dropsuit.
+# Copyright (C) 2013 Mark Wingerd <markwingerd@yahoo.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+
+from fitting import Fitting, Dropsuit
+from module import Module, Weapon, ModuleLibrary, WeaponLibrary
+from rules import DROPSUIT_PLAN, WEAPON_PLAN, ADD, MULTIPLY, STACK
+
+# Metrics an objective can weigh. ehp is shield_hp plus armor_hp.
+OBJECTIVES = ('ehp', 'dps', 'sprint_speed')
+
+# Slots which are searched, in search order. Weapons are chosen first since the
+# value of a damage modifier depends on the weapon.
+SEARCH_SLOTS = ('hi_slot', 'low_slot')
+WEAPON_SLOTS = ('heavy_weapon', 'light_weapon')
+
+# How rules.RULES must combine the stats the search scores. Scores are worked
+# out through the plans, but the bounds assume these.
+SEARCH_RULES = ((DROPSUIT_PLAN, 'shield_hp', ADD), (DROPSUIT_PLAN, 'armor_hp', ADD),
+	(DROPSUIT_PLAN, 'sprint_speed', STACK), (WEAPON_PLAN, 'damage', MULTIPLY),
+	(WEAPON_PLAN, 'rate_of_fire', MULTIPLY))
+
+# Weapon stats the modules enhancing a weapon change its dps through.
+DPS_STATS = ('damage', 'rate_of_fire')
+
+
+class LoadoutOptimizer:
+	""" Searches module.xml and weapon.xml for the loadout which scores best on
+	an objective without going over the dropsuits CPU, PG or slot counts.
+
+	The objective is one of OBJECTIVES or a dict of {metric: weight} with
+	positive weights. Items named in required are always fitted. Only the
+	primary weapon and the hi and low slots are searched, other slots are left
+	for the user. """
+	def __init__(self, ds_name, character, objective='ehp', required=()):
+		check_rules()
+		self.ds_name = ds_name
+		self.character = character
+		self.weights = get_weights(objective)
+		self.required = tuple(required)
+		self.dropsuit = Dropsuit(character, ds_name)
+		self.branches = {} # {weapon name: (groups, state, chosen)}
+
+		self.reset()
+		self._load_items()
+
+	def optimize(self):
+		""" Returns (score, item names) of the best legal loadout, or None if
+		even the required items do not fit. """
+		self.reset()
+		for weapon in self.get_weapon_branches():
+			self.search_branch(weapon)
+		return self.get_result()
+
+	def reset(self, floor=None):
+		""" Forgets the best loadout found so far. If a floor is given, only
+		loadouts scoring at least that much are looked for. """
+		self.best_score = None
+		self.best_items = None
+		self.floor = floor
+
+	def get_result(self):
+		if self.best_items is None:
+			return None
+		return (self.best_score, self.required + self.best_items)
+
+	def get_fitting(self, name):
+		""" Returns the best loadout as a Fitting. optimize must be called first. """
+		fit = Fitting(name, self.character, self.ds_name)
+		score, names = self.get_result()
+		for item_name in names:
+			if item_name in self.weapons:
+				fit.add_weapon(item_name)
+			else:
+				fit.add_module(item_name)
+		return fit
+
+	def get_weapon_branches(self):
+		""" Returns the primary weapon choices, most promising first. None
+		stands for leaving the primary weapon to the user. """
+		if not self.weights['dps'] or self.base['weapon'] is not None:
+			return [None]
+		weapons = []
+		for w in self.weapons.values():
+			if self.free_slots.get(w.stats['slot_type']) > 0 and w.get('rate_of_fire'):
+				weapons.append((-_get_dps(w.stats), w.name))
+		return [name for dps, name in sorted(weapons)] + [None]
+
+	def search_branch(self, weapon_name):
+		""" Runs the branch and bound search with one primary weapon choice,
+		keeping the best loadout found in best_score and best_items. """
+		groups, state, chosen = self._get_branch(weapon_name)
+		self._search(groups, 0, 0, groups[0][1], state, chosen)
+
+	def get_subtrees(self, weapon_name):
+		""" Splits the search of one weapon branch into parts for
+		search_subtree, in the order search_branch searches them. None is the
+		loadout with no searched module, (group, index) every loadout whose
+		first searched module is candidate index of that SEARCH_SLOTS group. """
+		groups = self._get_branch(weapon_name)[0]
+		subtrees = [None]
+		for group, (candidates, slots, suffix) in enumerate(groups):
+			if slots:
+				subtrees.extend([(group, index) for index in range(len(candidates))])
+		return subtrees
+
+	def search_subtree(self, weapon_name, subtree):
+		""" Searches one part of a weapon branch from get_subtrees. Searching
+		every part finds what search_branch finds. """
+		groups, state, chosen = self._get_branch(weapon_name)
+		if subtree is None:
+			self._check(state, chosen)
+			return
+		group, index = subtree
+		record = groups[group][0][index]
+		self._search(groups, group, index, groups[group][1] - 1,
+			self._add_item(state, record), chosen + (record['name'],))
+
+	def _get_branch(self, weapon_name):
+		""" Returns the search groups, starting state and chosen items of a
+		primary weapon choice. """
+		if weapon_name in self.branches:
+			return self.branches[weapon_name]
+		state = dict(self.base)
+		chosen = ()
+		if weapon_name is not None:
+			weapon = self.weapons[weapon_name]
+			state = self._add_item(state, _get_record(weapon))
+			state['weapon'] = weapon.stats
+			chosen = (weapon_name,)
+		if state['weapon'] is not None:
+			enhances = state['weapon']['slot_type']
+		else:
+			enhances = None
+
+		groups = []
+		for slot_type in SEARCH_SLOTS:
+			candidates = self._get_candidates(slot_type, enhances)
+			groups.append((candidates, self.free_slots[slot_type],
+				_get_suffix_max(candidates)))
+		self.branches[weapon_name] = (groups, state, chosen)
+		return self.branches[weapon_name]
+
+	def _check(self, state, chosen):
+		""" Keeps a loadout as the best so far if it is legal and beats it. """
+		if state['cpu_used'] <= state['cpu_max'] and state['pg_used'] <= state['pg_max']:
+			score = self._get_score(state)
+			if (self.best_score is None or score > self.best_score) and \
+					(self.floor is None or score >= self.floor):
+				self.best_score = score
+				self.best_items = chosen
+
+	def _search(self, groups, group, start, remaining, state, chosen):
+		""" Depth first search over multisets of candidates, group by group.
+		Every node is a legal stopping point, the rest left empty. """
+		self._check(state, chosen)
+
+		# The bound covers this group and every later one, so a node which
+		# can not beat the best loadout is dropped along with its later groups.
+		bound = self._get_bound(groups, group, start, remaining, state)
+		if bound is None or (self.best_score is not None and bound <= self.best_score) or \
+				(self.floor is not None and bound < self.floor):
+			return
+
+		candidates = groups[group][0]
+		if remaining:
+			for index in range(start, len(candidates)):
+				record = candidates[index]
+				self._search(groups, group, index, remaining - 1,
+					self._add_item(state, record), chosen + (record['name'],))
+		if group + 1 < len(groups):
+			self._search(groups, group + 1, 0, groups[group + 1][1], state, chosen)
+
+	def _get_bound(self, groups, group, start, remaining, state):
+		""" Returns an upper bound of the score of any loadout below this node,
+		or None if no loadout below it can fit.
+
+		Two bounds are taken and the lower one used. The first fills every open
+		slot with the best remaining item for each stat at once. The second
+		gives each open slot only the single item worth the most, valuing
+		dps and sprint speed at their best reachable multipliers. """
+		open_slots = []
+		if remaining and start < len(groups[group][0]):
+			open_slots.append((groups[group][0][start:], groups[group][2][start], remaining))
+		for g in range(group + 1, len(groups)):
+			if groups[g][0]:
+				open_slots.append((groups[g][0], groups[g][2][0], groups[g][1]))
+		if not open_slots:
+			return None
+
+		cpu_max = state['cpu_max']
+		pg_max = state['pg_max']
+		shield = state['shield_hp']
+		armor = state['armor_hp']
+		weapon_mods = dict([(s, list(m)) for s, m in state['weapon_mods'].items()])
+		sprint = list(state['sprint_mods'])
+		for candidates, suffix, slots in open_slots:
+			cpu_max *= (1 + suffix['cpu_bonus']) ** slots
+			pg_max += suffix['pg_bonus'] * slots
+			shield += suffix['shield_hp'] * slots
+			armor += suffix['armor_hp'] * slots
+			for stat in DPS_STATS:
+				if suffix[stat] > 0:
+					weapon_mods.setdefault(stat, []).extend([suffix[stat]] * slots)
+			if suffix['sprint_speed'] > 0:
+				sprint.extend([suffix['sprint_speed']] * slots)
+		if state['cpu_used'] > cpu_max or state['pg_used'] > pg_max:
+			return None
+
+		for modifiers in weapon_mods.values():
+			modifiers.sort(key=abs, reverse=True)
+		sprint.sort(key=abs, reverse=True)
+		stat_bound = self._get_score(dict(state, shield_hp=shield, armor_hp=armor,
+			weapon_mods=weapon_mods, sprint_mods=sprint))
+
+		# An items extra dps is at most its share of the dps every other open
+		# slot could add up to, and likewise for sprint speed.
+		dps_value = 0
+		if self.weights['dps'] and state['weapon'] is not None:
+			dps_value = self.weights['dps'] * _get_dps(state['weapon'], weapon_mods)
+		sprint_value = self.weights['sprint_speed'] * \
+			self.dropsuit.stats['sprint_speed'] * _get_sprint_total(sprint)
+		slot_items = []
+		for candidates, suffix, slots in open_slots:
+			items = []
+			for record in candidates:
+				value = self.weights['ehp'] * (record['shield_hp'] + record['armor_hp']) + \
+					dps_value * _get_dps_gain(record) + \
+					sprint_value * max(record['sprint_speed'], 0)
+				items.append((value, record['cpu'], record['pg'] - record['pg_bonus'],
+					record['cpu_bonus']))
+			slot_items.append((items, slots))
+
+		slot_bound = _get_slot_bound(self._get_score(state), slot_items,
+			state['cpu_max'], state['cpu_used'], state['pg_max'] - state['pg_used'])
+		return min(stat_bound, slot_bound)
+
+	def _get_score(self, state):
+		""" The objective of a loadout. The weapon and sprint speed modifiers
+		are applied as rules.RULES says. """
+		score = self.weights['ehp'] * (state['shield_hp'] + state['armor_hp'])
+		if self.weights['dps'] and state['weapon'] is not None:
+			score += self.weights['dps'] * _get_dps(state['weapon'], state['weapon_mods'])
+		if self.weights['sprint_speed']:
+			score += self.weights['sprint_speed'] * \
+				self.dropsuit.stats['sprint_speed'] * _get_sprint_total(state['sprint_mods'])
+		return score
+
+	def _add_item(self, state, record):
+		""" Returns a new state with the item fitted. """
+		state = dict(state)
+		state['cpu_used'] += record['cpu']
+		state['pg_used'] += record['pg']
+		state['cpu_max'] += state['cpu_max'] * record['cpu_bonus']
+		state['pg_max'] += record['pg_bonus']
+		if record['slot_type'] in SEARCH_SLOTS:
+			state['shield_hp'] += record['shield_hp']
+			state['armor_hp'] += record['armor_hp']
+			if record['sprint_speed']:
+				sprint = list(state['sprint_mods']) + [record['sprint_speed']]
+				sprint.sort(key=abs, reverse=True)
+				state['sprint_mods'] = sprint
+			if state['weapon'] is not None and \
+					record['enhances'] == state['weapon']['slot_type']:
+				weapon_mods = dict(state['weapon_mods'])
+				for stat in DPS_STATS:
+					if record[stat]:
+						modifiers = weapon_mods.get(stat, []) + [record[stat]]
+						modifiers.sort(key=abs, reverse=True)
+						weapon_mods[stat] = modifiers
+				state['weapon_mods'] = weapon_mods
+		return state
+
+	def _load_items(self):
+		""" Builds every module and weapon with the characters skills, then
+		fits the required items to get the starting state. """
+		skills = self.character.skill_effect
+		self.modules = {}
+		self.weapons = {}
+		for name in ModuleLibrary().get_names():
+			self.modules[name] = Module(skills, name)
+		for name in WeaponLibrary().get_names():
+			self.weapons[name] = Weapon(skills, name)
+
+		stats = self.dropsuit.stats
+		self.free_slots = {}
+		for slot_type in SEARCH_SLOTS + WEAPON_SLOTS:
+			self.free_slots[slot_type] = int(stats[slot_type])
+		self.base = {'cpu_used': 0, 'pg_used': 0, 'cpu_max': stats['cpu'],
+			'pg_max': stats['pg'], 'shield_hp': stats['shield_hp'],
+			'armor_hp': stats['armor_hp'], 'sprint_mods': [], 'weapon_mods': {},
+			'weapon': None}
+
+		required = [self.weapons.get(n) or self.modules[n] for n in self.required]
+		# Weapons first so required weapon modifiers count for them.
+		required.sort(key=lambda item: item.name not in self.weapons)
+		for item in required:
+			slot_type = item.stats['slot_type']
+			if slot_type in self.free_slots:
+				self.free_slots[slot_type] -= 1
+			# A heavy weapon is the primary weapon over a light one.
+			if slot_type in WEAPON_SLOTS and (self.base['weapon'] is None or
+					slot_type == 'heavy_weapon'):
+				self.base['weapon'] = item.stats
+			self.base = self._add_item(self.base, _get_record(item))
+
+	def _get_candidates(self, slot_type, enhances):
+		""" Returns the modules worth searching for a slot type, best first.
+		Modules that do nothing for the objective or the resources are left
+		out, as are modules another module beats on every count. """
+		records = []
+		for m in self.modules.values():
+			if m.stats['slot_type'] != slot_type:
+				continue
+			record = _get_record(m)
+			if record['enhances'] != enhances or not self.weights['dps']:
+				record['damage'] = record['rate_of_fire'] = 0
+			if not self.weights['ehp']:
+				record['shield_hp'] = record['armor_hp'] = 0
+			if not self.weights['sprint_speed']:
+				record['sprint_speed'] = 0
+			if any([record[k] for k in _VALUE_KEYS]):
+				records.append(record)
+
+		candidates = []
+		for record in records:
+			if not [other for other in records if _dominates(other, record)]:
+				candidates.append(record)
+		candidates.sort(key=self._get_priority, reverse=True)
+		return candidates
+
+	def _get_priority(self, record):
+		""" Rough worth of a module on its own, used to search good modules first. """
+		priority = self.weights['ehp'] * (record['shield_hp'] + record['armor_hp']) + \
+			self.weights['dps'] * _get_dps_gain(record) * 1000 + \
+			self.weights['sprint_speed'] * record['sprint_speed'] * 100
+		return (priority, record['cpu_bonus'], record['pg_bonus'], -record['cpu'],
+			record['name'])
+
+
+# Keys of a candidate record where a bigger value is better.
+_VALUE_KEYS = ('shield_hp', 'armor_hp', 'sprint_speed', 'damage', 'rate_of_fire',
+	'cpu_bonus', 'pg_bonus')
+_COST_KEYS = ('cpu', 'pg')
+
+
+def get_weights(objective):
+	""" Turns an objective name or {metric: weight} dict into a weight for
+	every metric in OBJECTIVES. """
+	if not isinstance(objective, dict):
+		objective = {objective: 1}
+	weights = dict((metric, 0) for metric in OBJECTIVES)
+	for metric, weight in objective.items():
+		if metric not in weights:
+			raise ValueError('Unknown objective: %s' % metric)
+		if weight < 0:
+			raise ValueError('Objective weights must be positive: %s' % metric)
+		weights[metric] = weight
+	return weights
+
+
+def check_rules():
+	""" Raises ValueError if rules.RULES combines a stat the search scores in a
+	way its bounds do not cover. """
+	for plan, stat, combine in SEARCH_RULES:
+		if plan.combine.get(stat) != combine or len(plan.get_group(stat)) > 1:
+			raise ValueError('LoadoutOptimizer can not search a %s rule for %s %s' %
+				(plan.combine.get(stat), plan.target, stat))
+
+
+def _get_record(item):
+	""" Reduces a Module or Weapon to the numbers the search needs. """
+	stats = item.stats
+	record = {'name': item.name, 'slot_type': stats['slot_type'],
+		'enhances': stats.get('enhances')}
+	for key in _VALUE_KEYS + _COST_KEYS:
+		record[key] = stats.get(key) or 0
+	return record
+
+
+def _dominates(a, b):
+	""" True if module a is at least as good as b on every count, costs no
+	more, and is either strictly better or comes first by name. """
+	for key in _VALUE_KEYS:
+		if a[key] < b[key]:
+			return False
+	for key in _COST_KEYS:
+		if a[key] > b[key]:
+			return False
+	if a['enhances'] != b['enhances'] and (b['damage'] or b['rate_of_fire']):
+		return False
+	same = [a[k] == b[k] for k in _VALUE_KEYS + _COST_KEYS]
+	return not all(same) or a['name'] < b['name']
+
+
+def _get_suffix_max(candidates):
+	""" suffix[i] holds the best value of each key among candidates[i:]. """
+	suffix = [dict((k, 0) for k in _VALUE_KEYS)]
+	for record in reversed(candidates):
+		best = dict(suffix[0])
+		for key in _VALUE_KEYS:
+			best[key] = max(best[key], record[key])
+		suffix.insert(0, best)
+	return suffix
+
+
+def _get_slot_bound(score, slot_items, cpu_max, cpu_used, pg_left):
+	""" Lagrangian bound of a score given the open slots. slot_items holds, per
+	group of slots, the (value, cpu, pg less pg bonus, cpu bonus) of each item
+	that could fill one of them.
+
+	CPU upgrades multiply the CPU, so each possible count of them is tried with
+	the CPU they could give at most. For that count and any prices l and m of
+	CPU and PG, no legal loadout can score more than the score so far plus
+	the priced CPU and PG left plus, for each slot, the best of its items
+	value less their priced cost. A few prices are tried, each set by an
+	items value per unit, and the lowest bound for the best count is used. """
+	prices = set([(0, 0)])
+	for items, slots in slot_items:
+		for value, cpu, pg, cpu_bonus in items:
+			if value > 0 and cpu > 0:
+				prices.add((value / cpu, 0))
+			if value > 0 and pg > 0:
+				prices.add((0, value / pg))
+
+	# Groups of slots split into the items without and with a CPU bonus.
+	groups = []
+	counts = []
+	for items, slots in slot_items:
+		plain = [i for i in items if not i[3]]
+		upgrades = [i for i in items if i[3]]
+		groups.append((plain, upgrades, slots))
+		counts.append(range(slots + 1) if upgrades else [0])
+
+	bound = None
+	for upgrade_counts in itertools.product(*counts):
+		cpu_left = cpu_max - cpu_used
+		for (plain, upgrades, slots), count in zip(groups, upgrade_counts):
+			if count:
+				cpu_left += cpu_max * ((1 + max([i[3] for i in upgrades])) ** count - 1)
+		count_bound = None
+		for l, m in prices:
+			total = score + l*cpu_left + m*pg_left
+			for (plain, upgrades, slots), count in zip(groups, upgrade_counts):
+				best = 0
+				for value, cpu, pg, cpu_bonus in plain:
+					best = max(best, value - l*cpu - m*pg)
+				total += best * (slots - count)
+				if count:
+					total += count * max([value - l*cpu - m*pg
+						for value, cpu, pg, cpu_bonus in upgrades])
+			if count_bound is None or total < count_bound:
+				count_bound = total
+		if bound is None or count_bound > bound:
+			bound = count_bound
+	return bound
+
+
+def _get_dps(stats, modifiers=None):
+	""" The dps of a weapon, with the {stat: [modifier, ...]} of the modules
+	enhancing it applied through rules.WEAPON_PLAN. """
+	damage = stats['damage']
+	rate_of_fire = stats.get('rate_of_fire', 0)
+	if modifiers:
+		damage = WEAPON_PLAN.apply('damage', damage,
+			WEAPON_PLAN.get_total('damage', modifiers))
+		rate_of_fire = WEAPON_PLAN.apply('rate_of_fire', rate_of_fire,
+			WEAPON_PLAN.get_total('rate_of_fire', modifiers))
+	return damage * rate_of_fire / 60
+
+
+def _get_dps_gain(record):
+	""" Share of a weapons dps a module enhancing it adds. """
+	return (1 + record['damage']) * (1 + record['rate_of_fire']) - 1
+
+
+def _get_sprint_total(modifiers):
+	""" Factor of sprint speed modifiers sorted strongest first, through
+	rules.DROPSUIT_PLAN. """
+	return DROPSUIT_PLAN.get_total('sprint_speed', {'sprint_speed': modifiers})
+
+
+if __name__ == '__main__':
+	import sys, time
+	from char import Character
+
+	objective = sys.argv[2] if len(sys.argv) > 2 else 'ehp'
+	ds_name = sys.argv[1] if len(sys.argv) > 1 else 'Assault Type-I'
+	start = time.time()
+	optimizer = LoadoutOptimizer(ds_name, Character('No Skills'), objective)
+	print optimizer.optimize()
+	print 'Searched in %.2f seconds' % (time.time() - start)
+	optimizer.get_fitting('Optimized').show_stats()
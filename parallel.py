@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# parallel.py - Runs loadout searches and batch evaluation on every core.
+# Copyright (C) 2013 Mark Wingerd <markwingerd@yahoo.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import Queue
+
+from util import CATALOG_SOURCES, get_catalog, get_file_loc
+
+# Rows of a batch sent to a worker at a time.
+CHUNK_SIZE = 8192
+
+# Tasks a dropsuits search is split into per process, so a worker which
+# finishes early always finds more.
+TASKS_PER_PROCESS = 4
+
+# Attackers and defenders in a tile of a matchup grid sent to a worker at a
+# time.
+TILE_SIZE = 256
+
+# State kept by each worker process between tasks, filled by _init_worker.
+_worker = {}
+
+
+def parallel_evaluate(ds_name, character, ids, processes=None,
+		chunk_size=CHUNK_SIZE, progress=None):
+	""" Same as BatchEvaluator(ds_name, character).evaluate(ids) with the rows
+	split across a pool of processes. Rows come back in their original order.
+	progress, if given, is called as progress(rows done, total rows). """
+	import numpy as np
+
+	ids = np.asarray(ids, dtype=int)
+	tasks = [(start, ds_name, ids[start:start + chunk_size])
+		for start in range(0, len(ids), chunk_size)]
+
+	results = {}
+	done = [0]
+	def collect(result):
+		start, stats = result
+		results[start] = stats
+		done[0] += len(stats)
+		if progress:
+			progress(done[0], len(ids))
+
+	_run(_evaluate_task, tasks, character, processes, collect)
+	if not results:
+		from batch import BATCH_STATS
+		return np.empty((0, len(BATCH_STATS)))
+	return np.concatenate([results[start] for start in sorted(results)])
+
+
+def parallel_optimize(ds_names, character, objective='ehp', required=(),
+		processes=None, progress=None):
+	""" Runs LoadoutOptimizer for every dropsuit in ds_names on one pool.
+	Returns {ds_name: (score, item names)}, or None for a dropsuit where the
+	required items do not fit.
+
+	A first task per dropsuit lists its weapon branches and splits each one
+	by its first hi or low slot module, see LoadoutOptimizer.get_subtrees,
+	into about TASKS_PER_PROCESS tasks per process in all. They are queued on
+	the same pool as soon as they are listed, the most promising weapon
+	first, so even a single dropsuit or an ehp search with one weapon branch
+	keeps every core busy. The best score found for a
+	dropsuit so far is shared through a Manager as the floor of its later
+	parts, so they prune nearly as hard as a single process search would.
+	When two loadouts tie, the one LoadoutOptimizer would find first wins, so
+	the result does not depend on which worker finished first. progress, if
+	given, is called as progress(tasks done, tasks listed so far). """
+	if processes is None:
+		processes = multiprocessing.cpu_count()
+	manager = multiprocessing.Manager()
+	try:
+		floors = manager.dict()
+		tasks = Queue.Queue()
+		for ds_name in ds_names:
+			tasks.put(('split', ds_name, objective, tuple(required),
+				processes * TASKS_PER_PROCESS))
+
+		results = []
+		counts = [len(ds_names), 0] # Tasks listed, tasks done.
+		def collect(result):
+			kind, ds_name, value = result
+			if kind == 'split':
+				for order, weapon, subtrees in value:
+					tasks.put(('search', ds_name, objective, tuple(required),
+						order, weapon, subtrees))
+				counts[0] += len(value)
+			else:
+				results.append((ds_name,) + value)
+			counts[1] += 1
+			if progress:
+				progress(counts[1], counts[0])
+			return counts[1] < counts[0]
+
+		pool = multiprocessing.Pool(processes, _init_worker, (character, floors))
+		try:
+			if ds_names:
+				for result in pool.imap_unordered(_optimize_task, _get_queued(tasks)):
+					if not collect(result):
+						break
+			tasks.put(None)
+			pool.close()
+		except:
+			tasks.put(None)
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
+	finally:
+		manager.shutdown()
+
+	best = dict((ds_name, None) for ds_name in ds_names)
+	for ds_name, order, result in sorted(results):
+		if result is not None and (best[ds_name] is None or result[0] > best[ds_name][0]):
+			best[ds_name] = result
+	return best
+
+
+def parallel_simulate(attackers, defenders, processes=None, tile_size=TILE_SIZE,
+		progress=None):
+	""" Same as combat.simulate_grid(attackers, defenders) with the grid split
+	into tiles of up to tile_size attackers by tile_size defenders across a
+	pool of processes. progress, if given, is called as progress(pairs done,
+	total pairs). """
+	import numpy as np
+	from combat import ATTACKER_STATS, DEFENDER_STATS, COMBAT_STATS
+
+	rows = len(attackers[ATTACKER_STATS[0]])
+	columns = len(defenders[DEFENDER_STATS[0]])
+	tasks = []
+	for row in range(0, rows, tile_size):
+		tile_attackers = dict((s, attackers[s][row:row + tile_size]) for s in ATTACKER_STATS)
+		for column in range(0, columns, tile_size):
+			tile_defenders = dict((s, defenders[s][column:column + tile_size])
+				for s in DEFENDER_STATS)
+			tasks.append((row, column, tile_attackers, tile_defenders))
+
+	output = np.empty((rows, columns, len(COMBAT_STATS)))
+	done = [0]
+	def collect(result):
+		row, column, results = result
+		output[row:row + results.shape[0], column:column + results.shape[1]] = results
+		done[0] += results.shape[0] * results.shape[1]
+		if progress:
+			progress(done[0], rows * columns)
+
+	# The tiles carry every stat they need, so the workers load nothing.
+	_run(_simulate_task, tasks, None, processes, collect, initialize=False)
+	return output
+
+
+def _run(function, tasks, character, processes, collect, initialize=True):
+	""" Maps function over tasks on a pool whose workers load the catalog and
+	character once, unless initialize is False, passing each result to
+	collect as it arrives. """
+	if not tasks:
+		return
+	if initialize:
+		pool = multiprocessing.Pool(processes, _init_worker, (character,))
+	else:
+		pool = multiprocessing.Pool(processes)
+	try:
+		for result in pool.imap_unordered(function, tasks):
+			collect(result)
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+
+
+def _get_queued(tasks):
+	""" Yields tasks from a queue until it holds None, so a pool can be given
+	tasks which are only listed once earlier ones are done. """
+	while True:
+		task = tasks.get()
+		if task is None:
+			return
+		yield task
+
+
+def _init_worker(character, floors=None):
+	""" Loads every catalog once so no task has to parse xml. floors is the
+	Manager dict parallel_optimize shares its floors through. """
+	for source in CATALOG_SOURCES:
+		get_catalog(get_file_loc(source))
+	_worker['character'] = character
+	_worker['floors'] = floors
+	_worker['evaluators'] = {}
+	_worker['optimizers'] = {}
+
+
+def _evaluate_task(task):
+	from batch import BatchEvaluator
+
+	start, ds_name, ids = task
+	evaluators = _worker['evaluators']
+	if ds_name not in evaluators:
+		evaluators[ds_name] = BatchEvaluator(ds_name, _worker['character'])
+	return (start, evaluators[ds_name].evaluate(ids))
+
+
+def _simulate_task(task):
+	from combat import simulate_grid
+
+	row, column, attackers, defenders = task
+	return (row, column, simulate_grid(attackers, defenders))
+
+
+def _optimize_task(task):
+	""" Either splits the search of a dropsuit into parts or searches one
+	part. A part is searched from scratch with only the shared floor, so its
+	result does not depend on what else the worker has searched. """
+	from optimizer import LoadoutOptimizer
+
+	kind, ds_name, objective, required = task[:4]
+	key = (ds_name, repr(objective), required)
+	optimizers = _worker['optimizers']
+	if key not in optimizers:
+		optimizers[key] = LoadoutOptimizer(ds_name, _worker['character'],
+			objective, required)
+	optimizer = optimizers[key]
+
+	if kind == 'split':
+		# Each weapon gets its share of the tasks, its subtrees dealt out in
+		# runs so a task searches them in the order search_branch would.
+		weapons = optimizer.get_weapon_branches()
+		share = -(-task[4] // len(weapons))
+		parts = []
+		for w, weapon in enumerate(weapons):
+			subtrees = optimizer.get_subtrees(weapon)
+			run = -(-len(subtrees) // share)
+			for start in range(0, len(subtrees), run):
+				parts.append(((w, start), weapon, tuple(subtrees[start:start + run])))
+		return (kind, ds_name, parts)
+
+	order, weapon, subtrees = task[4:]
+	floors = _worker['floors']
+	floor = floors.get(ds_name)
+	optimizer.reset(floor)
+	for subtree in subtrees:
+		optimizer.search_subtree(weapon, subtree)
+	result = optimizer.get_result()
+	# Another worker may raise the floor meanwhile and have it lowered again
+	# here. A floor lower than it could be only prunes less.
+	if result is not None and (floor is None or result[0] > floor):
+		floors[ds_name] = result[0]
+	return (kind, ds_name, (order, result))
+
+
+if __name__ == '__main__':
+	import sys, time
+	from char import Character
+	from fitting import DropsuitLibrary
+
+	def show_progress(done, total):
+		sys.stdout.write('\r%s/%s' % (done, total))
+		sys.stdout.flush()
+
+	start = time.time()
+	results = parallel_optimize(DropsuitLibrary().get_names(), Character('No Skills'),
+		{'ehp': 1, 'dps': 0.5}, progress=show_progress)
+	print '\nSearched in %.2f seconds' % (time.time() - start)
+	for ds_name in sorted(results):
+		print ds_name, results[ds_name]
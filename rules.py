@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# rules.py - How module stats combine with dropsuit and weapon stats.
+# Copyright (C) 2013 Mark Wingerd <markwingerd@yahoo.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import operator
+
+# Share of a modifier that still applies, by how many stronger modifiers of the
+# same stacking group are already fitted.
+STACKING_PENALTY = (1, 0.87, 0.57, 0.28, 0.105, 0.03)
+
+# How the modifiers of a stat combine with it.
+ADD = 'add' # The stat plus every modifier.
+MULTIPLY = 'multiply' # The stat times (1 + modifier) for every modifier.
+STACK = 'stack' # As MULTIPLY, strongest first with STACKING_PENALTY applied.
+
+# What a modules stat changes.
+DROPSUIT = 'dropsuit' # The dropsuits stat, from hi and low slot modules.
+ENHANCED = 'enhanced' # The stat of the weapons in the slot type a hi slot
+	# module enhances.
+
+# (stat, combine, stacking group, target) of every stat modules change. Stats
+# of a STACK rule which share a stacking group are penalized as one list of
+# modifiers, None gives the stat a group of its own. A new kind of module only
+# needs its rows here.
+RULES = (
+	('shield_hp', ADD, None, DROPSUIT),
+	('armor_hp', ADD, None, DROPSUIT),
+	('armor_repair_rate', ADD, None, DROPSUIT),
+	('movement_speed', MULTIPLY, None, DROPSUIT),
+	('shield_recharge', STACK, None, DROPSUIT),
+	('shield_recharge_delay', STACK, None, DROPSUIT),
+	('shield_depleted_recharge_delay', STACK, None, DROPSUIT),
+	('sprint_speed', STACK, None, DROPSUIT),
+	('scan_profile', STACK, None, DROPSUIT),
+	('scan_precision', STACK, None, DROPSUIT),
+	('scan_radius', STACK, None, DROPSUIT),
+	('stamina', STACK, None, DROPSUIT),
+	('damage', MULTIPLY, None, ENHANCED),
+	('rate_of_fire', MULTIPLY, None, ENHANCED),
+	('clip_size', MULTIPLY, None, ENHANCED),
+	('reload_time', MULTIPLY, None, ENHANCED),
+)
+
+
+class RulePlan:
+	""" The rules of one target compiled for evaluation. Every stat is given
+	its total and apply functions once, so working a stat out is two lookups
+	and no checking of its combine mode.
+
+	Modifiers are passed as {stat: [modifier, ...]} with each list sorted
+	strongest first, the way Fitting keeps them. """
+	def __init__(self, rules, target):
+		self.target = target
+		self.combine = {} # {stat: combine}
+		stats = []
+		groups = {}
+		for stat, combine, group, rule_target in rules:
+			if rule_target != target:
+				continue
+			if combine not in (ADD, MULTIPLY, STACK):
+				raise ValueError('Unknown combine mode %s for %s' % (combine, stat))
+			if stat in self.combine:
+				raise ValueError('More than one rule for %s' % stat)
+			self.combine[stat] = combine
+			stats.append(stat)
+			if combine == STACK:
+				groups.setdefault(group or stat, []).append(stat)
+
+		self.stats = tuple(stats)
+		self.additive = tuple([s for s in stats if self.combine[s] == ADD])
+		self.multiplicative = tuple([s for s in stats if self.combine[s] == MULTIPLY])
+		self.stacking = tuple([s for s in stats if self.combine[s] == STACK])
+		self.groups = {} # {stat: every stat penalized together with it}
+		for group in groups.values():
+			for stat in group:
+				self.groups[stat] = tuple(group)
+
+		self._total = {}
+		self._apply = {}
+		for stat in stats:
+			if self.combine[stat] == ADD:
+				self._total[stat] = _make_sum(stat)
+				self._apply[stat] = operator.add
+			elif self.combine[stat] == MULTIPLY:
+				self._total[stat] = _make_product(stat)
+				self._apply[stat] = operator.mul
+			else:
+				self._total[stat] = _make_stacking(stat, self.groups[stat])
+				self._apply[stat] = operator.mul
+
+	def get_group(self, stat):
+		""" Returns the stats whose totals change with the modifiers of stat. """
+		return self.groups.get(stat, (stat,))
+
+	def get_total(self, stat, modifiers):
+		""" Returns the sum or factor the modifiers of a stat add up to. """
+		return self._total[stat](modifiers)
+
+	def apply(self, stat, base, total):
+		""" Returns a stat with a total from get_total applied. """
+		return self._apply[stat](base, total)
+
+
+def _make_sum(stat):
+	def get_sum(modifiers):
+		return sum(modifiers.get(stat, ()))
+	return get_sum
+
+
+def _make_product(stat):
+	def get_product(modifiers):
+		output = 1
+		for m in modifiers.get(stat, ()):
+			output *= 1 + m
+		return output
+	return get_product
+
+
+def _make_stacking(stat, group):
+	def get_stacking(modifiers):
+		""" Every modifier of the group takes its penalty by how many stronger
+		ones there are, only those of stat are multiplied in. Zero
+		modifiers count as nothing. """
+		pooled = [(m, s) for s in group for m in modifiers.get(s, ()) if m]
+		if len(group) > 1:
+			pooled.sort(key=lambda pair: abs(pair[0]), reverse=True)
+		output = 1
+		for (m, s), p in zip(pooled, STACKING_PENALTY):
+			if s == stat:
+				output *= 1 + m*p
+		return output
+	return get_stacking
+
+
+# The rules compiled once for everything that evaluates a fitting.
+DROPSUIT_PLAN = RulePlan(RULES, DROPSUIT)
+WEAPON_PLAN = RulePlan(RULES, ENHANCED)
+
+
+if __name__ == '__main__':
+	for plan in (DROPSUIT_PLAN, WEAPON_PLAN):
+		print plan.target
+		for stat in plan.stats:
+			print '    {:<32} {:<10} {}'.format(stat, plan.combine[stat],
+				', '.join(plan.get_group(stat)))
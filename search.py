@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# search.py - Finds modules and weapons by name, category and stats.
+# Copyright (C) 2013 Mark Wingerd <markwingerd@yahoo.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import re
+from bisect import bisect_left, bisect_right
+
+from util import CATALOG_SOURCES, XmlRetrieval, get_catalog, get_file_loc
+
+# The shared CatalogIndex and the catalogs it was built from, see
+# get_catalog_index.
+_shared = {}
+
+# The xml files searched, in the order their items are listed.
+SEARCH_SOURCES = ('weapon.xml', 'module.xml')
+
+# Length of the pieces of a word the fuzzy match compares.
+GRAM_SIZE = 2
+
+# A word with no prefix match matches the words sharing at least this share of
+# its grams.
+FUZZY_SHARE = 0.5
+
+# A stat condition in a query, such as cpu<20 or shield_hp>=40.
+CONDITION = re.compile(r'^(\w+)(<=|>=|<|>|=)(-?[0-9.]+)$')
+OPERATORS = ('<', '<=', '>', '>=', '=')
+
+# Spaces around an operator, so cpu < 20 is read as cpu<20.
+OPERATOR_SPACE = re.compile(r'\s*(<=|>=|<|>|=)\s*')
+
+# sort:stat sorts a query by a stat, lowest first. sort:-stat highest first.
+SORT_PREFIX = 'sort:'
+
+
+class CatalogIndex:
+	""" Every module and weapon indexed for searching. Each item has an id,
+	its position in the catalog order.
+
+	Names and categories are split into lower case words kept sorted, so the
+	words starting with a prefix are a bisect away. Words no prefix matches are
+	looked up by the grams they share with the known words instead. Each
+	numeric stat has its values sorted along with the ids holding them, so a
+	range of values is two bisects. """
+	def __init__(self, sources=SEARCH_SOURCES):
+		self.names = [] # Name of each id.
+		self.sources = [] # Xml file of each id.
+		self.parents = [] # Category of each id.
+		self.ids = {} # {name: id}
+		word_ids = {} # {word: set of ids}
+		stat_values = {} # {stat: [(value, id), ...]}
+		for xml_file in sources:
+			data = XmlRetrieval(xml_file)
+			for parent in data.get_parents():
+				for child in data.get_children(parent):
+					name = child[0]
+					if name in self.ids:
+						continue
+					item_id = self.ids[name] = len(self.names)
+					self.names.append(name)
+					self.sources.append(xml_file)
+					self.parents.append(parent)
+					for word in _get_words(name) + _get_words(parent):
+						word_ids.setdefault(word, set()).add(item_id)
+					properties = data.get_target(name)[0]
+					for stat, value in properties.items():
+						if isinstance(value, float):
+							stat_values.setdefault(stat, []).append((value, item_id))
+
+		self.words = sorted(word_ids)
+		self.word_ids = [word_ids[w] for w in self.words]
+		self.grams = {} # {gram: set of positions in self.words}
+		for position, word in enumerate(self.words):
+			for gram in _get_grams(word):
+				self.grams.setdefault(gram, set()).add(position)
+
+		self.stats = {} # {stat: (sorted values, ids in the same order)}
+		self.values = {} # {stat: {id: value}}
+		for stat, pairs in stat_values.items():
+			pairs.sort()
+			self.stats[stat] = ([v for v, i in pairs], [i for v, i in pairs])
+			self.values[stat] = dict((i, v) for v, i in pairs)
+
+	def query(self, text):
+		""" Returns the names matching a query typed by the user. Words match
+		names and categories, stat conditions such as cpu<20 narrow them down
+		and sort:stat orders them, see parse_query. """
+		words, conditions, sort = parse_query(text)
+		return self.search(words, conditions, sort)
+
+	def search(self, words=(), conditions=(), sort=None):
+		""" Returns the names of the items matching every word and every
+		(stat, operator, value) condition. They are in catalog order unless
+		sort names a stat, '-stat' to put the highest first. Items without the
+		sort stat go last. """
+		matches = [self.find_word(w) for w in words]
+		matches.extend([self.find_range(*c) for c in conditions])
+		if matches:
+			matches.sort(key=len)
+			ids = set(matches[0])
+			for match in matches[1:]:
+				ids &= match
+		else:
+			ids = set(range(len(self.names)))
+
+		if sort:
+			reverse = sort.startswith('-')
+			values = self.values.get(sort.lstrip('-'), {})
+			sign = -1 if reverse else 1
+			order = sorted(ids, key=lambda i: (i not in values, sign * values.get(i, 0), i))
+		else:
+			order = sorted(ids)
+		return [self.names[i] for i in order]
+
+	def find_word(self, word):
+		""" Returns the ids with a word starting with word, or failing that
+		the ids with the words closest to it. word is one word as split by
+		parse_query. """
+		word = word.lower()
+		start = bisect_left(self.words, word)
+		# Every word starting with word sorts before word with its last letter
+		# one higher.
+		end = bisect_left(self.words, word[:-1] + chr(ord(word[-1]) + 1), start)
+		positions = range(start, end)
+		if not positions:
+			positions = self._find_fuzzy(word)
+		ids = set()
+		for position in positions:
+			ids |= self.word_ids[position]
+		return ids
+
+	def find_range(self, stat, operator, value):
+		""" Returns the ids whose stat compares to value as operator says. """
+		if operator not in OPERATORS:
+			raise ValueError('Unknown operator %s' % operator)
+		if stat not in self.stats:
+			return set()
+		values, ids = self.stats[stat]
+		if operator == '<':
+			return set(ids[:bisect_left(values, value)])
+		elif operator == '<=':
+			return set(ids[:bisect_right(values, value)])
+		elif operator == '>':
+			return set(ids[bisect_right(values, value):])
+		elif operator == '>=':
+			return set(ids[bisect_left(values, value):])
+		return set(ids[bisect_left(values, value):bisect_right(values, value)])
+
+	def get_source(self, name):
+		""" Returns the xml file of an item, or None if there is no such item. """
+		if name not in self.ids:
+			return None
+		return self.sources[self.ids[name]]
+
+	def group(self, names):
+		""" Returns {category: [name, ...]} for a list of item names, keeping
+		their order. """
+		output = {}
+		for name in names:
+			output.setdefault(self.parents[self.ids[name]], []).append(name)
+		return output
+
+	def _find_fuzzy(self, word):
+		""" Positions of the words sharing the most grams with word, if they
+		share at least FUZZY_SHARE of them. """
+		grams = _get_grams(word)
+		shared = {}
+		for gram in grams:
+			for position in self.grams.get(gram, ()):
+				shared[position] = shared.get(position, 0) + 1
+		if not shared:
+			return []
+		best = max(shared.values())
+		if best < FUZZY_SHARE * len(grams):
+			return []
+		return [p for p in shared if shared[p] == best]
+
+
+def parse_query(text):
+	""" Splits a query into (words, conditions, sort). Words are lower case
+	letters and digits, conditions are (stat, operator, value) from words such
+	as cpu<20 or cpu < 20 and sort is the stat of a sort:stat word or None. """
+	words = []
+	conditions = []
+	sort = None
+	for token in OPERATOR_SPACE.sub(r'\1', text).split():
+		condition = CONDITION.match(token)
+		if condition:
+			stat, operator, value = condition.groups()
+			try:
+				conditions.append((stat.lower(), operator, float(value)))
+				continue
+			except ValueError:
+				pass
+		if token.lower().startswith(SORT_PREFIX) and len(token) > len(SORT_PREFIX):
+			sort = token[len(SORT_PREFIX):].lower()
+		else:
+			words.extend(_get_words(token))
+	return words, conditions, sort
+
+
+def get_catalog_index():
+	""" Returns a CatalogIndex shared by every caller. It is built again once
+	any of the xml files has changed. """
+	catalogs = [get_catalog(get_file_loc(source)) for source in CATALOG_SOURCES]
+	if _shared.get('catalogs') != catalogs:
+		_shared['index'] = CatalogIndex()
+		_shared['catalogs'] = catalogs
+	return _shared['index']
+
+
+def _get_words(text):
+	""" The lower case words of a name or a category such as assault_rifles. """
+	return re.findall(r'[a-z0-9]+', text.lower())
+
+
+def _get_grams(word):
+	""" Every GRAM_SIZE long piece of a word, padded so short words and their
+	first and last letters count too. """
+	padded = ' %s ' % word
+	return set([padded[i:i + GRAM_SIZE] for i in range(max(1, len(padded) - GRAM_SIZE + 1))])
+
+
+if __name__ == '__main__':
+	import sys
+	import time
+
+	text = ' '.join(sys.argv[1:]) or 'shield cpu<40 shield_hp>20 sort:-shield_hp'
+	start = time.time()
+	index = get_catalog_index()
+	print 'Indexed %s items in %.4f seconds' % (len(index.names), time.time() - start)
+	start = time.time()
+	names = index.query(text)
+	print 'Query %r in %.6f seconds' % (text, time.time() - start)
+	for name in names:
+		print '   ', name
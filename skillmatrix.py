@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# skillmatrix.py - Applies a characters skills to the whole catalog at once.
+# Copyright (C) 2013 Mark Wingerd <markwingerd@yahoo.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+from util import CATALOG_SOURCES, XmlRetrieval, get_catalog, get_file_loc
+
+# The shared SkillMatrix and the catalogs it was built from, see get_skill_matrix.
+_shared = {}
+
+# Items in these files combine their skills the way Module does, a floored sum.
+# Dropsuits multiply theirs together and round to three places.
+ADDITIVE_SOURCES = ('module.xml', 'weapon.xml')
+MULTIPLICATIVE_SOURCES = ('dropsuit.xml',)
+
+
+class SkillMatrix:
+	""" Every numeric stat of every dropsuit, module and weapon as one row of a
+	matrix over the skills in skills.xml, holding how many times the skill
+	effects that stat. Applying a character to the modules and weapons is then
+	one matrix product, floor(base * (1 + matrix . effects)).
+
+	Dropsuits multiply their skills together and round to three places, where
+	a product through log1p would be off in the last place. Their rows instead
+	list the skills to multiply, in the order Dropsuit multiplies them. Either
+	way the stats are the same as Module and Dropsuit give. Effects are a
+	vector of skill effects, see get_effects, or an N x skills array of them. """
+	def __init__(self):
+		skill_data = XmlRetrieval('skills.xml')
+		self.skills = []
+		self.skill_ids = {}
+		effect = []
+		for name in skill_data.get_list():
+			if name not in self.skill_ids:
+				self.skill_ids[name] = len(self.skills)
+				self.skills.append(name)
+				effect.append(skill_data.get_target(name)[0]['effect'])
+		self.effect = np.array(effect)
+
+		self.rows = {} # {(xml file, item name): {stat: row}}
+		self.row_keys = [] # (xml file, item name, stat) of each row.
+		base = []
+		multiplicative = []
+		skilled = []
+		coefficients = []
+		factors = [] # Skill ids multiplied into each row.
+		for xml_file in ADDITIVE_SOURCES + MULTIPLICATIVE_SOURCES:
+			data = XmlRetrieval(xml_file)
+			for name in data.get_list():
+				if (xml_file, name) in self.rows:
+					continue
+				properties, effecting_skills = data.get_target(name)
+				stats = self.rows[(xml_file, name)] = {}
+				for stat in sorted(properties):
+					if not isinstance(properties[stat], float):
+						continue
+					row = np.zeros(len(self.skills))
+					skill_ids = []
+					for skill in effecting_skills.get(stat, ()):
+						if skill in self.skill_ids:
+							row[self.skill_ids[skill]] += 1
+							skill_ids.append(self.skill_ids[skill])
+					stats[stat] = len(self.row_keys)
+					self.row_keys.append((xml_file, name, stat))
+					base.append(properties[stat])
+					multiplicative.append(xml_file in MULTIPLICATIVE_SOURCES)
+					skilled.append(stat in effecting_skills)
+					coefficients.append(row)
+					factors.append(skill_ids)
+
+		self.base = np.array(base)
+		self.multiplicative = np.array(multiplicative)
+		self.skilled = np.array(skilled)
+		self.matrix = np.array(coefficients) * ~self.multiplicative[:, np.newaxis]
+
+		# Padded with an extra skill id whose effect is always 0.
+		width = max([len(f) for f in factors] + [1])
+		self.factor_skills = np.empty((len(factors), width), dtype=int)
+		self.factor_skills.fill(len(self.skills))
+		for row, skill_ids in enumerate(factors):
+			if self.multiplicative[row]:
+				self.factor_skills[row, :len(skill_ids)] = skill_ids
+
+	def get_effects(self, character, added=None):
+		""" Returns a characters skill effects as a vector. added, an array of
+		extra levels per skill, gives one row of effects for each of its rows. """
+		levels = np.array([character.get_skill_level(s) for s in self.skills])
+		if added is not None:
+			levels = levels + np.asarray(added)
+		return levels * self.effect
+
+	def apply(self, effects, rows=None):
+		""" Returns every rows skilled value for a vector of effects, or an
+		N x rows array for N x skills effects. If rows is given only those rows
+		are worked out, in that order. """
+		effects = np.asarray(effects, dtype=float)
+		if rows is None:
+			rows = np.arange(len(self.base))
+		rows = np.asarray(rows, dtype=int)
+		base = self.base[rows]
+		values = np.dot(effects, self.matrix[rows].T)
+		values = np.where(self.skilled[rows], np.floor(base * (1 + values)), base)
+
+		multiplicative = np.flatnonzero(self.multiplicative[rows])
+		if len(multiplicative):
+			padded = np.concatenate([effects, np.zeros(effects.shape[:-1] + (1,))], axis=-1)
+			factor = 1
+			for column in self.factor_skills[rows[multiplicative]].T:
+				factor = factor * (1 + padded[..., column])
+			values[..., multiplicative] = _round(base[multiplicative] * factor, 3)
+		return values
+
+	def get_row(self, xml_file, name, stat):
+		return self.rows[(xml_file, name)][stat]
+
+	def get_skills(self, rows):
+		""" Returns the names of the skills which effect any of rows. """
+		rows = np.asarray(rows, dtype=int)
+		used = self.matrix[rows].any(axis=0)
+		for skill_id in self.factor_skills[rows].flat:
+			if skill_id < len(self.skills):
+				used[skill_id] = True
+		return [self.skills[i] for i in np.flatnonzero(used)]
+
+	def get_stats(self, values, xml_file, name):
+		""" Returns {stat: value} of one item from the result of apply. Only
+		numeric stats are included. """
+		return dict((stat, values.T[row])
+			for stat, row in self.rows[(xml_file, name)].items())
+
+
+def get_skill_matrix():
+	""" Returns a SkillMatrix shared by every caller. It is built again once any
+	of the xml files has changed. """
+	catalogs = [get_catalog(get_file_loc(source)) for source in CATALOG_SOURCES]
+	if _shared.get('catalogs') != catalogs:
+		_shared['matrix'] = SkillMatrix()
+		_shared['catalogs'] = catalogs
+	return _shared['matrix']
+
+
+def _round(values, digits):
+	""" The builtin round for each value, which rounds the exact binary value
+	where numpy would round the scaled one. """
+	return np.frompyfunc(round, 2, 1)(values, digits).astype(float)
+
+
+if __name__ == '__main__':
+	import time
+	from char import Character
+
+	character = Character('Example')
+	character.set_skill('Weaponry', 5)
+	character.set_skill('Shield Control', 3)
+
+	start = time.time()
+	matrix = get_skill_matrix()
+	print 'Compiled %s rows in %.3f seconds' % (len(matrix.row_keys), time.time() - start)
+	start = time.time()
+	values = matrix.apply(matrix.get_effects(character))
+	print 'Applied in %.5f seconds' % (time.time() - start)
+	print matrix.get_stats(values, 'weapon.xml', 'Assault Rifle')
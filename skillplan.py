@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# skillplan.py - Finds the skill levels worth training for a fitting.
+# Copyright (C) 2013 Mark Wingerd <markwingerd@yahoo.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+from batch import (BATCH_STATS, SLOT_TYPES, ITEM_STATS, ADDITIVE_STATS,
+	MULTIPLICATIVE_STATS, STACKING_STATS, EMPTY, CHUNK_SIZE, evaluate_columns)
+from optimizer import get_weights
+from skillmatrix import get_skill_matrix
+from util import XmlRetrieval
+
+MAX_LEVEL = 5
+
+# Dropsuit stats evaluate_columns reads.
+DROPSUIT_STATS = ('cpu', 'pg') + ADDITIVE_STATS + MULTIPLICATIVE_STATS + STACKING_STATS
+
+# Plans are all enumerated when there are at most this many, otherwise a beam
+# search adding one level at a time keeps this many partial plans.
+MAX_PLANS = 200000
+BEAM_WIDTH = 64
+
+
+class SkillPlanner:
+	""" Scores a fitting for many sets of extra skill levels at once. Item and
+	dropsuit stats come from a SkillMatrix, so no Fitting is rebuilt per
+	candidate.
+
+	The objective is one of optimizer.OBJECTIVES or a dict of {metric: weight}. """
+	def __init__(self, fit, objective='ehp'):
+		self.fit = fit
+		self.character = fit.char
+		self.weights = get_weights(objective)
+		self.matrix = get_skill_matrix()
+		self.max_slots = np.array([fit.dropsuit.stats[s] for s in SLOT_TYPES])
+
+		# Matrix rows of the dropsuit stats, then of each item stat, with the
+		# items in the order change_character would refit them.
+		self.rows = [self.matrix.get_row('dropsuit.xml', fit.ds_name, stat)
+			for stat in DROPSUIT_STATS]
+		self.item_stats = [] # (column, stat) of each item row.
+		slots = []
+		enhances = []
+		items = [('module.xml', m) for m in fit.hi_slot + fit.low_slot + fit.equipment] + \
+			[('weapon.xml', w) for w in fit.heavy_weapon + fit.light_weapon + fit.sidearm + fit.grenade]
+		for column, (xml_file, item) in enumerate(items):
+			properties, effecting_skills = XmlRetrieval(xml_file).get_target(item.name)
+			slots.append(SLOT_TYPES.index(properties['slot_type']))
+			if properties.get('enhances') in SLOT_TYPES:
+				enhances.append(SLOT_TYPES.index(properties['enhances']))
+			else:
+				enhances.append(EMPTY)
+			stats = self.matrix.rows[(xml_file, item.name)]
+			for stat in ITEM_STATS:
+				if stat in stats:
+					self.item_stats.append((column, stat))
+					self.rows.append(stats[stat])
+		self.slots = np.array(slots, dtype=int)
+		self.enhances = np.array(enhances, dtype=int)
+
+		self.skills = [s for s in self.matrix.get_skills(self.rows)
+			if self.character.get_skill_level(s) < MAX_LEVEL]
+		self.skill_ids = [self.matrix.skill_ids[s] for s in self.skills]
+
+	def get_score(self, added):
+		""" Returns the objective score for each row of an N x len(self.skills)
+		array of extra levels. """
+		output = self.evaluate(added)
+		stat = dict((s, output[:, i]) for i, s in enumerate(BATCH_STATS))
+		return self.weights['ehp'] * (stat['shield_hp'] + stat['armor_hp']) + \
+			self.weights['dps'] * stat['primary_dps'] + \
+			self.weights['sprint_speed'] * stat['sprint_speed']
+
+	def evaluate(self, added):
+		""" Returns an N x len(BATCH_STATS) array of the fittings stats for each
+		row of extra levels. A single row may be given as a list. """
+		added = np.asarray(added, dtype=int)
+		if added.ndim == 1:
+			added = added.reshape(1, -1)
+		output = np.empty((len(added), len(BATCH_STATS)))
+		for start in range(0, len(added), CHUNK_SIZE):
+			output[start:start + CHUNK_SIZE] = self._evaluate(added[start:start + CHUNK_SIZE])
+		return output
+
+	def plan(self, levels, count=1):
+		""" Returns up to count (gain, {skill: levels to train}) pairs, best
+		first, for training levels more skill levels. With no skill left to
+		train the only plan is (0, {}). """
+		capacity = self._get_capacity()
+		levels = min(levels, int(capacity.sum()))
+		current = self.get_score(np.zeros((1, len(self.skills))))[0]
+
+		if _count_plans(capacity, levels) <= MAX_PLANS:
+			plans = _enumerate_plans(capacity, levels)
+			scores = self.get_score(plans)
+		else:
+			plans, scores = self._beam_search(capacity, levels)
+
+		order = np.argsort(-scores, kind='mergesort')[:count]
+		output = []
+		for row in order:
+			training = dict((self.skills[i], int(n))
+				for i, n in enumerate(plans[row]) if n)
+			output.append((scores[row] - current, training))
+		return output
+
+	def _evaluate(self, added):
+		levels = np.zeros((len(added), len(self.matrix.skills)), dtype=int)
+		levels[:, self.skill_ids] = added
+		effects = self.matrix.get_effects(self.character, levels)
+		values = self.matrix.apply(effects, self.rows)
+
+		rows = len(added)
+		width = len(self.slots)
+		base = dict((stat, values[:, i]) for i, stat in enumerate(DROPSUIT_STATS))
+		columns = dict((stat, np.zeros((rows, width))) for stat in ITEM_STATS)
+		for i, (column, stat) in enumerate(self.item_stats):
+			columns[stat][:, column] = values[:, len(DROPSUIT_STATS) + i]
+		slots = np.repeat(self.slots[np.newaxis], rows, axis=0)
+		enhances = np.repeat(self.enhances[np.newaxis], rows, axis=0)
+
+		return evaluate_columns(columns, slots, enhances, base, self.max_slots)
+
+	def _get_capacity(self):
+		return np.array([MAX_LEVEL - self.character.get_skill_level(s)
+			for s in self.skills], dtype=int)
+
+	def _beam_search(self, capacity, levels):
+		""" Adds one level at a time to the best BEAM_WIDTH partial plans. """
+		plans = np.zeros((1, len(self.skills)), dtype=int)
+		for step in range(levels):
+			grown = plans[:, np.newaxis, :] + np.eye(len(self.skills), dtype=int)
+			grown = grown.reshape(-1, len(self.skills))
+			grown = grown[(grown <= capacity).all(axis=1)]
+			grown = _unique_rows(grown)
+			scores = self.get_score(grown)
+			keep = np.argsort(-scores, kind='mergesort')[:BEAM_WIDTH]
+			plans = grown[keep]
+		return plans, scores[keep]
+
+
+def _count_plans(capacity, levels):
+	""" Number of ways to spread levels over skills with the given capacities. """
+	ways = [1] + [0] * levels
+	for cap in capacity:
+		ways = [sum(ways[max(0, total - cap):total + 1]) for total in range(levels + 1)]
+	return ways[levels]
+
+
+def _enumerate_plans(capacity, levels):
+	""" Returns every way to spread exactly levels over skills with the given
+	capacities as rows. """
+	plans = np.zeros((1, 0), dtype=int)
+	totals = np.zeros(1, dtype=int)
+	for i, cap in enumerate(capacity):
+		left = int(capacity[i + 1:].sum())
+		rows = []
+		for n in range(cap + 1):
+			keep = (totals + n <= levels) & (totals + n + left >= levels)
+			if keep.any():
+				grown = np.empty((keep.sum(), i + 1), dtype=int)
+				grown[:, :i] = plans[keep]
+				grown[:, i] = n
+				rows.append(grown)
+		plans = np.concatenate(rows)
+		totals = plans.sum(axis=1)
+	return plans
+
+
+def _unique_rows(rows):
+	""" Removes duplicate rows, keeping the first of each. """
+	seen = set()
+	keep = []
+	for i, row in enumerate(rows):
+		key = tuple(row)
+		if key not in seen:
+			seen.add(key)
+			keep.append(i)
+	return rows[keep]
+
+
+if __name__ == '__main__':
+	import sys
+	from char import Character
+	from fitting import Fitting
+
+	levels = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+	fit = Fitting('Plan', Character('No Skills'), 'Assault Type-I')
+	for name in ('Complex Shield Extender', 'Complex Light Damage Modifier',
+			'Basic Armor Plates', 'Assault Rifle'):
+		if name == 'Assault Rifle':
+			fit.add_weapon(name)
+		else:
+			fit.add_module(name)
+	for gain, training in SkillPlanner(fit, {'ehp': 1, 'dps': 1}).plan(levels, 5):
+		print round(gain, 2), training
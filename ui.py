@@ -1,13 +1,28 @@
+import sys
+import threading
+import time
+import traceback
+import Queue
 from Tkinter import *
 import ttk
 import tkFont
+import tkMessageBox
 
-from fitting import Fitting, DropsuitLibrary, Dropsuit, FittingLibrary
+from fitting import (Fitting, DropsuitLibrary, Dropsuit, FittingLibrary,
+    FittingStats, DISPLAY_SLOTS)
 from module import ModuleLibrary, Module, WeaponLibrary, Weapon
 from char import Character, CharacterLibrary, Skills
+from search import get_catalog_index
+from util import SaveWriter
 
 __application_name__ = 'Dust Fitting Tool'
 
+# Milliseconds between checks of the save status.
+STATUS_POLL = 250
+
+# Milliseconds between checks for startup stages the loader has finished.
+LOAD_POLL = 20
+
 
 class DftUi(Frame):
     """ This is the Main Window for the Dust Fitting Tool. """
@@ -15,20 +30,116 @@ class DftUi(Frame):
         # Main window initialization.
         Frame.__init__(self, parent)
         self.parent = parent
-        self.character_library = CharacterLibrary()
-        self.fitting_library = FittingLibrary()
-        self.weapon_library = WeaponLibrary()
-        self.module_library = ModuleLibrary()
-        self.current_char = Character('No Skills')
-        self.current_fit = self.fitting_library.get_fitting(self.fitting_library.get_fitting_list()[0])
-
-        # Call pertinent methods to display main window.
+        self.started = time.time()
+        self.startup_times = {} # {'first_paint' or 'interactive': seconds}
+        self.ready_text = None # Shown in the status bar until the first save.
+        # Saves are written by a background thread. Every window shares the
+        # libraries so they all see changes which are not written yet.
+        self.writer = SaveWriter()
+        self.current_char = None
+        self.current_fit = None
+
+        # Call pertinent methods to display main window. The widgets start out
+        # empty and are filled as load_libraries finishes each stage.
         self.menubar_main()
         self.combobox_character()
         self.combobox_fitting()
         self.tree_modules()
         self.fitting_display()
         self.stats_display()
+        self.status_display()
+
+        # The catalogs and libraries are loaded on a worker thread while the
+        # window is drawn. Its results come back through poll_loader.
+        self.loaded = Queue.Queue()
+        loader = threading.Thread(target=self.load_libraries)
+        loader.daemon = True
+        loader.start()
+        self.after_idle(self.first_paint)
+        self.after(LOAD_POLL, self.poll_loader)
+
+        # Unsaved changes are written before the window closes.
+        self.parent.protocol('WM_DELETE_WINDOW', self.close)
+
+    def load_libraries(self):
+        """ Runs on the loader thread. Each stage is put on self.loaded as
+        (stage, results), nothing here may touch a widget. """
+        try:
+            self.loaded.put(('catalogs',
+                (WeaponLibrary(), ModuleLibrary(), get_catalog_index())))
+            character_library = CharacterLibrary(self.writer)
+            fitting_library = FittingLibrary(character_library, self.writer)
+            character = Character('No Skills')
+            fitting = fitting_library.get_fitting(fitting_library.get_fitting_list()[0])
+            self.loaded.put(('libraries',
+                (character_library, fitting_library, character, fitting)))
+        except Exception:
+            self.loaded.put(('error', sys.exc_info()))
+
+    def poll_loader(self):
+        """ Shows every stage the loader has finished, until the window is
+        interactive. If loading failed the error is shown and the application
+        closes, there is nothing it can do without its libraries. """
+        while True:
+            try:
+                stage, results = self.loaded.get_nowait()
+            except Queue.Empty:
+                break
+            if stage == 'error':
+                traceback.print_exception(*results)
+                tkMessageBox.showerror('Loading failed',
+                    'The libraries could not be loaded: %s' % results[1],
+                    parent=self.parent)
+                self.close()
+                return
+            elif stage == 'catalogs':
+                self.show_catalogs(*results)
+            elif stage == 'libraries':
+                self.show_libraries(*results)
+        if 'interactive' not in self.startup_times:
+            self.after(LOAD_POLL, self.poll_loader)
+
+    def show_catalogs(self, weapon_library, module_library, search_index):
+        """ First stage, the module tree can be browsed and searched. """
+        self.weapon_library = weapon_library
+        self.module_library = module_library
+        self.search_index = search_index
+        self.fill_modules()
+        self.ent_filter.configure(state=NORMAL)
+
+    def show_libraries(self, character_library, fitting_library, character, fitting):
+        """ Last stage, the first fitting is shown and everything is enabled. """
+        self.character_library = character_library
+        self.fitting_library = fitting_library
+        self.current_char = character
+        self.cbx_character.configure(values=character_library.get_character_list(),
+            state=NORMAL)
+        self.cbx_character.set(character.name)
+        self.cbx_fitting.configure(values=fitting_library.get_fitting_list(),
+            state=NORMAL)
+        self.set_fitting(fitting)
+        for menu in (self.mnu_file, self.mnu_edit):
+            for index in range(menu.index(END) + 1):
+                if menu.type(index) == 'command':
+                    menu.entryconfigure(index, state=NORMAL)
+
+        self.startup_times['interactive'] = time.time() - self.started
+        self.show_ready()
+
+    def first_paint(self):
+        """ Called once the event loop is first idle. Drawing the window is
+        itself idle work, so it is finished first. """
+        self.update_idletasks()
+        self.startup_times['first_paint'] = time.time() - self.started
+        self.show_ready()
+
+    def show_ready(self):
+        """ Sets the startup times shown by update_status, once both are known.
+        The window may be painted before or after the loader is done. """
+        if len(self.startup_times) == 2:
+            self.ready_text = 'First paint %.2fs, ready in %.2fs' % (
+                self.startup_times['first_paint'],
+                self.startup_times['interactive'])
 
     def menubar_main(self):
         """ Displays and manages the upper menubar. """
@@ -37,31 +148,35 @@ class DftUi(Frame):
         self.parent.config(menu=menubar)
         self.parent.option_add('*tearOff', False)
 
-        # First menu contents
-        fileMenu = Menu(menubar)
-        fileMenu.add_command(label='New Dropsuit', command=self.new_dropsuit_window)
-        fileMenu.add_command(label='New Vehicle')
-        fileMenu.add_command(label='New Character', command=self.add_character_window)
-        editMenu = Menu(menubar)
-        editMenu.add_command(label='Edit Character', command=self.edit_character_window)
-        editMenu.add_command(label='Delete Character', command=self.delete_character_window)
-        editMenu.add_command(label='Delete Fitting', command=self.delete_fitting_window)
+        # First menu contents. Disabled until the libraries are loaded.
+        self.mnu_file = fileMenu = Menu(menubar)
+        fileMenu.add_command(label='New Dropsuit', command=self.new_dropsuit_window, state=DISABLED)
+        fileMenu.add_command(label='New Vehicle', state=DISABLED)
+        fileMenu.add_command(label='New Character', command=self.add_character_window, state=DISABLED)
+        self.mnu_edit = editMenu = Menu(menubar)
+        editMenu.add_command(label='Undo', accelerator='Ctrl+Z', command=self.undo, state=DISABLED)
+        editMenu.add_command(label='Redo', accelerator='Ctrl+Y', command=self.redo, state=DISABLED)
+        editMenu.add_separator()
+        editMenu.add_command(label='Edit Character', command=self.edit_character_window, state=DISABLED)
+        editMenu.add_command(label='Delete Character', command=self.delete_character_window, state=DISABLED)
+        editMenu.add_command(label='Delete Fitting', command=self.delete_fitting_window, state=DISABLED)
 
         # Add the menus
         menubar.add_cascade(label='File', menu=fileMenu)
         menubar.add_cascade(label='Edit', menu=editMenu)
 
-    def combobox_character(self):
-        """ Displays and manages the character selection for the main window. """
-        # Get known characters.  API calls or data retrieval here.
-        character_names = self.character_library.get_character_list()
+        # Bindings
+        self.parent.bind('<Control-z>', self.undo)
+        self.parent.bind('<Control-y>', self.redo)
 
+    def combobox_character(self):
+        """ Displays and manages the character selection for the main window.
+        The known characters are filled in by show_libraries. """
         # Creates the Combobox which has all known characters and automatically
         # selects the first character. Also other widgets.
         frm_character = Frame(self)
         lbl_character = Label(frm_character, text='Character:')
-        self.cbx_character = ttk.Combobox(frm_character, values=character_names, width=14)
-        self.cbx_character.set('No Skills')
+        self.cbx_character = ttk.Combobox(frm_character, width=14, state=DISABLED)
 
         # Grid management.
         frm_character.grid(column=0, row=0)
@@ -73,15 +188,11 @@ class DftUi(Frame):
 
     def combobox_fitting(self):
         """ Displays and manages the current fitting to be displayed on the
-        main window. """
-        # Get known fits. API calls or data retrieval here.
-        fitting_names = self.fitting_library.get_fitting_list()
-
+        main window. The known fits are filled in by show_libraries. """
         # Creates nessessary widgets.
         frm_fitting = Frame(self)
         lbl_fitting = Label(frm_fitting, text='Fitting:')
-        self.cbx_fitting = ttk.Combobox(frm_fitting, values=fitting_names)
-        self.cbx_fitting.set(self.current_fit.name)
+        self.cbx_fitting = ttk.Combobox(frm_fitting, state=DISABLED)
 
         # Grid management.
         frm_fitting.grid(column=1, row=0)
@@ -92,8 +203,11 @@ class DftUi(Frame):
         self.cbx_fitting.bind('<<ComboboxSelected>>', self.change_fitting)
 
     def tree_modules(self):
-        """ """
+        """ Creates the module tree, empty until fill_modules, and the box
+        filtering it. """
         frm_modules = Frame(self)
+        self.filter_text = StringVar()
+        self.ent_filter = Entry(frm_modules, textvariable=self.filter_text, bg='white', state=DISABLED)
         self.tre_modules = ttk.Treeview(frm_modules, height=14, columns=('cpu', 'pg'))
         scb_modules = Scrollbar(frm_modules, orient=VERTICAL, command=self.tre_modules.yview)
         self.tre_modules.column('#0', width=150, minwidth=150)
@@ -101,36 +215,52 @@ class DftUi(Frame):
         self.tre_modules.column('pg', width=30, minwidth=30)
         self.tre_modules.heading('cpu', text='CPU')
         self.tre_modules.heading('pg', text='PG')
-        for parent in self.weapon_library.get_parents():
-            self.tre_modules.insert('', 'end', parent, text=parent, tag='ttk')
-            for child in self.weapon_library.get_children(parent):
-                self.tre_modules.insert(parent, 'end', child[0], text=child[0], tag='ttk')
-                self.tre_modules.set(child[0], 'cpu', child[1])
-                self.tre_modules.set(child[0], 'pg', child[2])
-        for parent in self.module_library.get_parents():
-            self.tre_modules.insert('', 'end', parent, text=parent, tag='ttk')
-            for child in self.module_library.get_children(parent):
-                self.tre_modules.insert(parent, 'end', child[0], text=child[0], tag='ttk')
-                self.tre_modules.set(child[0], 'cpu', child[1])
-                self.tre_modules.set(child[0], 'pg', child[2])
 
         # Grid management.
         frm_modules.grid(column=0, row=1)
-        self.tre_modules.grid(column=0, row=0, sticky=NW, padx=3, pady=3)
-        scb_modules.grid(column=1, row=0, sticky=NE+S, pady=4)
+        self.ent_filter.grid(column=0, row=0, columnspan=2, sticky=EW, padx=3)
+        self.tre_modules.grid(column=0, row=1, sticky=NW, padx=3, pady=3)
+        scb_modules.grid(column=1, row=1, sticky=NE+S, pady=4)
         self.tre_modules.configure(yscrollcommand=scb_modules.set)
 
         # Bindings
         self.tre_modules.bind('<Double-1>', self.add_module)
+        self.filter_text.trace('w', self.filter_modules)
+
+    def filter_modules(self, *args):
+        """ Shows only the items matching the filter box as it is typed in,
+        see search.CatalogIndex.query. An empty box shows everything. """
+        text = self.filter_text.get()
+        if not text.strip():
+            self.lazy_modules.show_only(None)
+        else:
+            names = self.search_index.query(text)
+            self.lazy_modules.show_only(self.search_index.group(names))
+
+    def fill_modules(self):
+        """ Inserts the weapon and module categories. Only the categories are
+        inserted, their items are when one is opened. """
+        libraries = {} # {category: library holding its items}
+        for library in (self.weapon_library, self.module_library):
+            for parent in library.get_parents():
+                libraries[parent] = library
+        def get_children(parent):
+            return libraries[parent].get_children(parent)
+        def insert_child(parent, child):
+            self.tre_modules.insert(parent, 'end', child[0], text=child[0],
+                tag='ttk', values=(child[1], child[2]))
+        self.lazy_modules = LazyTree(self.tre_modules,
+            self.weapon_library.get_parents() + self.module_library.get_parents(),
+            get_children, insert_child)
 
     def fitting_display(self):
-        """ Displays all the current fitting information. """
-        # Set variables.
-        fitting_list = StringVar(value=self.current_fit.get_all_modules())
+        """ Creates the list of fitted items. Its rows are kept current by
+        show_slots. """
+        self.slot_rows = {} # {slot type: rows shown}
 
         # Creates the widgets needed for this display.
         frm_fitting_display = Frame(self, height=300)
-        self.lbx_fitting = Listbox(frm_fitting_display, listvariable=fitting_list, width=48, height=20, font='TkFixedFont', bg='white')
+        self.lbx_fitting = Listbox(frm_fitting_display, width=48, height=20, font='TkFixedFont', bg='white')
 
         # Grid management.
         frm_fitting_display.grid(column=1, row=1, sticky=W+E+N+S)
@@ -140,12 +270,14 @@ class DftUi(Frame):
         self.lbx_fitting.bind('<Double-1>', self.remove_module)
 
     def stats_display(self):
-        """ Displays fitting stats. """
+        """ Creates the fitting stats. Every value is a StringVar set by
+        show_stats, so the labels are only made once. """
         # Initialize variables.
-        cpu_text = '%s/%s' % (self.current_fit.current_cpu, self.current_fit.max_cpu)
-        pg_text = '%s/%s' % (self.current_fit.current_pg, self.current_fit.max_pg)
-        cpu_over = self.current_fit.get_cpu_over()
-        pg_over = self.current_fit.get_pg_over()
+        self.stat_vars = dict((field, StringVar()) for field in FittingStats._fields)
+        self.stat_vars['ds_name'] = StringVar()
+        self.stat_vars['cpu'] = StringVar()
+        self.stat_vars['pg'] = StringVar()
+        var = self.stat_vars
 
         # Creates the holding widgets.
         nbk_stats = ttk.Notebook(self)
@@ -154,30 +286,30 @@ class DftUi(Frame):
         nbk_stats.add(frm_overview, text='Overview')
         # Creates widgets for Dropsuit Type.
         lfr_dropsuit_type = ttk.Labelframe(frm_overview, text='Dropsuit Type:')
-        lbl_dropsuit_type = Label(lfr_dropsuit_type, text=self.current_fit.ds_name).grid(column=0, row=0)
+        lbl_dropsuit_type = Label(lfr_dropsuit_type, textvariable=var['ds_name']).grid(column=0, row=0)
         # Creates widgets for Resources.
         lfr_resources = ttk.Labelframe(frm_overview, text='Resources')
         lbl_cpu1 = Label(lfr_resources, text='CPU:').grid(column=0, row=0, sticky=W)
-        lbl_cpu2 = Label(lfr_resources, text=cpu_text).grid(column=1, row=0)
+        lbl_cpu2 = Label(lfr_resources, textvariable=var['cpu']).grid(column=1, row=0)
         lbl_pg1 = Label(lfr_resources, text='PG:').grid(column=2, row=0, sticky=W, padx=10)
-        lbl_pg2 = Label(lfr_resources, text=pg_text).grid(column=3, row=0)
-        lbl_cpu3 = Label(lfr_resources, text=cpu_over).grid(column=1, row=1, sticky=E)
-        lbl_pg3 = Label(lfr_resources, text=pg_over).grid(column=3, row=1, sticky=E)
+        lbl_pg2 = Label(lfr_resources, textvariable=var['pg']).grid(column=3, row=0)
+        lbl_cpu3 = Label(lfr_resources, textvariable=var['cpu_over']).grid(column=1, row=1, sticky=E)
+        lbl_pg3 = Label(lfr_resources, textvariable=var['pg_over']).grid(column=3, row=1, sticky=E)
         lfr_resources.columnconfigure(0, minsize=30)
         lfr_resources.columnconfigure(1, minsize=90)
         lfr_resources.columnconfigure(2, minsize=20)
         lfr_resources.columnconfigure(3, minsize=75)
         # Creates widgets for main offenses.
         lfr_offenses = ttk.Labelframe(frm_overview, text='Main Offense')
-        lbl_weapon = Label(lfr_offenses, text=self.current_fit.get_primary_weapon_name()).grid(column=0, row=0, columnspan=4)
+        lbl_weapon = Label(lfr_offenses, textvariable=var['primary_weapon']).grid(column=0, row=0, columnspan=4)
         lbl_dmg1 = Label(lfr_offenses, text='Damage: ').grid(column=0, row=1, sticky=W)
-        lbl_dmg2 = Label(lfr_offenses, text=self.current_fit.get_primary_stats('damage')).grid(column=1, row=1, sticky=E)
+        lbl_dmg2 = Label(lfr_offenses, textvariable=var['damage']).grid(column=1, row=1, sticky=E)
         lbl_rof1 = Label(lfr_offenses, text='RoF:').grid(column=2, row=1, sticky=W, padx=10)
-        lbl_rof2 = Label(lfr_offenses, text=self.current_fit.get_primary_stats('rate_of_fire')).grid(column=3, row=1, sticky=E)
+        lbl_rof2 = Label(lfr_offenses, textvariable=var['rate_of_fire']).grid(column=3, row=1, sticky=E)
         lbl_dps1 = Label(lfr_offenses, text='DPS: ').grid(column=0, row=2, sticky=W)
-        lbl_dps2 = Label(lfr_offenses, text=self.current_fit.get_primary_dps()).grid(column=1, row=2, sticky=E)
+        lbl_dps2 = Label(lfr_offenses, textvariable=var['dps']).grid(column=1, row=2, sticky=E)
         lbl_dpm1 = Label(lfr_offenses, text='DPMag: ').grid(column=2, row=2, sticky=W, padx=10)
-        lbl_dpm2 = Label(lfr_offenses, text=self.current_fit.get_primary_dpm()).grid(column=3, row=2, sticky=E)
+        lbl_dpm2 = Label(lfr_offenses, textvariable=var['dpm']).grid(column=3, row=2, sticky=E)
         lfr_offenses.columnconfigure(0, minsize=60)
         lfr_offenses.columnconfigure(1, minsize=45)
         lfr_offenses.columnconfigure(2, minsize=60)
@@ -185,13 +317,13 @@ class DftUi(Frame):
         # Creates widgets for Defenses.
         lfr_defenses = ttk.Labelframe(frm_overview, text='Defenses')
         lbl_shield1 = Label(lfr_defenses, text='Shield HP:').grid(column=0, row=0, sticky=W)
-        lbl_shield2 = Label(lfr_defenses, text=self.current_fit.get_shield_hp()).grid(column=1, row=0, sticky=E)
+        lbl_shield2 = Label(lfr_defenses, textvariable=var['shield_hp']).grid(column=1, row=0, sticky=E)
         lbl_recharge1 = Label(lfr_defenses, text='Recharge:').grid(column=2, row=0, sticky=W, padx=10)
-        lbl_recharge2 = Label(lfr_defenses, text=self.current_fit.get_shield_recharge()).grid(column=3, row=0, sticky=E)
+        lbl_recharge2 = Label(lfr_defenses, textvariable=var['shield_recharge']).grid(column=3, row=0, sticky=E)
         lbl_armor1 = Label(lfr_defenses, text='Armor HP:').grid(column=0, row=1, sticky=W)
-        lbl_armor2 = Label(lfr_defenses, text=self.current_fit.get_armor_hp()).grid(column=1, row=1, sticky=E)
+        lbl_armor2 = Label(lfr_defenses, textvariable=var['armor_hp']).grid(column=1, row=1, sticky=E)
         lbl_repair1 = Label(lfr_defenses, text='Repair:').grid(column=2, row=1, sticky=W, padx=10)
-        lbl_repair2 = Label(lfr_defenses, text=self.current_fit.get_armor_repair_rate()).grid(column=3, row=1, sticky=E)
+        lbl_repair2 = Label(lfr_defenses, textvariable=var['armor_repair_rate']).grid(column=3, row=1, sticky=E)
         lfr_defenses.columnconfigure(0, minsize=70)
         lfr_defenses.columnconfigure(1, minsize=50)
         lfr_defenses.columnconfigure(2, minsize=70)
@@ -199,11 +331,11 @@ class DftUi(Frame):
         # Creates widgets for Sensors.
         lfr_sensors = ttk.Labelframe(frm_overview, text='Sensors')
         lbl_prof1 = Label(lfr_sensors, text='Scan Profile: ').grid(column=0, row=0, sticky=W)
-        lbl_prof2 = Label(lfr_sensors, text=self.current_fit.get_scan_profile()).grid(column=1, row=0, sticky=E)
+        lbl_prof2 = Label(lfr_sensors, textvariable=var['scan_profile']).grid(column=1, row=0, sticky=E)
         lbl_prec1 = Label(lfr_sensors, text='Scan Precision: ').grid(column=0, row=1, sticky=W)
-        lbl_prec2 = Label(lfr_sensors, text=self.current_fit.get_scan_precision()).grid(column=1, row=1, sticky=E)
+        lbl_prec2 = Label(lfr_sensors, textvariable=var['scan_precision']).grid(column=1, row=1, sticky=E)
         lbl_radi1 = Label(lfr_sensors, text='Scan Radius: ').grid(column=0, row=2, sticky=W)
-        lbl_radi2 = Label(lfr_sensors, text=self.current_fit.get_scan_radius()).grid(column=1, row=2, sticky=E)
+        lbl_radi2 = Label(lfr_sensors, textvariable=var['scan_radius']).grid(column=1, row=2, sticky=E)
         
         # Grid management.
         nbk_stats.grid(column=2, row=0, rowspan=3, sticky=W+E+N+S, padx=3, pady=3)
@@ -214,6 +346,86 @@ class DftUi(Frame):
         lfr_sensors.grid(column=0, row=4, sticky=EW)
         frm_overview.columnconfigure(0, minsize=250)
 
+    def set_fitting(self, fitting):
+        """ Makes fitting the one shown. Only its changes are shown from then
+        on, see fitting_changed. """
+        if self.current_fit is not None:
+            self.current_fit.unsubscribe(self.fitting_changed)
+        self.current_fit = fitting
+        self.current_fit.subscribe(self.fitting_changed)
+        self.cbx_fitting.set(fitting.name)
+        self.stat_vars['ds_name'].set(fitting.ds_name)
+        self.show_slots(DISPLAY_SLOTS)
+        self.show_stats(fitting.snapshot(), FittingStats._fields)
+        if fitting.dropped_items:
+            tkMessageBox.showwarning('Unknown items',
+                'These items no longer exist and were left out of %s:\n\n%s'
+                % (fitting.name, '\n'.join(fitting.dropped_items)), parent=self.parent)
+            # Only said once, saving the fitting drops them for good.
+            fitting.dropped_items = ()
+
+    def fitting_changed(self, fitting, slot_types, fields):
+        """ Called by the current fitting after each change. """
+        self.show_slots(slot_types)
+        self.show_stats(fitting.snapshot(), fields)
+
+    def show_slots(self, slot_types):
+        """ Replaces the listbox rows of the given slot types. """
+        start = 0
+        for slot_type in DISPLAY_SLOTS:
+            count = self.slot_rows.get(slot_type, 0)
+            if slot_type in slot_types:
+                rows = self.current_fit.get_slot_rows(slot_type)
+                if count:
+                    self.lbx_fitting.delete(start, start + count - 1)
+                if rows:
+                    self.lbx_fitting.insert(start, *rows)
+                count = self.slot_rows[slot_type] = len(rows)
+            start += count
+
+    def show_stats(self, stats, fields):
+        """ Sets the StringVars of the given FittingStats fields. """
+        for field in fields:
+            value = getattr(stats, field)
+            self.stat_vars[field].set('' if value is None else value)
+        if 'cpu_used' in fields or 'cpu_max' in fields:
+            self.stat_vars['cpu'].set('%s/%s' % (stats.cpu_used, stats.cpu_max))
+        if 'pg_used' in fields or 'pg_max' in fields:
+            self.stat_vars['pg'].set('%s/%s' % (stats.pg_used, stats.pg_max))
+
+    def status_display(self):
+        """ Shows whether changes have been written and keeps it current. """
+        self.lbl_status = Label(self, anchor=W)
+        self.lbl_status.grid(column=0, row=2, columnspan=2, sticky=W, padx=3)
+        self.update_status()
+
+    def update_status(self):
+        """ Polls the save writer, the label can not be set from its thread.
+        The startup times are shown until there is something to save. """
+        if 'interactive' in self.startup_times:
+            status = self.writer.get_status()
+            if status != 'Saved':
+                self.ready_text = None
+            self.lbl_status.configure(text=self.ready_text or status)
+        else:
+            self.lbl_status.configure(text='Loading...')
+        self.after(STATUS_POLL, self.update_status)
+
+    def close(self):
+        """ Writes any unsaved changes then closes the application. If they
+        cannot be written the user can try again, close without them or keep
+        the application open. """
+        while not self.writer.close():
+            retry = tkMessageBox.askyesnocancel('Save failed',
+                'Your changes could not be saved: %s\n\n'
+                'Try saving them again? Choose No to close without them.'
+                % self.writer.error, parent=self.parent)
+            if retry is None:
+                return
+            if not retry:
+                self.writer.discard()
+        self.parent.destroy()
+
     def new_dropsuit_window(self):
         """ Handles creating a whole new dropsuit. """
         dropsuit_window = DropsuitWindow(self)
@@ -238,46 +450,67 @@ class DftUi(Frame):
         """ Called from the DropsuitWindow class.  This will load the dropsuit
         given by DropsuitWindow into the current fit. """
         # Change the fit to hold the selected dropsuit.
-        self.current_fit = Fitting(fitting_name, self.current_char, dropsuit)
-        self.fitting_library.save_fitting(self.current_fit)
+        fitting = Fitting(fitting_name, self.current_char, dropsuit)
+        self.fitting_library.save_fitting(fitting)
 
-        # Call the fitting_display and stats_display functions.
-        self.combobox_fitting()
-        self.fitting_display()
-        self.stats_display()
+        # Display the new fitting and add it to the dropdown menu.
+        self.cbx_fitting.configure(values=self.fitting_library.get_fitting_list())
+        self.set_fitting(fitting)
 
     def add_module(self, *args):
-        """ Adds a module to the fitting. """
+        """ Adds a module to the fitting. The fitting tells fitting_changed
+        what to redraw. """
+        if self.current_fit is None:
+            # Still loading, there is no fitting to add to yet.
+            return
+
         # Find what is selected.
         module_name = self.tre_modules.selection()[0]
 
         # Check to see if its a module or weapon, get the item requested.
-        if module_name in self.module_library.get_names():
+        source = self.search_index.get_source(module_name)
+        if source == 'module.xml':
             self.current_fit.add_module(module_name)
-        else:
+        elif source == 'weapon.xml':
             self.current_fit.add_weapon(module_name)
+        else:
+            # A category was selected.
+            return
 
         # Save the changes.
         self.fitting_library.save_fitting(self.current_fit)
 
-        # Display the change.
-        self.fitting_display()
-        self.stats_display()
-
     def remove_module(self, *args):
         """ Removes a module from the fitting. """
-        # Find what is selected.
-        listbox_index = self.lbx_fitting.curselection()
-        module_name = self.lbx_fitting.get(listbox_index)
+        # Find what is selected. Rows line up with the fittings slot positions.
+        selection = self.lbx_fitting.curselection()
+        if not selection:
+            return
+        slot_type, position = self.current_fit.get_slot_positions()[int(selection[0])]
 
-        self.current_fit.remove_module(module_name)
+        if self.current_fit.remove_slot(slot_type, position) is None:
+            return
 
         # Save the changes.
         self.fitting_library.save_fitting(self.current_fit)
 
-        # Display the change.
-        self.fitting_display()
-        self.stats_display()
+    def undo(self, *args):
+        """ Takes back the last change to the fitting. The fitting tells
+        fitting_changed what to redraw. """
+        if self.current_fit is not None and self.current_fit.undo():
+            self.history_changed()
+
+    def redo(self, *args):
+        """ Makes the last undone change to the fitting again. """
+        if self.current_fit is not None and self.current_fit.redo():
+            self.history_changed()
+
+    def history_changed(self):
+        """ Saves the fitting after an undo or redo. It may have gone back
+        to another character. """
+        self.current_char = self.current_fit.char
+        self.cbx_character.set(self.current_char.name)
+        self.fitting_library.save_fitting(self.current_fit)
 
     def change_character(self, *args):
         """ Changes the current characters for this fitting. """
@@ -287,49 +520,98 @@ class DftUi(Frame):
         self.current_char = self.character_library.get_character(name)
         self.current_fit.change_character(self.current_char)
 
-        # Display the change.
-        self.fitting_display()
-        self.stats_display()
-
     def change_fitting(self, *args):
         """ Changes the current fitting. """
         fitting_name = self.cbx_fitting.get()
 
         # Change the current fitting.
-        self.current_fit = self.fitting_library.get_fitting(fitting_name)
-
-        # Display the change.
-        self.fitting_display()
-        self.stats_display()
+        self.set_fitting(self.fitting_library.get_fitting(fitting_name))
 
     def update_character(self, character):
-        """ Called by CharacterEditWindow.  This will update a character with
-        the changed skills. """
-        # Reload character data. THIS IS A HACK. Add better methods for changing and updating characters.
-        self.character_library = CharacterLibrary()
-        self.current_char = self.character_library.get_character(self.current_char.name)
+        """ Called by CharacterEditWindow and DeleteCharacterWindow.  The fit
+        is rebased onto the edited character if it is the current one, or onto
+        the given character if the current one was deleted. """
+        if character.name != self.current_char.name and \
+                self.current_char.name in self.character_library.get_character_list():
+            # Another character was edited, keep the current one.
+            character = self.character_library.get_character(self.current_char.name)
+        self.current_char = character
         self.current_fit.change_character(self.current_char)
 
-        # Display the changes.
-        self.fitting_display()
-        self.stats_display()
         # Reloads the character dropdown menu. Needed if a new character is added.
-        self.combobox_character()
+        self.cbx_character.configure(values=self.character_library.get_character_list())
+        self.cbx_character.set(self.current_char.name)
 
     def update_fitting(self, fitting):
         """ Called by DeleteFittingWindow. """
-        self.fitting_library = FittingLibrary()
-
         # Selects a fitting and makes it active.
         misc_fitting = self.fitting_library.get_fitting_list()[0]
-        self.current_fit = self.fitting_library.get_fitting(misc_fitting)
 
         # Display the changes.
-        self.combobox_fitting()
-        self.fitting_display()
-        self.stats_display()
+        self.cbx_fitting.configure(values=self.fitting_library.get_fitting_list())
+        self.set_fitting(self.fitting_library.get_fitting(misc_fitting))
             
 
+class LazyTree:
+    """ Fills a Treeview one category at a time. Only the categories are
+    inserted at first, each holding an empty placeholder so it can be opened.
+    The first time one is opened the placeholder is replaced by its items,
+    from get_children(category) through insert_child(category, child). """
+    def __init__(self, tree, parents, get_children, insert_child):
+        self.tree = tree
+        self.get_children = get_children
+        self.insert_child = insert_child
+        self.parents = list(parents)
+        self.placeholders = {} # {category: placeholder item} until it is filled.
+        self.filled = [] # Categories in the order they were filled.
+        self.items = {} # {category: its items in order} once it is filled.
+        for parent in parents:
+            tree.insert('', 'end', parent, text=parent, tag='ttk')
+            self.placeholders[parent] = tree.insert(parent, 'end')
+        tree.bind('<<TreeviewOpen>>', self.fill_opened)
+
+    def fill_opened(self, *args):
+        """ Fills the category being opened, which has the focus. """
+        self.fill(self.tree.focus())
+
+    def fill(self, parent):
+        """ Inserts the items of a category unless it is already filled. """
+        if parent not in self.placeholders:
+            return
+        self.tree.delete(self.placeholders.pop(parent))
+        for child in self.get_children(parent):
+            self.insert_child(parent, child)
+        self.filled.append(parent)
+        self.items[parent] = self.tree.get_children(parent)
+
+    def get_filled(self):
+        """ Returns every item inserted so far. """
+        output = []
+        for parent in self.filled:
+            output.extend(self.items[parent])
+        return output
+
+    def show_only(self, shown=None):
+        """ Detaches every item but those in shown, {category: [item, ...]},
+        and opens the categories holding them. The items are shown in the
+        order given. None shows every item again, in their first order. """
+        for parent in self.parents:
+            if shown is not None and parent not in shown:
+                self.tree.detach(parent)
+                continue
+            self.tree.move(parent, '', 'end')
+            if shown is not None:
+                self.fill(parent)
+                self.tree.item(parent, open=True)
+            items = self.items.get(parent, ())
+            if items:
+                self.tree.detach(*items)
+            if shown is not None:
+                items = [c for c in shown[parent] if c in self.items[parent]]
+            for child in items:
+                self.tree.move(child, parent, 'end')
+
+
 class DropsuitWindow(Frame):
     """ This handles the window for selecting a new dropsuit. """
     def __init__(self, parent):
@@ -337,7 +619,7 @@ class DropsuitWindow(Frame):
         self.parent = parent
         self.window = Toplevel(self.parent)
         self.window.resizable(width=False, height=False)
-        self.fitting_library = FittingLibrary()
+        self.fitting_library = parent.fitting_library
         self.dropsuit_library = DropsuitLibrary()
 
         # Call pertinent methods for this window.
@@ -390,7 +672,7 @@ class AddCharacterWindow(Frame):
         self.parent = parent
         self.window = Toplevel(self.parent)
         self.window.resizable(width=False, height=False)
-        self.character_library = CharacterLibrary()
+        self.character_library = parent.character_library
 
         # Call pertinent methods for this window.
         self.entrybox_name()
@@ -429,7 +711,7 @@ class CharacterEditWindow(Frame):
         self.parent = parent
         self.window = Toplevel(self.parent)
         self.window.resizable(width=False, height=False)
-        self.character_library = CharacterLibrary()
+        self.character_library = parent.character_library
         self.character = self.character_library.get_character(character_name)
 
         # Call pertinent methods for this window.
@@ -467,12 +749,14 @@ class CharacterEditWindow(Frame):
         self.tre_skills.column('#0', width=250, minwidth=150)
         self.tre_skills.column('level', width=30, minwidth=30)
         self.tre_skills.heading('level', text='Lvl')
-        for parent in self.character.get_parent_skills():
-            self.tre_skills.insert('', 'end', parent, text=parent, tag='ttk')
-            for child in self.character.get_children_skills(parent):
-                self.character.skill_level
-                self.tre_skills.insert(parent, 'end', child, text=child, tag='ttk')
-                self.tre_skills.set(child, 'level', self.character.get_skill_level(child))
+        # Skills are inserted when their category is first opened, with the
+        # level of whichever character is selected by then.
+        def insert_child(parent, child):
+            self.tre_skills.insert(parent, 'end', child, text=child, tag='ttk',
+                values=(self.character.get_skill_level(child),))
+        self.lazy_skills = LazyTree(self.tre_skills,
+            self.character.get_parent_skills(),
+            self.character.get_children_skills, insert_child)
 
         # Grid management.
         frm_skills.grid(column=0, row=1)
@@ -536,8 +820,10 @@ class CharacterEditWindow(Frame):
         # Change the character
         self.character = self.character_library.get_character(name)
 
-        # Display the change.
-        self.tree_skills()
+        # Display the change. Only the levels of the skills shown so far are
+        # set, the rest get theirs when they are inserted.
+        for skill in self.lazy_skills.get_filled():
+            self.tre_skills.set(skill, 'level', self.character.get_skill_level(skill))
 
     def done(self, *args):
         """ Close window, call a function from the main UI to pass the modified
@@ -552,7 +838,7 @@ class DeleteCharacterWindow(Frame):
         self.parent = parent
         self.window = Toplevel(self.parent)
         self.window.resizable(width=False, height=False)
-        self.character_library = CharacterLibrary()
+        self.character_library = parent.character_library
 
         # Call pertinent methods for this window.
         self.combobox_select_name()
@@ -583,7 +869,7 @@ class DeleteCharacterWindow(Frame):
 
         # Update main window to show some other character.
         other_character = self.character_library.get_character_list()[0]
-        self.parent.update_character(other_character)
+        self.parent.update_character(self.character_library.get_character(other_character))
         self.window.destroy()
 
 
@@ -593,7 +879,7 @@ class DeleteFittingWindow(Frame):
         self.parent = parent
         self.window = Toplevel(self.parent)
         self.window.resizable(width=False, height=False)
-        self.fitting_library = FittingLibrary()
+        self.fitting_library = parent.fitting_library
 
         # Call pertinent methods for this window.
         self.combobox_select_fitting()
@@ -1,21 +1,110 @@
 import os, sys
 import pickle
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
 import xml.etree.ElementTree as ET
+from array import array
 
-class XmlRetrieval:
+# Parsed xml data files shared by every XmlRetrieval. {file path: XmlCatalog}
+_catalogs = {}
+# Held while _catalogs is checked or rebuilt, catalogs may be loaded from a
+# background thread.
+_catalogs_lock = threading.RLock()
+
+# The xml files which are compiled together into one binary catalog.  The xml
+# stays the source of truth, the compiled file only speeds up start up.
+CATALOG_SOURCES = ('dropsuit.xml', 'module.xml', 'weapon.xml', 'skills.xml')
+COMPILED_CATALOG = 'catalog.bin'
+COMPILED_VERSION = 2
+
+# magic, version, byte order, sources, strings, string bytes, props, items, skill refs
+_HEADER = struct.Struct('<4sHHIIIIII')
+# file name string id, file size, crc32 of the file
+_SOURCE = struct.Struct('<iqI')
+_ITEM_FIELDS = 7 # source, parent, name, cpu text, pg text, first prop, prop count
+_PROP_FIELDS = 4 # tag, text (-1 number, -2 None), first skill ref, skill ref count
+_NO_STRING = -2
+
+# Journal files used by DataRetrieval start with JOURNAL_MAGIC and a version
+# followed by records of op, name size, payload size and crc32 of the name and
+# payload.  Version 1 payloads are pickled objects, version 2 payloads are
+# whatever the libraries encode function returns.
+JOURNAL_MAGIC = 'DFTJ'
+JOURNAL_OBJECTS = 1
+JOURNAL_RECORDS = 2
+JOURNAL_PUT = 1
+JOURNAL_DELETE = 2
+JOURNAL_PROTOCOL = 2
+# Compaction waits until at least this many bytes are superseded.
+JOURNAL_COMPACT_SIZE = 1 << 16
+_JOURNAL_HEADER = struct.Struct('<4sI')
+_RECORD = struct.Struct('<BHII')
+# Objects DataRetrieval keeps unpickled.
+DATA_CACHE_SIZE = 16
+# Seconds a SaveWriter waits for a burst of changes to end before writing.
+SAVE_DELAY = 0.5
+
+
+class XmlCatalog:
+    """ The parsed contents of one xml data file.  Items are indexed by name and
+    by parent so that lookups never need to touch the xml tree again. """
     def __init__(self, file_name):
-        self.file_name = get_file_loc(file_name)
+        self.file_name = file_name
+        self.mtime = os.path.getmtime(file_name)
+        self.size = None
+        self.crc = None
+
+        self.items = {} # {name: (properties, effecting_skills)}
+        self.layouts = {} # {name: StatLayout}
+        self.names = [] # Every item name in file order.
+        self.parents = [] # Every parent tag in file order.
+        self.children = {} # {parent: [(name, cpu, pg), ...]}
+
+        self._parse()
+
+    def _parse(self):
+        """ Reads the xml file once and builds every index. """
+        xml_file = open(self.file_name, 'rb')
+        try:
+            text = xml_file.read()
+        finally:
+            xml_file.close()
+        self.size = len(text)
+        self.crc = _get_crc(text)
+        xml_tree = ET.ElementTree(ET.fromstring(text))
+
+        for parent in xml_tree.findall('.//*[@name]/..'):
+            if parent.tag not in self.children:
+                self.parents.append(parent.tag)
+                self.children[parent.tag] = []
+            for child in parent:
+                name = child.attrib['name']
+                self.names.append(name)
+                self.children[parent.tag].append(
+                    (name, child.findtext('cpu'), child.findtext('pg')))
+                # The first item of a given name wins, same as an xpath find.
+                if name not in self.items:
+                    self.items[name] = self._get_properties(child)
 
     def get_target(self, target_name):
-        """Will return the targets xml data. """
-        # Create a dictionary of the targets properties and effecting skills.
+        """ Returns (properties, effecting_skills) of the named item. """
+        return self.items[target_name]
+
+    def get_layout(self, target_name):
+        """ Returns the StatLayout shared by every record of the named item. """
+        if target_name not in self.layouts:
+            properties = self.get_target(target_name)[0]
+            self.layouts[target_name] = make_stat_layout(properties)
+        return self.layouts[target_name]
+
+    def _get_properties(self, target):
+        """ Extracts the properties and effecting skills of a single item. """
         properties = {}
         effecting_skills = {}
 
-        xml_tree = ET.parse(self.file_name)
-        target = xml_tree.find('.//*[@name="%s"]' % target_name)
-
-        # Extracts targets data.
         for prop in target:
             # Get any xml attributes and save them to a dict for later use.
             if 'effected_by' in prop.attrib.keys():
@@ -28,82 +117,866 @@ class XmlRetrieval:
 
         return (properties, effecting_skills)
 
-    def get_list(self):
-        """ Returns a list of all items in an xml file. """
-        names_list = []
+    def _is_number(self, s):
+        """ Returns true if a string is a number. """
+        try:
+            float(s)
+            return True
+        except (TypeError, ValueError):
+            return False
 
-        xml_tree = ET.parse(self.file_name)
 
-        parents = xml_tree.findall('.//*[@name]/..')
+class CompiledCatalog(XmlCatalog):
+    """ One xml files worth of items read from the compiled binary catalog.
+    Only the names and parents are built up front, an items properties are
+    decoded from the stat arrays the first time it is asked for. """
+    def __init__(self, file_name, mtime, size, crc, tables, rows):
+        self.file_name = file_name
+        self.mtime = mtime
+        self.size = size
+        self.crc = crc
+        self.tables = tables
 
-        for parent in parents:
-            for child in parent:
-                names_list.append(child.attrib['name'])
+        self.items = {}
+        self.layouts = {}
+        self.names = []
+        self.parents = []
+        self.children = {}
+        self.rows = {} # {name: row in the item table}
 
-        return names_list
+        strings, items = tables['strings'], tables['items']
+        for row in rows:
+            base = row * _ITEM_FIELDS
+            parent = strings[items[base + 1]]
+            name = strings[items[base + 2]]
+            if parent not in self.children:
+                self.parents.append(parent)
+                self.children[parent] = []
+            self.names.append(name)
+            self.children[parent].append(
+                (name, _get_string(strings, items[base + 3]),
+                _get_string(strings, items[base + 4])))
+            self.rows.setdefault(name, row)
 
-    def get_parents(self):
-        """ Returns a list of all parents in the xml file. """
-        parent_list = []
+    def get_target(self, target_name):
+        if target_name not in self.items:
+            self.items[target_name] = self._decode(self.rows[target_name])
+        return self.items[target_name]
 
-        xml_tree = ET.parse(self.file_name)
-        parents = xml_tree.findall('.//*[@name]/..')
-        for parent in parents:
-            parent_list.append(parent.tag)
+    def _decode(self, row):
+        """ Rebuilds the properties and effecting skills of one item. """
+        strings, items = self.tables['strings'], self.tables['items']
+        props, values = self.tables['props'], self.tables['values']
+        skill_refs = self.tables['skill_refs']
+        properties = {}
+        effecting_skills = {}
 
-        return parent_list
+        first = items[row * _ITEM_FIELDS + 5]
+        for p in range(first, first + items[row * _ITEM_FIELDS + 6]):
+            base = p * _PROP_FIELDS
+            tag = strings[props[base]]
+            if props[base + 1] == -1:
+                properties[tag] = values[p]
+            else:
+                properties[tag] = _get_string(strings, props[base + 1])
+            if props[base + 3]:
+                refs = skill_refs[props[base + 2]:props[base + 2] + props[base + 3]]
+                effecting_skills[tag] = [strings[s] for s in refs]
 
-    def get_children(self, target):
-        """ Returns all the children of a given parent. """
-        children_list = []
+        return (properties, effecting_skills)
 
-        xml_tree = ET.parse(self.file_name)
-        parent = xml_tree.findall('.//%s/' % target)
-        for child in parent:
-            tup = (child.attrib['name'], child.find('cpu').text, child.find('pg').text)
-            children_list.append(tup)
 
-        return children_list
+class StatLayout(object):
+    """ Which stats one catalog item has.  Numeric stats get a position in the
+    values of the items StatRecords, text stats such as slot_type are kept
+    here once since skills never change them. """
+    __slots__ = ('keys', 'numeric', 'index', 'text')
 
-    def _is_number(self, s):
-        """ Returns true if a string is a number. """
+    def __init__(self, keys, text):
+        self.keys = tuple(keys) # Every stat in catalog order.
+        self.text = dict(text) # {stat: text}
+        self.numeric = tuple([key for key in self.keys if key not in self.text])
+        self.index = dict((key, i) for i, key in enumerate(self.numeric))
+
+    def __reduce__(self):
+        return (StatLayout, (self.keys, self.text))
+
+
+class StatRecord(object):
+    """ The stats of one Module, Weapon or Dropsuit.  Numbers are held in an
+    array of doubles laid out by a StatLayout shared with every other record
+    of the same item, so a record costs two slots and an array instead of a
+    dict.  It reads like the stats dict it replaces. """
+    __slots__ = ('layout', 'values')
+
+    def __init__(self, layout, values):
+        self.layout = layout
+        self.values = array('d', values)
+
+    def __getitem__(self, key):
         try:
-            float(s)
-            return True
-        except ValueError:
-            return False
+            return self.values[self.layout.index[key]]
+        except KeyError:
+            return self.layout.text[key]
 
+    def __setitem__(self, key, value):
+        """ Only numeric stats the item already has can be changed. """
+        self.values[self.layout.index[key]] = value
 
-class DataRetrieval:
+    def __contains__(self, key):
+        return key in self.layout.index or key in self.layout.text
+
+    def __iter__(self):
+        return iter(self.layout.keys)
+
+    def __len__(self):
+        return len(self.layout.keys)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __eq__(self, other):
+        if isinstance(other, StatRecord):
+            other = dict(other.items())
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    # Mutable, so unhashable like the dict it replaces.
+    __hash__ = None
+
+    def __reduce__(self):
+        return (StatRecord, (self.layout, self.values))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(self.layout.keys)
+
+    def numeric_items(self):
+        """ Returns (stat, value) of only the numeric stats. """
+        return zip(self.layout.numeric, self.values)
+
+    def items(self):
+        return [(key, self[key]) for key in self.layout.keys]
+
+    def copy(self):
+        return StatRecord(self.layout, self.values)
+
+
+def make_stat_record(stats):
+    """ Turns a stats dict, such as one pickled before StatRecord existed, into
+    a StatRecord with a layout of its own. """
+    layout = make_stat_layout(stats)
+    return StatRecord(layout, [stats[key] for key in layout.numeric])
+
+
+def make_stat_layout(properties):
+    """ Returns the StatLayout of a catalog items properties.  Stat names are
+    interned so every layout shares the same strings. """
+    keys = [intern(key) for key in properties]
+    text = dict((intern(key), properties[key]) for key in properties
+        if not isinstance(properties[key], float))
+    return StatLayout(keys, text)
+
+
+def _get_string(strings, string_id):
+    if string_id == _NO_STRING:
+        return None
+    return strings[string_id]
+
+
+def compile_catalog(catalogs=None):
+    """ Writes every file in CATALOG_SOURCES into one versioned binary file
+    made of a string table and typed arrays of items, properties and stats.
+    The file is written to a temporary name and renamed into place so a
+    reader never sees half of it. """
+    string_ids = {}
+    strings = []
+    items, props, values, skill_refs = array('i'), array('i'), array('d'), array('i')
+    sources = []
+
+    def intern_string(s):
+        if s is None:
+            return _NO_STRING
+        if s not in string_ids:
+            string_ids[s] = len(strings)
+            strings.append(s)
+        return string_ids[s]
+
+    for index, source in enumerate(CATALOG_SOURCES):
+        file_name = get_file_loc(source)
+        if catalogs and file_name in catalogs:
+            catalog = catalogs[file_name]
+        else:
+            catalog = XmlCatalog(file_name)
+        sources.append((intern_string(source), catalog.size, catalog.crc))
+
+        for parent in catalog.parents:
+            for name, cpu, pg in catalog.children[parent]:
+                properties, effecting_skills = catalog.get_target(name)
+                items.extend((index, intern_string(parent), intern_string(name),
+                    intern_string(cpu), intern_string(pg),
+                    len(values), len(properties)))
+                for tag in properties:
+                    value = properties[tag]
+                    skills = effecting_skills.get(tag, ())
+                    if isinstance(value, float):
+                        props.extend((intern_string(tag), -1, len(skill_refs), len(skills)))
+                        values.append(value)
+                    else:
+                        props.extend((intern_string(tag), intern_string(value),
+                            len(skill_refs), len(skills)))
+                        values.append(0.0)
+                    skill_refs.extend([intern_string(s) for s in skills])
+
+    blob = []
+    offsets = array('i', [0])
+    for s in strings:
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        blob.append(s)
+        offsets.append(offsets[-1] + len(s))
+    blob = ''.join(blob)
+
+    byte_order = 0 if sys.byteorder == 'little' else 1
+    header = _HEADER.pack('DFTC', COMPILED_VERSION, byte_order, len(sources),
+        len(strings), len(blob), len(values), len(items) / _ITEM_FIELDS,
+        len(skill_refs))
+    # Every section is padded to 8 bytes so the arrays stay aligned.
+    sections = [header + ''.join([_SOURCE.pack(*s) for s in sources]),
+        offsets.tostring(), blob, values.tostring(), items.tostring(),
+        props.tostring(), skill_refs.tostring()]
+
+    file_name = get_file_loc(COMPILED_CATALOG)
+    temp_name = file_name + '.tmp'
+    data_file = open(temp_name, 'wb')
+    try:
+        for section in sections:
+            data_file.write(section)
+            data_file.write('\0' * (-len(section) % 8))
+        data_file.flush()
+        os.fsync(data_file.fileno())
+    finally:
+        data_file.close()
+    replace_file(temp_name, file_name)
+
+
+def load_compiled_catalog():
+    """ Reads the compiled catalog and returns {file path: catalog} for every
+    source whose contents have not changed since it was compiled.  Sources are
+    compared by size and crc32 rather than mtime, which changes whenever the
+    files are copied or unpacked.  An empty dict is returned if the file is
+    missing or was written by another version. """
+    try:
+        data_file = open(get_file_loc(COMPILED_CATALOG), 'rb')
+    except IOError:
+        return {}
+    try:
+        data = data_file.read()
+    finally:
+        data_file.close()
+
+    try:
+        tables, sources = _read_compiled(data)
+    except (struct.error, ValueError, IndexError):
+        return {}
+    if tables is None:
+        return {}
+
+    catalogs = {}
+    for index, (source, size, crc) in enumerate(sources):
+        file_name = get_file_loc(source)
+        try:
+            if os.path.getsize(file_name) != size:
+                continue
+            mtime = os.path.getmtime(file_name)
+            xml_file = open(file_name, 'rb')
+            try:
+                if _get_crc(xml_file.read()) != crc:
+                    continue
+            finally:
+                xml_file.close()
+        except EnvironmentError:
+            continue
+        rows = [r for r in range(len(tables['items']) / _ITEM_FIELDS)
+            if tables['items'][r * _ITEM_FIELDS] == index]
+        catalogs[file_name] = CompiledCatalog(file_name, mtime, size, crc, tables, rows)
+    return catalogs
+
+
+def _read_compiled(data):
+    """ Splits a catalog file back into its string table and arrays. """
+    (magic, version, byte_order, n_sources, n_strings, n_bytes, n_props,
+        n_items, n_refs) = _HEADER.unpack_from(data, 0)
+    if magic != 'DFTC' or version != COMPILED_VERSION or \
+            byte_order != (0 if sys.byteorder == 'little' else 1):
+        return None, None
+
+    position = [_HEADER.size]
+    def read(size):
+        start = position[0]
+        position[0] += size + (-size % 8)
+        return data[start:start + size]
+    def read_array(typecode, count):
+        a = array(typecode)
+        a.fromstring(read(count * a.itemsize))
+        return a
+
+    raw_sources = []
+    for i in range(n_sources):
+        raw_sources.append(_SOURCE.unpack_from(data, position[0]))
+        position[0] += _SOURCE.size
+    position[0] += -position[0] % 8
+
+    offsets = read_array('i', n_strings + 1)
+    blob = read(n_bytes)
+    strings = []
+    for i in range(n_strings):
+        s = blob[offsets[i]:offsets[i + 1]]
+        try:
+            s.decode('ascii')
+        except UnicodeDecodeError:
+            s = s.decode('utf-8')
+        strings.append(s)
+
+    tables = {'strings': strings}
+    tables['values'] = read_array('d', n_props)
+    tables['items'] = read_array('i', n_items * _ITEM_FIELDS)
+    tables['props'] = read_array('i', n_props * _PROP_FIELDS)
+    tables['skill_refs'] = read_array('i', n_refs)
+
+    sources = [(strings[s], size, crc) for s, size, crc in raw_sources]
+    return tables, sources
+
+
+def _get_crc(text):
+    """ crc32 of a files contents as an unsigned int. """
+    return zlib.crc32(text) & 0xffffffff
+
+
+def replace_file(source, destination):
+    """ Renames source over destination.  Windows will not rename onto an
+    existing file so it has to be removed first there. """
+    try:
+        os.rename(source, destination)
+    except OSError:
+        os.remove(destination)
+        os.rename(source, destination)
+
+
+def get_catalog(file_name):
+    """ Returns the shared catalog for an xml file.  On first use the compiled
+    catalog is tried, otherwise the xml is parsed and the compiled catalog is
+    rebuilt.  A catalog is parsed again once its modification time has
+    changed. """
+    with _catalogs_lock:
+        catalog = _catalogs.get(file_name)
+        if catalog is None and not _catalogs:
+            _catalogs.update(load_compiled_catalog())
+            catalog = _catalogs.get(file_name)
+        if catalog is None or catalog.mtime != os.path.getmtime(file_name):
+            catalog = XmlCatalog(file_name)
+            _catalogs[file_name] = catalog
+            if os.path.basename(file_name) in CATALOG_SOURCES:
+                _rebuild_compiled_catalog()
+        return catalog
+
+
+def _rebuild_compiled_catalog():
+    """ Parses any out of date sources and writes a new compiled catalog. """
+    for source in CATALOG_SOURCES:
+        file_name = get_file_loc(source)
+        catalog = _catalogs.get(file_name)
+        if catalog is None or catalog.mtime != os.path.getmtime(file_name):
+            _catalogs[file_name] = XmlCatalog(file_name)
+    try:
+        compile_catalog(_catalogs)
+    except EnvironmentError:
+        # A read only install, keep using the parsed xml.
+        pass
+
+
+class XmlRetrieval:
     def __init__(self, file_name):
         self.file_name = get_file_loc(file_name)
 
-        self.data = {}
+    def get_target(self, target_name):
+        """ Will return the targets xml data as a tuple of its properties and
+        effecting skills.  These dicts are shared, do not modify them. """
+        return get_catalog(self.file_name).get_target(target_name)
+
+    def get_layout(self, target_name):
+        """ Returns the StatLayout of the named item. """
+        return get_catalog(self.file_name).get_layout(target_name)
 
+    def get_catalog(self):
+        """ Returns the current catalog, for looking up an items target and
+        layout together. """
+        return get_catalog(self.file_name)
+
+    def get_list(self):
+        """ Returns a list of all items in an xml file. """
+        return list(get_catalog(self.file_name).names)
+
+    def get_parents(self):
+        """ Returns a list of all parents in the xml file. """
+        return list(get_catalog(self.file_name).parents)
+
+    def get_children(self, target):
+        """ Returns all the children of a given parent. """
+        return list(get_catalog(self.file_name).children.get(target, ()))
+
+
+class DataRetrieval:
+    """ A library of pickled objects keyed by name.  The file is a journal of
+    put and delete records, so saving one object only appends that object.
+    Each record is checked with a crc32 and synced to disk before save_data
+    returns, so a crash mid-save loses at most that record.  Superseded
+    records are dropped by compacting into a new file which is renamed into
+    place.
+
+    Only the record index is read when the library is opened.  Objects are
+    decoded by get_data and the most recently used are kept in a cache.
+
+    Objects are pickled unless encode and decode are given, in which case
+    encode(obj) must return a string which decode turns back into the object.
+    Files in the old single pickle format, or holding pickled objects when
+    encode is given, are loaded whole and converted when they are opened.
+
+    If a SaveWriter is given, save_data and delete_data only record the change
+    and the writer thread writes it later.  Until then get_names and get_data
+    answer from the pending changes. """
+    def __init__(self, file_name, encode=None, decode=None,
+            cache_size=DATA_CACHE_SIZE, writer=None):
+        self.file_name = get_file_loc(file_name)
+        self.cache_size = cache_size
+        self.writer = writer
+        self.lock = threading.RLock()
+        self.pending = {} # {name: object, or None to delete} not yet written.
+        if encode is None:
+            self.encode = lambda obj: pickle.dumps(obj, JOURNAL_PROTOCOL)
+            self.decode = pickle.loads
+            self.version = JOURNAL_OBJECTS
+        else:
+            self.encode = encode
+            self.decode = decode
+            self.version = JOURNAL_RECORDS
+
+        self.cache = OrderedDict() # {name: object} least recently used first.
+        self.legacy = None # {name: object} of an unconverted pickle file.
         self._load()
 
-    def save_data(self, obj):
-        """ Will save all the character classes. """
-        self.data[obj.name] = obj
+    def get_names(self):
+        """ Returns the names of every saved object as a tuple. """
+        with self.lock:
+            self._refresh()
+            if self.legacy is not None:
+                names = self.legacy.keys()
+            else:
+                names = self.records.keys()
+            names = [n for n in names if self.pending.get(n, n) is not None]
+            for name, obj in self.pending.items():
+                if obj is not None and name not in names:
+                    names.append(name)
+            return tuple(names)
 
-        data_file = open(self.file_name, 'wb')
-        pickle.dump(self.data, data_file)
-        data_file.close()
+    def get_data(self, name):
+        """ Returns the saved object, loading it if it is not cached. """
+        with self.lock:
+            if name in self.pending:
+                if self.pending[name] is None:
+                    raise KeyError(name)
+                return self.pending[name]
+            self._refresh()
+            if self.legacy is not None:
+                return self.legacy[name]
+            if name in self.cache:
+                obj = self.cache.pop(name)
+            else:
+                offset, size = self.records[name]
+                op, name, payload = _read_record(self.file_name, offset, size)
+                obj = self.decode(payload)
+            self._cache(name, obj)
+            return obj
+
+    def save_data(self, obj):
+        """ Saves or replaces one object. """
+        with self.lock:
+            if self.writer is not None:
+                self.pending[obj.name] = obj
+                self.cache.pop(obj.name, None)
+                self.writer.mark(self, obj.name)
+            else:
+                self._refresh()
+                self._store(obj.name, obj)
 
     def delete_data(self, obj):
-        del self.data[obj.name]
+        with self.lock:
+            if obj.name not in self.get_names():
+                raise KeyError(obj.name)
+            if self.writer is not None:
+                self.pending[obj.name] = None
+                self.cache.pop(obj.name, None)
+                self.writer.mark(self, obj.name)
+            else:
+                self._store(obj.name, None)
+
+    def write_pending(self, name):
+        """ Writes the pending change to name, if there is one.  Called by the
+        SaveWriter thread. """
+        with self.lock:
+            if name in self.pending:
+                self._refresh()
+                self._store(name, self.pending[name])
+                del self.pending[name]
+
+    def compact(self):
+        """ Rewrites the file with only the live records.  Records are copied
+        as they are, only a legacy library has to be encoded again.
 
-        data_file = open(self.file_name, 'wb')
-        pickle.dump(self.data, data_file)
+        Only what is on disk is compacted.  Pending changes are left to the
+        writer, including the one being written when compaction started,
+        which is on disk but still pending. """
+        temp_name = self.file_name + '.tmp'
+        records = {}
+        if self.legacy is not None:
+            names = self.legacy.keys()
+        else:
+            names = self.records.keys()
+        data_file = open(temp_name, 'wb')
+        try:
+            data_file.write(_JOURNAL_HEADER.pack(JOURNAL_MAGIC, self.version))
+            offset = _JOURNAL_HEADER.size
+            for name in sorted(names):
+                if self.legacy is not None:
+                    record = _pack_record(JOURNAL_PUT, name,
+                        self.encode(self.legacy[name]))
+                else:
+                    old_offset, size = self.records[name]
+                    record = _read_record(self.file_name, old_offset, size, True)
+                data_file.write(record)
+                records[name] = (offset, len(record))
+                offset += len(record)
+            data_file.flush()
+            os.fsync(data_file.fileno())
+        except:
+            data_file.close()
+            os.remove(temp_name)
+            raise
         data_file.close()
+        replace_file(temp_name, self.file_name)
+
+        self.records = records
+        self.end = offset
+        self.dead = 0
+        self.legacy = None
+        self._set_stamp()
+
+    def _store(self, name, obj):
+        """ Writes obj under name, or deletes name if obj is None. """
+        if self.legacy is not None:
+            if obj is None:
+                self.legacy.pop(name, None)
+            else:
+                self.legacy[name] = obj
+        if obj is not None:
+            self._write(JOURNAL_PUT, name, self.encode(obj))
+            self.cache.pop(name, None)
+            self._cache(name, obj)
+        else:
+            if self.legacy is not None or name in self.records:
+                self._write(JOURNAL_DELETE, name, '')
+            self.cache.pop(name, None)
+
+    def _cache(self, name, obj):
+        self.cache[name] = obj
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _write(self, op, name, payload):
+        if self.legacy is not None:
+            # The whole library is rewritten once in the journal format.
+            self.compact()
+            return
+        if self.end == 0:
+            data_file = open(self.file_name, 'wb')
+            data_file.write(_JOURNAL_HEADER.pack(JOURNAL_MAGIC, self.version))
+            self.end = _JOURNAL_HEADER.size
+        else:
+            data_file = open(self.file_name, 'r+b')
+        record = _pack_record(op, name, payload)
+        try:
+            # Anything past self.end is a torn record from an earlier crash.
+            data_file.seek(self.end)
+            data_file.write(record)
+            data_file.truncate()
+            data_file.flush()
+            os.fsync(data_file.fileno())
+        finally:
+            data_file.close()
+
+        if name in self.records:
+            self.dead += self.records.pop(name)[1]
+        if op == JOURNAL_PUT:
+            self.records[name] = (self.end, len(record))
+        else:
+            self.dead += len(record)
+        self.end += len(record)
+        self._set_stamp()
+
+        if self.dead > JOURNAL_COMPACT_SIZE and self.dead > self.end / 2:
+            self.compact()
+
+    def _refresh(self):
+        """ Reloads the index if another DataRetrieval has written the file. """
+        if self._get_stamp() != self.stamp:
+            self.cache.clear()
+            self._load()
+
+    def _get_stamp(self):
+        try:
+            stat = os.stat(self.file_name)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime)
+
+    def _set_stamp(self):
+        self.stamp = self._get_stamp()
 
     def _load(self):
-        """ """
+        """ Reads the record index.  A file in an older format is read whole
+        and converted. """
+        self._load_index()
+        if self.legacy is not None and self.version == JOURNAL_RECORDS:
+            try:
+                self.compact()
+            except EnvironmentError:
+                # Read only, keep using the loaded objects.
+                pass
+
+    def _load_index(self):
+        self.records = {} # {name: (offset, size)} of each live record.
+        self.end = 0 # Offset just past the last good record.
+        self.dead = 0 # Bytes of superseded and delete records.
+        self.legacy = None
+        self._set_stamp()
         try:
             data_file = open(self.file_name, 'rb')
-            self.data = pickle.load(data_file)
         except IOError:
             print 'No data file found.'
+            return
+        try:
+            header = data_file.read(_JOURNAL_HEADER.size)
+            if not header.startswith(JOURNAL_MAGIC):
+                if header:
+                    data_file.seek(0)
+                    self.legacy = pickle.load(data_file)
+                return
+            magic, version = _JOURNAL_HEADER.unpack(header)
+            entries = _scan_records(data_file, len(header))
+            if version != self.version:
+                if version != JOURNAL_OBJECTS:
+                    raise ValueError('%s holds version %s records' %
+                        (self.file_name, version))
+                # Pickled objects from before records were encoded.
+                self.legacy = {}
+                for op, name, offset, size in entries:
+                    if op == JOURNAL_PUT:
+                        data_file.seek(offset)
+                        op, name, payload = _unpack_record(data_file.read(size))
+                        self.legacy[name] = pickle.loads(payload)
+                    else:
+                        self.legacy.pop(name, None)
+                return
+        finally:
+            data_file.close()
+
+        for op, name, offset, size in entries:
+            if name in self.records:
+                self.dead += self.records.pop(name)[1]
+            if op == JOURNAL_PUT:
+                self.records[name] = (offset, size)
+            else:
+                self.dead += size
+            self.end = offset + size
+        if not entries:
+            self.end = _JOURNAL_HEADER.size
+
+
+class SaveWriter:
+    """ Writes the changes recorded by DataRetrievals on a background thread.
+    A burst of changes is written once it has been quiet for delay seconds,
+    and an object changed many times in a burst is written once. """
+    def __init__(self, delay=SAVE_DELAY):
+        self.delay = delay
+        self.dirty = OrderedDict() # {(DataRetrieval, name): None}
+        self.condition = threading.Condition()
+        self.last_change = 0
+        self.writing = False
+        self.closed = False
+        self.error = None
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def mark(self, data, name):
+        """ Queues the pending change to name in data. """
+        with self.condition:
+            self.dirty.pop((data, name), None)
+            self.dirty[(data, name)] = None
+            self.last_change = time.time()
+            self.condition.notify_all()
+
+    def get_status(self):
+        """ Returns a short description of the save state for the UI. """
+        with self.condition:
+            if self.error is not None:
+                return 'Save failed: %s' % self.error
+            if self.dirty or self.writing:
+                return 'Saving...'
+            return 'Saved'
+
+    def flush(self):
+        """ Writes every queued change now and waits until they are done.  A
+        failed write is left queued. """
+        with self.condition:
+            self.last_change = 0
+            self.error = None
+            self.condition.notify_all()
+            while (self.dirty or self.writing) and self.error is None:
+                self.condition.wait()
+
+    def discard(self):
+        """ Drops every queued change, such as those which failed to write. """
+        with self.condition:
+            self.dirty.clear()
+            self.error = None
+
+    def close(self):
+        """ Flushes and stops the writer thread.  If a write failed the thread
+        is left running with the change still queued and False is returned,
+        so it can be retried or discarded. """
+        self.flush()
+        with self.condition:
+            if self.error is not None:
+                return False
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        return True
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.dirty and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                # Wait for the burst of changes to end.
+                while True:
+                    remaining = self.last_change + self.delay - time.time()
+                    if remaining <= 0 or self.closed:
+                        break
+                    self.condition.wait(remaining)
+                batch = self.dirty.keys()
+                self.dirty.clear()
+                self.writing = True
+
+            error = None
+            failed = []
+            for data, name in batch:
+                try:
+                    data.write_pending(name)
+                except Exception, e:
+                    error = e
+                    failed.append((data, name))
+
+            with self.condition:
+                for key in failed:
+                    self.dirty.setdefault(key, None)
+                self.error = error
+                if failed:
+                    self.last_change = time.time()
+                self.writing = False
+                self.condition.notify_all()
+
+
+def _pack_record(op, name, payload):
+    """ Returns a journal record: header, name then payload. """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    crc = zlib.crc32(name + payload) & 0xffffffff
+    return _RECORD.pack(op, len(name), len(payload), crc) + name + payload
+
+
+def _scan_records(data_file, offset):
+    """ Returns [(op, name, offset, size)] for the records from offset on by
+    reading only their headers and names.  Reading stops at a torn record.
+    Only the last record is crc checked, as that is the one a crash during a
+    save could have left half written. """
+    data_file.seek(0, 2)
+    file_size = data_file.tell()
+    entries = []
+    while offset + _RECORD.size <= file_size:
+        data_file.seek(offset)
+        op, name_size, payload_size, crc = _RECORD.unpack(data_file.read(_RECORD.size))
+        size = _RECORD.size + name_size + payload_size
+        if offset + size > file_size or op not in (JOURNAL_PUT, JOURNAL_DELETE):
+            break
+        name = _decode_name(data_file.read(name_size))
+        entries.append((op, name, offset, size))
+        offset += size
+
+    if entries:
+        op, name, offset, size = entries[-1]
+        data_file.seek(offset)
+        try:
+            _unpack_record(data_file.read(size))
+        except ValueError:
+            entries.pop()
+    return entries
+
+
+def _read_record(file_name, offset, size, raw=False):
+    """ Returns (op, name, payload) of the record at offset, or its bytes if
+    raw is set. """
+    data_file = open(file_name, 'rb')
+    try:
+        data_file.seek(offset)
+        record = data_file.read(size)
+    finally:
+        data_file.close()
+    result = _unpack_record(record)
+    if raw:
+        return record
+    return result
+
+
+def _unpack_record(record):
+    """ Splits a record into (op, name, payload).  ValueError is raised if it
+    is torn or fails its crc. """
+    if len(record) < _RECORD.size:
+        raise ValueError('Truncated journal record')
+    op, name_size, payload_size, crc = _RECORD.unpack_from(record)
+    body = record[_RECORD.size:]
+    if len(body) != name_size + payload_size or \
+            zlib.crc32(body) & 0xffffffff != crc:
+        raise ValueError('Corrupt journal record')
+    return op, _decode_name(body[:name_size]), body[name_size:]
+
+
+def _decode_name(name):
+    """ Names come back as str unless they were saved as non ascii unicode. """
+    try:
+        return name.decode('ascii').encode('ascii')
+    except UnicodeDecodeError:
+        return name.decode('utf-8')
 
 
 def get_file_loc(file_name):
@@ -117,6 +990,40 @@ def get_file_loc(file_name):
         
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['compile']:
+        # Run before freezing so the executable ships a fresh catalog.
+        compile_catalog()
+        print 'Compiled %s' % get_file_loc(COMPILED_CATALOG)
+        sys.exit()
+
+    if sys.argv[1:] == ['check']:
+        # Compacting while another save is still pending must keep it.
+        import shutil, tempfile
+        class Saved:
+            def __init__(self, name, text):
+                self.name = name
+                self.text = text
+        JOURNAL_COMPACT_SIZE = 100
+        temp_dir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(temp_dir, 'check.dat')
+            writer = SaveWriter(delay=3600)
+            data = DataRetrieval(file_name, writer=writer)
+            data.save_data(Saved('b', 'kept'))
+            for i in range(3):
+                data.save_data(Saved('a', 'x' * 200 + str(i)))
+                data.write_pending('a')
+            assert os.listdir(temp_dir) == ['check.dat']
+            assert writer.close()
+            data = DataRetrieval(file_name)
+            assert sorted(data.get_names()) == ['a', 'b']
+            assert data.get_data('a').text == 'x' * 200 + '2'
+            assert data.get_data('b').text == 'kept'
+        finally:
+            shutil.rmtree(temp_dir)
+        print 'Checks passed'
+        sys.exit()
+
     mod = XmlRetrieval('module.xml')
 
     #ds._get_target('Assault Type-II')